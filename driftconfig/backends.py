@@ -2,16 +2,140 @@
 '''
 ReLib Backends
 '''
+import errno
+import json
 import logging
 import os
+import threading
+import time
 from StringIO import StringIO
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 from urlparse import urlparse
 import zipfile
 
-from .relib import Backend, BackendError, register
+from .relib import Backend, BackendError, register, jsonloads, LRUCache, STREAM_CHUNK_SIZE
 
 log = logging.getLogger(__name__)
 
+# Max total size of the file content kept in the FileBackend read cache. Files larger than
+# this are not cached at all.
+READ_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ClientRegistry(object):
+    """
+    Process wide registry of clients and connection pools, so backend instances for the
+    same endpoint share them instead of paying for client construction and new
+    connections every time.
+
+    Clients are dropped when the process forks, and clients which have a health check
+    are checked at most every 'health_check_interval' seconds when they are handed out.
+    """
+
+    health_check_interval = 30.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}  # Key is client key, value is dict with 'client' and 'checked'.
+        self._pid = os.getpid()
+
+    def get(self, key, factory, health_check=None, dispose=None):
+        """
+        Return the client for 'key'. If it doesn't exist or failed its health check,
+        a new one is created by calling 'factory'.
+
+        'health_check' is a function which accepts the client and raises an exception
+        or returns False if the client is no longer usable.
+        'dispose' is a function which is called with clients that are dropped.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # Connections must not be shared with the parent process.
+                self._clients = {}
+                self._pid = os.getpid()
+            entry = self._clients.get(key)
+            now = time.time()
+            needs_check = entry and health_check and now - entry['checked'] > self.health_check_interval
+            if needs_check:
+                entry['checked'] = now  # Other threads use the client while it's checked.
+
+        if needs_check:
+            try:
+                healthy = health_check(entry['client']) is not False
+            except Exception as e:
+                log.warning("Client %s failed health check: %s", key, e)
+                healthy = False
+            if not healthy:
+                with self._lock:
+                    if self._clients.get(key) is entry:
+                        del self._clients[key]
+                if dispose:
+                    dispose(entry['client'])
+                entry = None
+
+        if entry:
+            return entry['client']
+
+        client = factory()
+        with self._lock:
+            # Another thread may have beaten us to it.
+            entry = self._clients.setdefault(key, {'client': client, 'checked': time.time()})
+        if entry['client'] is not client and dispose:
+            dispose(client)
+        return entry['client']
+
+    def clear(self):
+        """Drop all clients."""
+        with self._lock:
+            self._clients = {}
+
+
+clients = ClientRegistry()
+
+
+def get_s3_client(region_name=None):
+    """Return a shared boto3 S3 client for 'region_name'."""
+    import boto3
+    return clients.get(('s3', region_name), lambda: boto3.client('s3', region_name=region_name))
+
+
+def get_redis_connection_pool(host, port, db):
+    """Return a shared Redis connection pool for 'host', 'port' and 'db'."""
+    import redis
+    return clients.get(
+        ('redis', host, port, db),
+        lambda: redis.ConnectionPool(host=host, port=port, db=db, socket_timeout=5.0),
+        health_check=lambda pool: redis.StrictRedis(connection_pool=pool).ping(),
+        dispose=lambda pool: pool.disconnect(),
+    )
+
+
+class ChunkReader(object):
+    """Read-only file object which reads from 'chunks', an iterator of strings."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = ''
+
+    def read(self, size=-1):
+        parts = [self._buf]
+        length = len(self._buf)
+        while size < 0 or length < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        if size < 0:
+            self._buf = ''
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
 
 @register
 class S3Backend(Backend):
@@ -21,14 +145,15 @@ class S3Backend(Backend):
 
     __scheme__ = 's3'
     default_format = 'pickle'
+    max_concurrency = 8  # Requests are latency bound and the boto3 client is thread safe.
 
     def __init__(self, bucket_name, folder_name, region_name=None, etag=None):
-        import boto3
-        self.s3_client = boto3.client('s3', region_name=region_name)
+        self.s3_client = get_s3_client(region_name)
         self.bucket_name = bucket_name
         self.folder_name = folder_name.lstrip('/')  # Strip leading slashes
         self.region_name = region_name
         self.etag = etag
+        self._bucket_exists = False
 
     @classmethod
     def create_from_url_parts(cls, parts, query):
@@ -53,6 +178,35 @@ class S3Backend(Backend):
     def save_data(self, file_name, data):
         return self._save_data_with_bucket_logic(file_name, data, try_create_bucket=True)
 
+    def save_stream(self, file_name, chunks):
+        # boto3 uploads the chunks as they are read, using a multipart upload if the data
+        # is large. The data can't be sent again so the bucket is created beforehand if
+        # needed.
+        self._ensure_bucket()
+        key_name = self.get_key_name(file_name)
+        log.debug("Uploading stream to s3://%s/%s", self.bucket_name, key_name)
+        self.s3_client.upload_fileobj(
+            ChunkReader(chunks),
+            self.bucket_name,
+            key_name,
+            ExtraArgs={'ContentType': 'application/json'},
+        )
+
+    def _ensure_bucket(self):
+        from botocore.client import ClientError
+        if self._bucket_exists:
+            return
+        try:
+            self.s3_client.head_bucket(Bucket=self.bucket_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchBucket', '404'):
+                raise
+            self.s3_client.create_bucket(
+                Bucket=self.bucket_name,
+                CreateBucketConfiguration={'LocationConstraint': self.region_name}
+            )
+        self._bucket_exists = True
+
     def _save_data_with_bucket_logic(self, file_name, data, try_create_bucket):
         from botocore.client import ClientError
         f = StringIO(data)
@@ -82,12 +236,66 @@ class S3Backend(Backend):
         self.s3_client.download_fileobj(self.bucket_name, key_name, f)
         return f.getvalue()
 
+    def load_stream(self, file_name):
+        key_name = self.get_key_name(file_name)
+        log.debug("Streaming s3://%s/%s", self.bucket_name, key_name)
+        response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key_name)
+        return response['Body'].iter_chunks(STREAM_CHUNK_SIZE)
+
+    def delete_data(self, file_name):
+        # Deleting a key which doesn't exist is not an error in S3.
+        self.s3_client.delete_object(Bucket=self.bucket_name, Key=self.get_key_name(file_name))
+
+    def get_etag(self, file_name):
+        from botocore.client import ClientError
+        try:
+            response = self.s3_client.head_object(Bucket=self.bucket_name, Key=self.get_key_name(file_name))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            return None
+        return response['ETag']
+
+    def compare_and_swap_manifest(self, expected_token, manifest):
+        # Uses S3 conditional writes on the ETag of the manifest object.
+        from botocore.client import ClientError
+        key_name = self.get_key_name(self.manifest_filename)
+        try:
+            response = self.s3_client.get_object(Bucket=self.bucket_name, Key=key_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise
+            current, etag = None, None
+        else:
+            current = jsonloads(response['Body'].read(), self.manifest_filename)
+            etag = response['ETag']
+
+        current_token = current['version_token'] if current else None
+        if current_token != expected_token:
+            return False
+
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=key_name,
+                Body=json.dumps(manifest, indent=4, sort_keys=True),
+                ContentType='application/json',
+                **condition
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
 
 @register
 class RedisBackend(Backend):
 
     __scheme__ = 'redis'
     default_format = 'pickle'
+    max_concurrency = 8  # The connection pool hands out a connection per thread.
 
     def __init__(self, host=None, port=None, db=None, prefix=None, expire_sec=None):
         import redis
@@ -98,12 +306,7 @@ class RedisBackend(Backend):
         self.expire_sec = expire_sec
 
 
-        self.conn = redis.StrictRedis(
-            host=host,
-            port=port,
-            db=db,
-            socket_timeout=5.0,
-        )
+        self.conn = redis.StrictRedis(connection_pool=get_redis_connection_pool(host, port, db))
 
         self.host, self.port, self.db = host, port, db
         log.debug("%s initialized.", self)
@@ -148,6 +351,28 @@ class RedisBackend(Backend):
             raise BackendError("Redis cache doesn't have '{}'. (Is it expired?)".format(key_name))
         return data
 
+    def delete_data(self, file_name):
+        self.conn.delete(self.get_key_name(file_name))
+
+
+    def compare_and_swap_manifest(self, expected_token, manifest):
+        # Uses WATCH/MULTI so the swap fails if someone else touches the key in between.
+        import redis
+        key_name = self.get_key_name(self.manifest_filename)
+        with self.conn.pipeline() as pipe:
+            try:
+                pipe.watch(key_name)
+                data = pipe.get(key_name)
+                current = jsonloads(data, self.manifest_filename) if data else None
+                current_token = current['version_token'] if current else None
+                if current_token != expected_token:
+                    return False
+                pipe.multi()
+                pipe.set(key_name, json.dumps(manifest, indent=4, sort_keys=True))
+                pipe.execute()
+            except redis.WatchError:
+                return False
+        return True
 
     def get_url(self):
         return "redis://{}:{}/{}?prefix={}".format(self.host, self.port, self.db, self.prefix)
@@ -158,7 +383,13 @@ class FileBackend(Backend):
 
     __scheme__ = 'file'
 
-    def __init__(self, folder_name):
+    # Process wide caches of file content and of loaded table stores, validated against
+    # the stat signature of the files. See load_data() and load_table_store().
+    # Key is path, value is tuple of signature and data.
+    _read_cache = LRUCache(1024, max_weight=READ_CACHE_MAX_BYTES, weigh=lambda value: len(value[1]))
+    _table_store_cache = LRUCache(16)  # Key is folder name, value is dict with 'signatures' and 'blob'.
+
+    def __init__(self, folder_name, fsync=False):
         if '~' in folder_name:
             # Expand user and trim whatever was in front of the ~ char.
             folder_name = os.path.expanduser('~') + folder_name.split('~', 1)[1]
@@ -168,13 +399,17 @@ class FileBackend(Backend):
         if not os.path.exists(folder_name):
             os.makedirs(folder_name)
         self.folder_name = folder_name
+        self.fsync = fsync
+        self._pending = None  # List of (temp path, path) tuples while saving with fsync.
+        self._signatures = None  # Dict of path and stat signature while loading a table store.
 
     @classmethod
     def create_from_url_parts(cls, parts, query):
         # combine host and path into one
         path = parts.netloc or ''  # Change None to '' if needed.
         path += parts.path
-        return cls(folder_name=path)
+        fsync = query.get('fsync', ['0'])[0] in ('1', 'true')
+        return cls(folder_name=path, fsync=fsync)
 
     def get_url(self):
         path = self.folder_name
@@ -189,7 +424,28 @@ class FileBackend(Backend):
         file_name = file_name.replace('/', os.sep)  # Adjust to Windows platform mainly
         return os.path.join(self.folder_name, file_name)
 
+    def start_saving(self):
+        # With fsync on, files are renamed into place in done_saving() so all of them can
+        # be flushed to disk together.
+        if self.fsync:
+            self._pending = []
+
+    def done_saving(self):
+        pending, self._pending = self._pending, None
+        if pending:
+            for temp_name, path_name in pending:
+                _fsync_file(temp_name)
+            for temp_name, path_name in pending:
+                _rename(temp_name, path_name)
+            for dir_name in set(os.path.dirname(path_name) for temp_name, path_name in pending):
+                _fsync_dir(dir_name)
+
     def save_data(self, file_name, data):
+        self.save_stream(file_name, [data])
+
+    def save_stream(self, file_name, chunks):
+        # The data is written to a temporary file which is renamed to the target file name,
+        # so readers never see a partially written file.
         path_name = self.get_filename(file_name)
 
         # Create subdirs if neccessary
@@ -197,15 +453,171 @@ class FileBackend(Backend):
         if not os.path.exists(dir_name):
             os.makedirs(dir_name)
 
-        with open(path_name, 'w') as f:
-            log.debug("Writing %s bytes to %s", len(data), path_name)
-            f.write(data)
+        temp_name = os.path.join(dir_name, '.{}.{}.tmp'.format(os.path.basename(path_name), os.urandom(16).encode('hex')))
+        fd = os.open(temp_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0666)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                log.debug("Wrote %s bytes to %s", f.tell(), path_name)
+                if self.fsync and self._pending is None:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except Exception:
+            os.remove(temp_name)
+            raise
+
+        if self._pending is not None:
+            self._pending.append((temp_name, path_name))
+        else:
+            _rename(temp_name, path_name)
+            if self.fsync:
+                _fsync_dir(dir_name)
 
     def load_data(self, file_name):
+        # The content is cached and only read again if the file has changed.
         path_name = self.get_filename(file_name)
+        signature = _stat_signature_or_none(path_name)
+        if self._signatures is not None:
+            self._signatures[path_name] = signature
+
+        cached = self._read_cache.get(path_name)
+        if signature is not None and cached and cached[0] == signature:
+            return cached[1]
+
         log.debug("Reading from %s", path_name)
-        with open(path_name, 'r') as f:
-            return f.read()
+        with open(path_name, 'rb') as f:
+            data = f.read()
+        if signature is not None:
+            self._read_cache[path_name] = (signature, data)
+        return data
+
+    def load_stream(self, file_name):
+        # Large files are read in chunks and not kept in the read cache.
+        path_name = self.get_filename(file_name)
+        signature = _stat_signature_or_none(path_name)
+        if signature is None or signature[1] <= STREAM_CHUNK_SIZE:
+            return iter([self.load_data(file_name)])
+
+        if self._signatures is not None:
+            self._signatures[path_name] = signature
+        log.debug("Streaming from %s", path_name)
+        return _iter_file(open(path_name, 'rb'), STREAM_CHUNK_SIZE)
+
+    def delete_data(self, file_name):
+        path_name = self.get_filename(file_name)
+        try:
+            os.remove(path_name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._read_cache.pop(path_name)
+
+    def get_etag(self, file_name):
+        # The stat signature changes whenever the file is replaced or changed in place. It's
+        # noted while loading a table store, as the etag can decide what gets loaded.
+        path_name = self.get_filename(file_name)
+        signature = _stat_signature_or_none(path_name)
+        if self._signatures is not None:
+            self._signatures[path_name] = signature
+        if signature is None:
+            return None
+        return '{}:{}'.format(path_name, ':'.join(str(v) for v in signature))
+
+    def load_table_store(self):
+        """
+        Load the table store, or return a copy of the one loaded previously if none of
+        the files it was loaded from have changed. The copy is made from an in-memory
+        pickle, which is much faster than parsing and checking json files.
+        """
+        cached = self._table_store_cache.get(self.folder_name)
+        if cached and all(_stat_signature_or_none(path_name) == signature
+                          for path_name, signature in cached['signatures'].items()):
+            return pickle.loads(cached['blob'])
+
+        self._signatures = {}
+        try:
+            ts = super(FileBackend, self).load_table_store()
+            signatures = self._signatures
+        finally:
+            self._signatures = None
+        self._table_store_cache[self.folder_name] = {
+            'signatures': signatures,
+            'blob': pickle.dumps(ts, pickle.HIGHEST_PROTOCOL),
+        }
+        # Drop files of the previous load which are no longer part of the table store,
+        # such as the files of an old version folder.
+        if cached:
+            for path_name in set(cached['signatures']) - set(signatures):
+                self._read_cache.pop(path_name)
+        return ts
+
+    lock_timeout = 10.0  # Seconds to wait for the manifest lock.
+
+    def compare_and_swap_manifest(self, expected_token, manifest):
+        # Serialize the swap across processes using an exclusively created lock file.
+        lock_name = self.get_filename(self.manifest_filename + '.lock')
+        deadline = time.time() + self.lock_timeout
+        while True:
+            try:
+                fd = os.open(lock_name, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                if time.time() > deadline:
+                    raise BackendError(
+                        "Timed out waiting for lock '{}'. Remove it if it's stale.".format(lock_name))
+                time.sleep(0.05)
+
+        try:
+            os.close(fd)
+            return super(FileBackend, self).compare_and_swap_manifest(expected_token, manifest)
+        finally:
+            os.remove(lock_name)
+
+
+def _stat_signature(path_name):
+    # The inode changes on every save as files are replaced, and mtime and size catch
+    # changes made in place by others.
+    st = os.stat(path_name)
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+def _stat_signature_or_none(path_name):
+    try:
+        return _stat_signature(path_name)
+    except OSError:
+        return None
+
+
+def _iter_file(f, chunk_size):
+    with f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+def _rename(temp_name, path_name):
+    if os.name == 'nt' and os.path.exists(path_name):
+        os.remove(path_name)  # Rename doesn't overwrite on Windows.
+    os.rename(temp_name, path_name)
+
+
+def _fsync_file(path_name):
+    fd = os.open(path_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(dir_name):
+    # Flush the directory entry of renamed files. Not supported on Windows.
+    if os.name != 'nt':
+        _fsync_file(dir_name)
 
 
 @register
@@ -237,6 +649,9 @@ class MemoryBackend(Backend):
     def load_data(self, file_name):
         return MemoryBackend.archive[self.folder_name][file_name]
 
+    def delete_data(self, file_name):
+        MemoryBackend.archive[self.folder_name].pop(file_name, None)
+
 
 class ZipEncoded(Backend):
     """Aggregate class which serializes to and from a single zip file."""
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+'''
+Drift Config Benchmarks
+
+Times the core table store operations on synthetic domains of growing size, made with
+testhelpers.create_test_domain(), and writes out the results as json:
+
+    python -m driftconfig.benchmark --sizes 1,2,4 --repeat 5 --output results.json
+
+To catch regressions, compare against the results of a previous run:
+
+    python -m driftconfig.benchmark --compare results.json
+
+The exit code is 1 if any benchmark got slower than the threshold allows.
+'''
+import argparse
+import collections
+import json
+import logging
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+from datetime import datetime
+
+import driftconfig
+from driftconfig.relib import create_backend, copy_table_store
+from driftconfig.testhelpers import create_test_domain
+from driftconfig.util import get_drift_config, set_sticky_config
+
+log = logging.getLogger(__name__)
+
+
+DEFAULT_SIZES = [1, 2, 4, 8]
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 1.25  # Ratio of current to baseline time that counts as a regression.
+
+# Key is benchmark name, value is a tuple of (function, number).
+BENCHMARKS = collections.OrderedDict()
+
+
+def benchmark(number=1):
+    """
+    Register a benchmark function. The function is called with a table store and a
+    scratch folder name and returns the callable which is timed. The callable is
+    called 'number' times per repetition. Any setup done in the benchmark function
+    itself is not timed.
+    """
+    def decorator(fn):
+        BENCHMARKS[fn.__name__] = (fn, number)
+        return fn
+    return decorator
+
+
+def get_config_size(size):
+    """Returns 'config_size' for testhelpers.create_test_domain() scaled by 'size'."""
+    return {
+        'num_org': size,
+        'num_tiers': 2,
+        'num_deployables': 2,
+        'num_products': 2,
+        'num_tenants': 2,
+    }
+
+
+def _any_tenant(ts):
+    return ts.get_table('tenants').find()[0]
+
+
+@benchmark()
+def add(ts, folder):
+    ts = copy_table_store(ts)
+    organizations = ts.get_table('organizations')
+
+    def run():
+        for i in xrange(100):
+            organizations.add({
+                'organization_name': 'benchorg{}'.format(i),
+                'short_name': 'benchorg{}'.format(i),
+                'display_name': 'Benchmark Organization',
+            })
+    return run
+
+
+@benchmark(number=100)
+def find(ts, folder):
+    tenants = ts.get_table('tenants')
+    tier_name = _any_tenant(ts)['tier_name']
+    return lambda: tenants.find({'tier_name': tier_name, 'state': 'active'})
+
+
+@benchmark(number=1000)
+def get(ts, folder):
+    tenants = ts.get_table('tenants')
+    tenant = _any_tenant(ts)
+    primary_key = {k: tenant[k] for k in ('tier_name', 'deployable_name', 'tenant_name')}
+    return lambda: tenants.get(primary_key)
+
+
+@benchmark(number=1000)
+def get_foreign_row(ts, folder):
+    tenants = ts.get_table('tenants')
+    tenant = _any_tenant(ts)
+    return lambda: tenants.get_foreign_row(tenant, 'tenant-names')
+
+
+@benchmark()
+def check_integrity(ts, folder):
+    return ts.check_integrity
+
+
+def _save(url, file_format):
+    def benchmark_fn(ts, folder):
+        backend = create_backend(url.format(folder=folder))
+        return lambda: backend.save_table_store(ts, file_format=file_format)
+    return benchmark_fn
+
+
+def _load(url, file_format):
+    def benchmark_fn(ts, folder):
+        backend = create_backend(url.format(folder=folder))
+        backend.save_table_store(ts, file_format=file_format)
+        return backend.load_table_store
+    return benchmark_fn
+
+
+for _name, _url in [('memory', 'memory:///benchmark/{format}'), ('file', 'file://{{folder}}/{format}')]:
+    for _format in ['json', 'pickle']:
+        _format_url = _url.format(format=_format)
+        BENCHMARKS['save_{}_{}'.format(_format, _name)] = (_save(_format_url, _format), 1)
+        BENCHMARKS['load_{}_{}'.format(_format, _name)] = (_load(_format_url, _format), 1)
+
+
+@benchmark()
+def copy(ts, folder):
+    return lambda: copy_table_store(ts)
+
+
+@benchmark()
+def refresh_metadata(ts, folder):
+    return ts.refresh_metadata
+
+
+@benchmark(number=100)
+def drift_config(ts, folder):
+    tenant = _any_tenant(ts)
+
+    def run():
+        # Time the lookup itself and not the resolution cache.
+        ts.invalidate_caches()
+        return get_drift_config(
+            ts=ts,
+            tenant_name=tenant['tenant_name'],
+            tier_name=tenant['tier_name'],
+            deployable_name=tenant['deployable_name'],
+        )
+    return run
+
+
+def count_rows(ts):
+    return sum(len(table.find()) for table in ts.tables.values())
+
+
+def run_benchmarks(sizes=None, repeat=None, names=None):
+    """
+    Run benchmarks on domains of each size in 'sizes'. Each benchmark is repeated 'repeat'
+    times. If 'names' is set, only those benchmarks are run.
+
+    Returns a dict with information on the environment and 'results' as a list of dicts,
+    one for each benchmark and size, with 'name', 'size', 'rows', 'repeat', 'number' and
+    'min', 'mean' and 'max' as seconds per call.
+    """
+    sizes = sizes or DEFAULT_SIZES
+    repeat = repeat or DEFAULT_REPEAT
+    names = names or BENCHMARKS.keys()
+
+    results = []
+    for size in sizes:
+        ts = create_test_domain(config_size=get_config_size(size), resource_attributes={})
+        set_sticky_config(None)
+        rows = count_rows(ts)
+        for name in names:
+            fn, number = BENCHMARKS[name]
+            timings = []
+            for i in xrange(repeat):
+                folder = tempfile.mkdtemp(prefix='driftconfig-benchmark-')
+                run = None
+                try:
+                    run = fn(ts, folder)
+                    timings.append(timeit.timeit(run, number=number) / number)
+                finally:
+                    del run  # Memory backends are released when they go out of scope.
+                    shutil.rmtree(folder)
+
+            log.info("%s size=%s: %.6f sec", name, size, min(timings))
+            results.append({
+                'name': name,
+                'size': size,
+                'rows': rows,
+                'repeat': repeat,
+                'number': number,
+                'min': min(timings),
+                'mean': sum(timings) / len(timings),
+                'max': max(timings),
+            })
+
+    return {
+        'driftconfig_version': driftconfig.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'results': results,
+    }
+
+
+def compare_results(baseline, current, threshold=None):
+    """
+    Compare benchmark results 'current' to 'baseline', both as returned from run_benchmarks().
+    Returns a list of dicts with 'name', 'size', 'baseline', 'current' and 'ratio' for each
+    benchmark where the ratio of the best times exceeds 'threshold'.
+    """
+    threshold = threshold or DEFAULT_THRESHOLD
+    baseline_times = {(r['name'], r['size']): r['min'] for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        baseline_time = baseline_times.get((result['name'], result['size']))
+        if not baseline_time:
+            continue
+        ratio = result['min'] / baseline_time
+        if ratio > threshold:
+            regressions.append({
+                'name': result['name'],
+                'size': result['size'],
+                'baseline': baseline_time,
+                'current': result['min'],
+                'ratio': ratio,
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run Drift Config benchmarks.")
+    parser.add_argument(
+        '--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+        help="Comma separated list of domain sizes. Default is %(default)s."
+    )
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Number of repetitions.")
+    parser.add_argument(
+        '--only', action='append', choices=BENCHMARKS.keys(), help="Run only this benchmark. Can be repeated."
+    )
+    parser.add_argument('--output', help="Write results to this file instead of stdout.")
+    parser.add_argument('--compare', help="Compare results to a previous run in this file.")
+    parser.add_argument(
+        '--threshold', type=float, default=DEFAULT_THRESHOLD,
+        help="Slowdown ratio which counts as a regression. Default is %(default)s."
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    results = run_benchmarks(sizes=sizes, repeat=args.repeat, names=args.only)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        results['regressions'] = compare_results(baseline, results, threshold=args.threshold)
+
+    text = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print text
+
+    if results.get('regressions'):
+        for regression in results['regressions']:
+            sys.stderr.write("Regression in {name} size={size}: {ratio:.2f}x slower\n".format(**regression))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
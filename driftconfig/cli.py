@@ -2,24 +2,16 @@
 import os
 import os.path
 import sys
+import copy
 from datetime import datetime, timedelta
 import time
 import json
 import logging
 import subprocess
 
-# pygments is optional for now
-try:
-    got_pygments = True
-    from pygments import highlight
-    from pygments.lexers import get_lexer_by_name
-    from pygments.formatters import get_formatter_by_name
-except ImportError:
-    got_pygments = False
-
-from driftconfig.relib import create_backend, get_store_from_url, diff_meta, diff_tables, CHECK_INTEGRITY, copy_table_store
+from driftconfig.relib import create_backend, get_store_from_url, diff_meta, diff_table_store, CHECK_INTEGRITY, copy_table_store, Snapshot
 from driftconfig.config import get_drift_table_store, push_to_origin, pull_from_origin, TSTransaction, TSLocal
-from driftconfig.config import update_cache
+from driftconfig.config import update_caches
 from driftconfig.backends import FileBackend
 from driftconfig.util import (
     config_dir, get_domains, get_default_drift_config, get_default_drift_config_and_source,
@@ -27,11 +19,29 @@ from driftconfig.util import (
     get_tier_resource_modules, register_tier_defaults, register_this_deployable_on_tier,
     register_this_deployable
 )
-from driftconfig import testhelpers
+from driftconfig.profiling import Profiler
 
 log = logging.getLogger(__name__)
 
 
+# pygments is optional for now. It's slow to import so it's imported on first use.
+_pygments = None
+
+
+def got_pygments():
+    """Returns True if pygments is available."""
+    global _pygments
+    if _pygments is None:
+        try:
+            from pygments import highlight
+            from pygments.lexers import get_lexer_by_name
+            from pygments.formatters import get_formatter_by_name
+            _pygments = highlight, get_lexer_by_name, get_formatter_by_name
+        except ImportError:
+            _pygments = False
+    return bool(_pygments)
+
+
 # Enable simple in-line color and styling of output
 try:
     from colorama.ansi import Fore, Back, Style
@@ -117,6 +127,10 @@ def get_options(parser):
         '-t', '--tier',
         help="The tier on which to update cache, or all if ommitted."
     )
+    p.add_argument(
+        '--timeout', type=float, default=10.0,
+        help="Seconds to wait for the caches to update. Default is %(default)s."
+    )
 
     # 'migrate' command
     p = subparsers.add_parser(
@@ -157,7 +171,7 @@ def get_options(parser):
     )
     p.add_argument(
         'dest_url',
-        action='store',
+        action='store', nargs='+', help="One or more destination urls."
     )
     p.add_argument(
         '-p', '--pickle',
@@ -326,9 +340,8 @@ def init_command(args):
 
 
 def _format_domain_info(domain_info):
-    domain = domain_info['table_store'].get_table('domain')
     return "{}: \"{}\" at '{}'. Origin: '{}'".format(
-        domain['domain_name'], domain['display_name'], domain_info['path'], domain['origin'])
+        domain_info['domain_name'], domain_info['display_name'], domain_info['path'], domain_info['origin'])
 
 
 def list_command(args):
@@ -388,22 +401,22 @@ def cache_command(args):
     print "Updating cache for '{}' - {}".format(
         ts.get_table('domain')['domain_name'], ts)
 
-    for tier in ts.get_table('tiers').find():
-        tier_name = tier['tier_name']
-        if args.tier and args.tier.upper() != tier_name:
-            continue
-        click.secho("{}: ".format(tier_name), nl=False, bold=True)
-        try:
-            b = update_cache(ts, tier_name)
-        except Exception as e:
-            if "Timeout" not in str(e):
-                raise
-            click.secho("Updating failed. VPN down? {}".format(e), fg='red', bold=True)
+    tier_names = [tier['tier_name'] for tier in ts.get_table('tiers').find()]
+    if args.tier:
+        tier_names = [tier_name for tier_name in tier_names if tier_name == args.tier.upper()]
+
+    # All the caches are updated at the same time.
+    for report in update_caches(ts, tier_names, timeout=args.timeout):
+        click.secho("{}: ".format(report['tier_name']), nl=False, bold=True)
+        if report['no_cache']:
+            click.secho("No Redis resource defined for this tier.", fg='red', bold=True)
+        elif report['skipped']:
+            click.secho("Cache is up to date. Url: {}".format(report['url']))
+        elif report['ok']:
+            click.secho("Cache updated in {:.0f} ms, {} bytes. Url: {}".format(
+                report['seconds'] * 1000.0, report['bytes'], report['url']))
         else:
-            if b:
-                click.secho("Cache updated. Url: {}".format(b.get_url()))
-            else:
-                click.secho("No Redis resource defined for this tier.", fg='red', bold=True)
+            click.secho("Updating failed. VPN down? {}".format(report['error']), fg='red', bold=True)
 
     '''
     # bench test:
@@ -480,14 +493,18 @@ def push_command(args):
 
 
 def copy_command(args):
-    print "Copy '%s' to '%s'" % (args.source_url, args.dest_url)
+    print "Copy '%s' to '%s'" % (args.source_url, "', '".join(args.dest_url))
     if args.source_url == '.':
         ts = get_default_drift_config()
     else:
         ts = get_store_from_url(args.source_url)
-    b = create_backend(args.dest_url)
-    b.default_format = 'pickle' if args.pickle else 'json'
-    b.save_table_store(ts)
+    # The table store is encoded once and written to each destination.
+    snapshot = Snapshot(ts, file_format='pickle' if args.pickle else 'json')
+    for dest_url in args.dest_url:
+        if create_backend(dest_url).save_snapshot(snapshot):
+            print "Copied to '{}': {}".format(dest_url, snapshot)
+        else:
+            print "'{}' is already up to date.".format(dest_url)
     print "Done."
 
 
@@ -552,8 +569,7 @@ def diff_command(args):
     # Get origin table store meta info
     origin = local_ts.get_table('domain')['origin']
     origin_backend = create_backend(origin)
-    origin_ts = origin_backend.load_table_store()
-    origin_meta = origin_ts.meta.get()
+    origin_meta = origin_backend.load_meta()
 
     local_diff = ("Local store and scratch", local_m1, local_m2, False)
     origin_diff = ("Local and origin", origin_meta, local_m2, args.details)
@@ -574,12 +590,10 @@ def diff_command(args):
             print "\tModified tables:", diff['modified_tables']
 
             if details:
-                # Diff origin
-                origin_ts = get_store_from_url(origin)
-                for table_name in diff['modified_tables']:
-                    t1 = local_ts.get_table(table_name)
-                    t2 = origin_ts.get_table(table_name)
-                    tablediff = diff_tables(t1, t2)
+                # Diff origin, fetching only the files that differ.
+                store_diff = diff_table_store(local_ts, origin_backend)
+                for table_name in sorted(store_diff['tables']):
+                    tablediff = store_diff['tables'][table_name]
                     print "\nTable diff for", table_name, "\n(first=local, second=origin):"
                     print json.dumps(tablediff, indent=4, sort_keys=True)
 
@@ -867,15 +881,18 @@ def assign_tier_command(args):
 
 
 def _diff_ts(ts1, ts2):
-    from driftconfig.relib import diff_meta, diff_tables
+    from driftconfig.relib import diff_meta, diff_table_store, DictBackend
     # Get local table store and its meta state
 
     ts1 = copy_table_store(ts1)
-    ts2 = copy_table_store(ts2)
     local_m1, local_m2 = ts1.refresh_metadata()
 
-    # Get origin table store meta info
-    origin_meta = ts2.meta.get()
+    # Get origin table store meta info. Origin is serialized in json format so the
+    # detailed diff only needs to look at row groups that differ. Saving refreshes the
+    # meta data of the table store, so a copy is saved to leave 'ts2' untouched.
+    origin_backend = DictBackend()
+    origin_backend.save_table_store(copy.deepcopy(ts2))
+    origin_meta = origin_backend.load_meta()
 
     title = "Local and origin"
     m1, m2 = origin_meta, local_m2
@@ -900,10 +917,9 @@ def _diff_ts(ts1, ts2):
             print "To get detailed diff do {s.BRIGHT}pip install jsondiff{s.NORMAL}".format(**styles)
         else:
             # Diff origin
-            for table_name in diff['modified_tables']:
-                t1 = ts1.get_table(table_name)
-                t2 = ts2.get_table(table_name)
-                tablediff = diff_tables(t1, t2)
+            store_diff = diff_table_store(ts1, origin_backend)
+            for table_name in sorted(store_diff['tables']):
+                tablediff = store_diff['tables'][table_name]
                 print "\nTable diff for {s.BRIGHT}{}{s.NORMAL}".format(table_name, **styles)
 
                 for modified_row in tablediff['modified_rows']:
@@ -924,6 +940,8 @@ def main(as_module=False):
     parser.add_argument('--loglevel', default='WARNING')
     parser.add_argument('--nocheck', action='store_true', help="Skip all relational integrity and schema checks.")
     parser.add_argument('--user-dir', action='store_true', help="Choose user directory over site for locally stored configs.")
+    parser.add_argument('--profile', action='store_true', help="Profile the command and print a summary.")
+    parser.add_argument('--profile-output', metavar='FILE', help="Profile the command and write cProfile data to FILE.")
     get_options(parser)
     args = parser.parse_args()
 
@@ -935,7 +953,16 @@ def main(as_module=False):
         del driftconfig.relib.CHECK_INTEGRITY[:]
 
     fn = globals()["{}_command".format(args.command.replace("-", "_"))]
-    fn(args)
+    if args.profile or args.profile_output:
+        profiler = Profiler(output=args.profile_output)
+        profiler.start()
+        try:
+            fn(args)
+        finally:
+            profiler.stop()
+            profiler.report()
+    else:
+        fn(args)
 
 
 if __name__ == '__main__':
@@ -974,12 +1001,25 @@ pass_repo = click.make_pass_decorator(Globals)
     help='Specify organization name/short name.')
 @click.option('--product', '-p', is_flag=True,
     help='Specify product name.')
+@click.option('--profile', is_flag=True,
+    help='Profile the command and print a summary.')
+@click.option('--profile-output', metavar='FILE',
+    help='Profile the command and write cProfile data to FILE.')
 @click.version_option('1.0')
 @click.pass_context
-def cli(ctx, config_url, verbose, organization, product):
+def cli(ctx, config_url, verbose, organization, product, profile, profile_output):
     """This command line tool helps you manage and maintain Drift
     Configuration databases.
     """
+    if profile or profile_output:
+        profiler = Profiler(output=profile_output)
+        profiler.start()
+
+        def report():
+            profiler.stop()
+            profiler.report()
+        ctx.call_on_close(report)
+
     ctx.obj = Globals()
     ctx.obj.config_url = config_url
     if config_url:
@@ -1004,11 +1044,11 @@ def configs():
             "to remedy.")
     else:
         ts, source = get_default_drift_config_and_source()
+        default_domain_name = ts.get_table('domain')['domain_name']
         got_default = False
 
-        for domain_info in domains.values():
-            domain = domain_info['table_store'].get_table('domain')
-            is_default = domain['domain_name'] == ts.get_table('domain')['domain_name']
+        for domain in domains.values():
+            is_default = domain['domain_name'] == default_domain_name
             if is_default:
                 click.secho(domain['domain_name'] + " [DEFAULT]:", bold=True, nl=False)
                 got_default = True
@@ -1017,7 +1057,7 @@ def configs():
 
             click.secho(" \"{}\"".format(domain['display_name']), fg='green')
             click.secho("\tOrigin: " + domain['origin'])
-            click.secho("\tLocal: " + domain_info['path'])
+            click.secho("\tLocal: " + domain['path'])
             click.secho("")
 
         if got_default:
@@ -1159,6 +1199,7 @@ def developer(recreate, user, run):
                 fg='yellow'
                 )
 
+        from driftconfig import testhelpers
         testhelpers.DOMAIN_NAME = domain_name
         testhelpers.ORG_NAME = 'localorg'
         testhelpers.TIER_NAME = tier_name
@@ -1259,8 +1300,9 @@ def developer(recreate, user, run):
     )
 
     # Define an alias for the developer tenant so it less cumbersome than the actual name.
-    result['tenant_master_row']['alias'] = tenant_name
-    tenant_name = result['tenant_master_row']['tenant_name']  # The actual tenant name
+    tenant_master_row = dict(result['tenant_master_row'], alias=tenant_name)
+    ts.get_table('tenant-names').update(tenant_master_row)
+    tenant_name = tenant_master_row['tenant_name']  # The actual tenant name
 
     # Provision all resources for the tenant for all deployables
     report = provision_tenant_resources(
@@ -1294,7 +1336,7 @@ def developer(recreate, user, run):
         )
     click.secho(pretty(sh, lexer='bash'))
 
-    if not got_pygments:
+    if not got_pygments():
         click.secho("\n\nFinal Note! All the blurb above would look much better with colors!.\n"
             "Plese Run the following command for the sake of rainbows and unicorns:\n"
             "pip install pygments\n\n"
@@ -1622,7 +1664,8 @@ def pretty(ob, lexer=None):
     if lexer == 'json':
         ob = json.dumps(ob, indent=4, sort_keys=True)
 
-    if got_pygments:
+    if got_pygments():
+        highlight, get_lexer_by_name, get_formatter_by_name = _pygments
         lexerob = get_lexer_by_name(lexer)
         formatter = get_formatter_by_name(PRETTY_FORMATTER, style=PRETTY_STYLE)
         #from pygments.filters import *
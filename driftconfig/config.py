@@ -359,9 +359,11 @@ aws commands extend service/deployable:
 
 '''
 import logging
+import threading
+import time
 from datetime import datetime
 
-from driftconfig.relib import TableStore, copy_table_store, create_backend
+from driftconfig.relib import TableStore, copy_table_store, create_backend, make_manifest, get_table_folders, Snapshot
 import driftconfig.relib
 from driftconfig.util import get_default_drift_config_and_source
 from driftconfig.backends import RedisBackend
@@ -384,9 +386,37 @@ directivegames-borkbork
 '''
 
 
+# The definition of the Core Drift tables and its fingerprint, built on first use.
+_drift_definition = None
+_drift_fingerprint = None
+_drift_definition_lock = threading.Lock()
+
+
 def get_drift_table_store():
     """
     Create a Data Store which contains all Core Drift tables.
+
+    The tables are only built once per process. Each call returns a new table store
+    cloned from the cached definition.
+    """
+    global _drift_definition, _drift_fingerprint
+    if _drift_definition is None:
+        with _drift_definition_lock:
+            if _drift_definition is None:
+                ts = _build_drift_table_store()
+                _drift_fingerprint = ts.get_definition_fingerprint()
+                _drift_definition = ts.get_definition()
+
+    ts = TableStore()
+    if not ts.init_from_fingerprint(_drift_fingerprint):
+        ts.init_from_definition(_drift_definition)
+    return ts
+
+
+def _build_drift_table_store():
+    """
+    Build the Core Drift tables from scratch. This is relatively slow, use
+    get_drift_table_store() instead.
     """
 
     # RULE: pk='tier_name'='LIVENORTH', role['liveops', 'admin', 'service']
@@ -960,13 +990,10 @@ def get_drift_table_store():
 
     # END OF TABLE DEFS
 
-    definition = ts.get_definition()
-    new_ts = TableStore()
-    new_ts.init_from_definition(definition)
-    return new_ts
+    return ts
 
 
-def push_to_origin(local_ts, force=False, _first=False, _origin_crc=None):
+def push_to_origin(local_ts, force=False, _first=False, _origin_crc=None, _version_token=None):
     """
     Pushed 'local_ts' to origin.
     Returns a dict with 'pushed' as True or False depending on success.
@@ -991,11 +1018,25 @@ def push_to_origin(local_ts, force=False, _first=False, _origin_crc=None):
     store is pushed.
 
     '_origin_crc' is the original and expected origin crc.
+
+    '_version_token' is the version token of the origin manifest at the time
+    'local_ts' was pulled. If set, the origin is not downloaded. Instead the
+    modified tables are uploaded to a new version folder and the manifest is
+    swapped conditionally to point to it. If the origin has changed since, the
+    return value contains 'reason' = 'version_conflict'. Note that in pickle
+    format, the default for S3, the whole table store is uploaded.
+
+    Either way the table store at the root of the origin is kept up to date for
+    clients which don't read the manifest, and version folders which are no
+    longer in use are deleted.
     """
     origin = local_ts.get_table('domain')['origin']
     origin_backend = create_backend(origin)
     origin_ts = None
 
+    if _version_token is not None and not _first and not force:
+        return _push_with_version_token(local_ts, origin_backend, _version_token)
+
     if _first:
         crc_match = force = True
     else:
@@ -1027,15 +1068,125 @@ def push_to_origin(local_ts, force=False, _first=False, _origin_crc=None):
     if crc_match and old == new and not force:
         return {'pushed': True, 'reason': 'push_skipped_crc_match'}
 
+    origin_manifest = origin_backend.load_manifest() or {}
+    _save_to_origin(local_ts, origin_backend)
+    journal_head = _save_journal_to_origin(local_ts, origin_backend, origin_manifest)
+
+    # The table store is saved at the root, so the version folders are no longer used,
+    # but the last one is kept for clients which may still be reading it.
+    folder = origin_manifest.get('folder')
+    origin_backend.save_manifest(make_manifest(
+        local_ts, journal_head, previous_folder=folder, root_etag=origin_backend.get_root_etag()))
+    local_ts.reset_journal()  # Changes that have been pushed are not pushed again.
+    if origin_manifest.get('previous_folder') and origin_ts is not None:
+        in_use = get_table_folders(origin_ts.meta.get(), folder) if folder else {}
+        origin_backend.delete_version(local_ts, origin_manifest['previous_folder'], [in_use])
+
+    return {'pushed': True, 'reason': 'pushed_to_origin'}
+
+
+def _push_with_version_token(local_ts, origin_backend, version_token):
+    """
+    Push 'local_ts' to 'origin_backend' if the origin manifest still has 'version_token'.
+    See push_to_origin() for details.
+    """
+    old, new = local_ts.refresh_metadata()
+    if old == new:
+        return {'pushed': True, 'reason': 'push_skipped_crc_match'}
+
+    def version_conflict(origin_manifest):
+        return {
+            'pushed': False,
+            'reason': 'version_conflict',
+            'local_meta': local_ts.meta.get(),
+            'origin_manifest': origin_manifest,
+            'expected_token': version_token,
+        }
+
+    # The version token doesn't cover changes made at the root by clients which don't
+    # read the manifest, so those are checked for separately.
+    origin_manifest = origin_backend.load_manifest()
+    if not origin_manifest or origin_manifest['version_token'] != version_token:
+        return version_conflict(origin_manifest)
+    if not origin_backend.is_manifest_current(origin_manifest):
+        return version_conflict(origin_manifest)
+
+    old_md5 = {table_meta['table_name']: table_meta['md5'] for table_meta in old['tables']}
+    table_names = [
+        table_meta['table_name']
+        for table_meta in new['tables']
+        if old_md5.get(table_meta['table_name']) != table_meta['md5']
+    ]
+
+    # The new version is uploaded to a folder of its own, leaving the current version
+    # untouched. Only the modified tables are uploaded, the others are read from the
+    # folders of the versions they were last modified in, unless the current version is
+    # not kept in a version folder at all.
+    folder = driftconfig.relib.make_version_folder()
+    _save_to_origin(
+        local_ts, origin_backend,
+        table_names=table_names if origin_manifest.get('folder') else None,
+        folder=folder,
+    )
+    journal_head = _save_journal_to_origin(local_ts, origin_backend, origin_manifest)
+
+    # Publish the new version. If someone else got there first, the files uploaded
+    # above are simply never referenced.
+    origin_folder = origin_manifest.get('folder')
+    manifest = make_manifest(local_ts, journal_head, folder, previous_folder=origin_folder)
+    if not origin_backend.compare_and_swap_manifest(version_token, manifest):
+        return version_conflict(origin_backend.load_manifest())
+    local_ts.reset_journal()
+
+    _update_origin_root(local_ts, origin_backend, origin_manifest, manifest, table_names)
+
+    # The version before the one just replaced is no longer in use. The one just replaced
+    # is kept for clients which may still be reading it.
+    if origin_manifest.get('previous_folder'):
+        in_use = [
+            get_table_folders(old, origin_folder) if origin_folder else {},
+            get_table_folders(local_ts.meta.get(), folder),
+        ]
+        origin_backend.delete_version(local_ts, origin_manifest['previous_folder'], in_use)
+
+    return {'pushed': True, 'reason': 'pushed_to_origin', 'tables': table_names}
+
+
+def _update_origin_root(local_ts, origin_backend, origin_manifest, manifest, table_names):
+    # Save 'local_ts' at the root of the origin as well, for clients which don't read the
+    # manifest, and record the etag of the root in 'manifest' once it's up to date. Only
+    # the tables in 'table_names' are saved if the root was up to date with the version
+    # in 'origin_manifest', i.e. the root etag was recorded or there was no version folder.
+    if origin_backend.load_manifest() != manifest:
+        return  # A newer version has been published, which updates the root instead.
+
+    root_was_current = origin_manifest.get('root_etag') or not origin_manifest.get('folder')
+    _save_to_origin(local_ts, origin_backend, table_names=table_names if root_was_current else None)
+    root_etag = origin_backend.get_root_etag()
+    if root_etag:
+        origin_backend.compare_and_swap_manifest(manifest['version_token'], dict(manifest, root_etag=root_etag))
+
+
+def _save_to_origin(local_ts, origin_backend, table_names=None, folder=None):
     # Always turn on all integrity check when saving to origin
     tmp = driftconfig.relib.CHECK_INTEGRITY
     driftconfig.relib.CHECK_INTEGRITY = ['pk', 'fk', 'unique', 'schema', 'constraints']
     try:
-        origin_backend.save_table_store(local_ts)
+        # The manifest is written by the caller.
+        origin_backend.save_table_store(local_ts, table_names=table_names, folder=folder, update_manifest=False)
     finally:
         driftconfig.relib.CHECK_INTEGRITY = tmp
 
-    return {'pushed': True, 'reason': 'pushed_to_origin'}
+
+def _save_journal_to_origin(local_ts, origin_backend, origin_manifest):
+    # Save the journal of 'local_ts' as a segment following the journal head in
+    # 'origin_manifest'. Returns the journal head to publish in the new manifest. The
+    # meta data of 'local_ts' must be up to date.
+    journal_head = origin_manifest.get('journal_head') if origin_manifest else None
+    journal = local_ts.get_journal()
+    if journal:
+        journal_head = origin_backend.save_journal(journal, journal_head, checksum=local_ts.meta['checksum'])
+    return journal_head
 
 
 def pull_from_origin(local_ts, ignore_if_modified=False, force=False):
@@ -1054,7 +1205,10 @@ def pull_from_origin(local_ts, ignore_if_modified=False, force=False):
 
 
 def get_redis_cache_backend(ts, tier_name):
-    """Returns cache backend for tier 'tier_name' in 'ts'."""
+    """
+    Returns cache backend for tier 'tier_name' in 'ts', or None if the tier has no cache
+    nor Redis resource defined.
+    """
     # Note: drift.core.resources.redis module defines where to find default
     # connection information for a Redis server. We make good use of that here,
     # but it does mean that this piece of code below is now coupled with
@@ -1065,7 +1219,9 @@ def get_redis_cache_backend(ts, tier_name):
     if 'cache' in tier:
         b = create_backend(tier['cache'])
     else:
-        redis_info = tier['resources']['drift.core.resources.redis']
+        redis_info = tier.get('resources', {}).get('drift.core.resources.redis')
+        if not redis_info:
+            return None
         b = RedisBackend.create_from_server_info(
             host=redis_info['host'],
             port=redis_info['port'],
@@ -1084,6 +1240,67 @@ def update_cache(ts, tier_name):
     return b
 
 
+def update_caches(ts, tier_names=None, timeout=10.0):
+    """
+    Push table store 'ts' to the Redis caches of all tiers, or the ones in 'tier_names'.
+    The table store is pickled once and pushed to all the caches at the same time. Pushes
+    which don't finish within 'timeout' seconds are reported as failed, so a slow or
+    unreachable cache doesn't hold up the others. Caches which already hold the same
+    snapshot of the table store are skipped.
+
+    Returns a list of dicts, one for each tier, with 'tier_name', 'url' as the cache url
+    or None, 'ok', 'skipped', 'no_cache' as True if the tier has no cache defined, 'error'
+    as the error message or None, 'seconds' and 'bytes' as the number of bytes written.
+    """
+    if tier_names is None:
+        tier_names = [tier['tier_name'] for tier in ts.get_table('tiers').find()]
+
+    snapshot = Snapshot(ts)
+    reports = [
+        {
+            'tier_name': tier_name, 'url': None, 'ok': False, 'skipped': False, 'no_cache': False,
+            'error': None, 'seconds': None, 'bytes': 0,
+        }
+        for tier_name in tier_names
+    ]
+
+    def push(report):
+        start = time.time()
+        try:
+            b = get_redis_cache_backend(ts, report['tier_name'])
+            if b is None:
+                report['no_cache'] = True
+            else:
+                report['url'] = b.get_url()
+                if b.save_snapshot(snapshot):
+                    report['bytes'] = snapshot.size
+                else:
+                    report['skipped'] = True
+        except Exception as e:
+            report['error'] = str(e) or repr(e)
+        else:
+            report['ok'] = not report['no_cache']
+        report['seconds'] = time.time() - start
+
+    # The threads are daemons so the ones that time out don't keep the process alive.
+    threads = []
+    for report in reports:
+        thread = threading.Thread(target=push, args=(report,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    results = []
+    deadline = time.time() + timeout
+    for thread, report in zip(threads, reports):
+        thread.join(max(deadline - time.time(), 0.0))
+        if thread.is_alive():
+            report = dict(report, ok=False, error="Timed out after {} seconds.".format(timeout), seconds=timeout)
+        results.append(dict(report))
+
+    return results
+
+
 class TSTransactionError(RuntimeError):
     pass
 
@@ -1102,6 +1319,17 @@ class TSTransaction(object):
 
         self._semaphore = 1
         ts, self._url = get_default_drift_config_and_source()
+
+        # Note the origin version before pulling. If the origin has no manifest, or it's
+        # out of date, the commit falls back to comparing checksums with a full download
+        # of the origin.
+        origin_backend = create_backend(ts.get_table('domain')['origin'])
+        manifest = origin_backend.load_manifest()
+        if manifest and origin_backend.is_manifest_current(manifest):
+            self._version_token = manifest['version_token']
+        else:
+            self._version_token = None
+
         result = pull_from_origin(ts)
         if not result['pulled']:
             e = TSTransactionError("Can't pull latest table store: {}".format(result['reason']))
@@ -1110,6 +1338,8 @@ class TSTransaction(object):
         self._ts = result['table_store']
         self._origin_crc = self._ts.meta['checksum']
         self._ts._lock_meta = True
+        # Rows are edited in place within the transaction, so nothing must be cached.
+        self._ts.invalidate_caches()
 
         return self._ts
 
@@ -1121,24 +1351,96 @@ class TSTransaction(object):
             return False
 
         if self._commit_to_origin:
-            result = push_to_origin(self._ts, _origin_crc=self._origin_crc)
+            result = push_to_origin(
+                self._ts, _origin_crc=self._origin_crc, _version_token=self._version_token)
             if not result['pushed']:
                 e = TSTransactionError("Can't push to origin: {}".format(result))
                 e.result = result
                 raise e
 
         if self._write_to_scratch:
-            # Update cache if applicable
+            # Update cache if applicable. The table store is saved straight to the backend so
+            # large tables are streamed out as they are encoded.
             source_backend = create_backend(self._url)
             source_backend.save_table_store(self._ts)
 
 
+class TSBatch(object):
+    """
+    Accumulates many operations on the table store and commits them to origin in one
+    transaction, instead of pulling and pushing the table store for each one.
+
+    An operation is a function which takes the table store as its first argument, like
+    util.define_tenant() or util.provision_tenant_resources():
+
+        batch = TSBatch()
+        for tenant_name in tenant_names:
+            batch.add(define_tenant, tenant_name=tenant_name, product_name=..., tier_name=...)
+        result = batch.commit()
+
+    If an operation raises an exception, any changes it made are rolled back and the
+    remaining operations carry on. The integrity of the table store is checked once when
+    it's pushed to origin.
+
+    Rolling back an operation only reverts rows it got hold of through the Table API, see
+    TableStore.savepoint(). Changes made to rows reached through Table._rows, or through
+    results of util.get_drift_config() obtained before the operation ran, are not rolled
+    back.
+    """
+
+    def __init__(self, commit_to_origin=True, write_to_scratch=True):
+        self._commit_to_origin = commit_to_origin
+        self._write_to_scratch = write_to_scratch
+        self._operations = []
+
+    def add(self, fn, *args, **kw):
+        """Add operation 'fn' which is called with the table store, 'args' and 'kw'."""
+        self._operations.append((fn, args, kw))
+
+    def __len__(self):
+        return len(self._operations)
+
+    def commit(self):
+        """
+        Run all operations and commit the table store to origin.
+
+        Returns a dict with 'results' as a list of dicts, one for each operation, with
+        'index', 'ok', and either 'result' as the return value or 'error' as the exception.
+        Also returns 'ok_count' and 'error_count'.
+
+        Raises TSTransactionError if the table store can't be pulled or pushed.
+        """
+        results = []
+        with TSTransaction(commit_to_origin=self._commit_to_origin, write_to_scratch=self._write_to_scratch) as ts:
+            for index, (fn, args, kw) in enumerate(self._operations):
+                savepoint = ts.savepoint()
+                try:
+                    result = fn(ts, *args, **kw)
+                except Exception as e:
+                    log.warning("Batch operation %s, %s failed: %s", index, fn.__name__, repr(e))
+                    ts.rollback(savepoint)
+                    results.append({'index': index, 'ok': False, 'error': e})
+                else:
+                    ts.release(savepoint)
+                    results.append({'index': index, 'ok': True, 'result': result})
+
+        self._operations = []
+        ok_count = sum(1 for result in results if result['ok'])
+        return {
+            'results': results,
+            'ok_count': ok_count,
+            'error_count': len(results) - ok_count,
+        }
+
+
 class TSLocal(object):
     def __init__(self):
         self._ts = None
 
     def __enter__(self):
         self._ts, self._url = get_default_drift_config_and_source()
+        # Rows are edited in place, so nothing must be cached.
+        self._ts.invalidate_caches()
         return self._ts
 
     def __exit__(self, exc, value, traceback):
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+'''
+Instrumentation hooks
+
+Relib, the backends and the config helpers report timings and byte counts through
+this module. By default nothing is recorded and the hooks cost next to nothing. To
+collect the numbers, install a recorder:
+
+    from driftconfig import instrument
+
+    recorder = instrument.MemoryRecorder()
+    instrument.set_recorder(recorder)
+    ...
+    print recorder.report()
+
+To feed a statsd or Prometheus client, use CallbackRecorder or subclass Recorder.
+
+Metric names:
+
+    backend.load_data           Timer for loading a single file from a backend.
+    backend.load_data.bytes     Counter of bytes loaded from backends.
+    backend.save_data           Timer for saving a single file to a backend.
+    backend.save_data.bytes     Counter of bytes saved to backends.
+    relib.pickle_decode         Timer for unpickling a table store.
+    relib.json_decode           Timer for decoding a json file.
+    relib.json_decode.bytes     Counter of json bytes decoded.
+    relib.check_schema          Timer for the json schema check of a row.
+    relib.check_constraints     Timer for the constraint checks of a row.
+    util.get_drift_config       Timer for get_drift_config() calls.
+'''
+import collections
+import functools
+import threading
+import time
+
+
+class Recorder(object):
+    """Base class for recorders. Records nothing."""
+
+    def timing(self, name, seconds):
+        """Record that operation 'name' took 'seconds'."""
+
+    def incr(self, name, value=1):
+        """Increment counter 'name' by 'value'."""
+
+
+class MemoryRecorder(Recorder):
+    """Keeps counters and timer statistics in memory."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.defaultdict(int)
+            self.timers = {}
+
+    def timing(self, name, seconds):
+        with self._lock:
+            stats = self.timers.get(name)
+            if stats is None:
+                self.timers[name] = {'count': 1, 'total': seconds, 'min': seconds, 'max': seconds}
+            else:
+                stats['count'] += 1
+                stats['total'] += seconds
+                stats['min'] = min(stats['min'], seconds)
+                stats['max'] = max(stats['max'], seconds)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def report(self):
+        """
+        Returns a dict with 'counters' as a dict of counter values and 'timers' as a dict of
+        dicts with 'count', 'total', 'min', 'max' and 'mean' in seconds.
+        """
+        with self._lock:
+            timers = {}
+            for name, stats in self.timers.items():
+                timers[name] = dict(stats, mean=stats['total'] / stats['count'])
+            return {'counters': dict(self.counters), 'timers': timers}
+
+
+class CallbackRecorder(Recorder):
+    """
+    Forwards timings and counters to 'timing' and 'incr' callbacks, which have the same
+    signature as the Recorder methods.
+    """
+
+    def __init__(self, timing=None, incr=None):
+        self._timing = timing
+        self._incr = incr
+
+    def timing(self, name, seconds):
+        if self._timing:
+            self._timing(name, seconds)
+
+    def incr(self, name, value=1):
+        if self._incr:
+            self._incr(name, value)
+
+
+_recorder = None
+enabled = False  # Hot paths check this before doing any instrumentation work.
+
+
+def set_recorder(recorder):
+    """Install 'recorder', or pass None to turn off instrumentation. Returns the previous one."""
+    global _recorder, enabled
+    previous = _recorder
+    _recorder = recorder
+    enabled = recorder is not None
+    return previous
+
+
+def get_recorder():
+    """Returns the current recorder or None."""
+    return _recorder
+
+
+class _Timer(object):
+    __slots__ = ['name', 'start']
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        recorder = _recorder
+        if recorder is not None:
+            recorder.timing(self.name, time.time() - self.start)
+        return False
+
+
+class _NullTimer(object):
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc, value, traceback):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(name):
+    """Returns a context manager which records how long its block takes as 'name'."""
+    if enabled:
+        return _Timer(name)
+    return _null_timer
+
+
+def incr(name, value=1):
+    """Increment counter 'name' by 'value'."""
+    if enabled:
+        _recorder.incr(name, value)
+
+
+def timed(name):
+    """Decorator which records the time each call to the function takes as 'name'."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kw):
+            if not enabled:
+                return fn(*args, **kw)
+            with _Timer(name):
+                return fn(*args, **kw)
+        return wrapper
+    return decorator
+
+
+class recording(object):
+    """
+    Context manager which installs 'recorder' for the duration of the block. If no
+    recorder is given, a MemoryRecorder is used. The recorder is returned from __enter__.
+    """
+
+    def __init__(self, recorder=None):
+        self.recorder = recorder or MemoryRecorder()
+
+    def __enter__(self):
+        self._previous = set_recorder(self.recorder)
+        return self.recorder
+
+    def __exit__(self, exc, value, traceback):
+        set_recorder(self._previous)
+        return False
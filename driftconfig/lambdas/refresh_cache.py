@@ -5,8 +5,13 @@ AWS lambda functions to keep drift config cached in Redis.
 import os
 import os.path
 
-from driftconfig.relib import get_store_from_url
-from driftconfig.config import update_cache
+from driftconfig.relib import Backend, create_backend, get_store_from_url
+from driftconfig.config import get_redis_cache_backend, update_cache
+
+
+# Backends are kept between invocations of a warm lambda container so clients and
+# connections are reused and the cache location is only looked up once.
+_backends = {}
 
 
 def on_config_update(event, context):
@@ -14,13 +19,16 @@ def on_config_update(event, context):
     Process config update event
     """
 
-    # Get the uploaded file's information
-    key = event['Records'][0]['s3']['object']['key']
-    path, filename = os.path.split(key)
+    # An event may contain many uploads. They are coalesced into a single update as only
+    # the latest version of the table store matters.
+    # Versions pushed with a version token are published by writing the manifest.
+    keys = [record['s3']['object']['key'] for record in event['Records']]
+    trigger_names = [Backend.pickle_filename, Backend.manifest_filename]
+    pickle_keys = [key for key in keys if os.path.split(key)[1] in trigger_names]
 
-    if filename != 'table-store.pickle':
-        print "Drift config cache trigger ignoring file: ", key
-        print "Only 'table-store.pickle' files trigger cache updates."
+    if not pickle_keys:
+        print "Drift config cache trigger ignoring files: ", ", ".join(keys)
+        print "Only 'table-store.pickle' and 'manifest.json' files trigger cache updates."
     else:
         # We don't care if it's this config in particular that got pushed,
         # it's harmless to push the config to cache.
@@ -32,13 +40,69 @@ def do_update_cache(event, context):
     _push_to_cache(os.environ['S3_ORIGIN_URL'], os.environ['TIER_NAME'])
 
 
+def sync_cache(origin_backend, cache_backend):
+    """
+    Copy the pickled table store from 'origin_backend' to 'cache_backend' as is, without
+    decoding it. The ETag of the origin file is recorded in the cache manifest, and if
+    the cache already holds the current version, nothing is copied. The pickle is read
+    from the version folder named in the origin manifest, if any.
+
+    Returns a dict with 'updated' as True or False and 'reason'. If the origin is not in
+    pickle format, the reason is 'not_pickle' and the table store must be pushed to the
+    cache the slow way.
+    """
+    manifest = origin_backend.load_manifest() or {}
+    file_name = Backend.pickle_filename
+    if manifest.get('folder'):
+        file_name = manifest['folder'] + '/' + file_name
+
+    etag = origin_backend.get_etag(file_name)
+    if etag:
+        cache_manifest = cache_backend.load_manifest()
+        if cache_manifest and cache_manifest.get('source_etag') == etag:
+            return {'updated': False, 'reason': 'up_to_date'}
+
+    blob = origin_backend._load_data(file_name)
+    if not blob:
+        return {'updated': False, 'reason': 'not_pickle'}
+
+    # The pickle is kept at the root of the cache.
+    cache_backend.save_pickled_table_store(blob)
+    manifest.pop('folder', None)
+    cache_backend.save_manifest(dict(manifest, source_etag=etag))
+    return {'updated': True, 'reason': 'copied'}
+
+
+def _get_backends(origin, tier_name):
+    # Returns a tuple of origin and cache backend. The cache location is defined in the
+    # table store, which is only loaded once per container, unless 'CACHE_URL' is set.
+    key = (origin, tier_name)
+    if key not in _backends:
+        cache_url = os.environ.get('CACHE_URL')
+        if cache_url:
+            cache_backend = create_backend(cache_url)
+        else:
+            cache_backend = get_redis_cache_backend(get_store_from_url(origin), tier_name)
+            if cache_backend is None:
+                raise RuntimeError("No Redis resource defined for tier '{}'.".format(tier_name))
+        _backends[key] = create_backend(origin), cache_backend
+    return _backends[key]
+
+
 def _push_to_cache(origin, tier_name):
     """Push config  with origin 'origin' to its designated Redis cache."""
-    print "Get config store from url:", origin
-    ts = get_store_from_url(origin)
-    redis_backend = update_cache(ts, tier_name)
-    print "Config {} saved to {}".format(ts, redis_backend)
-
+    origin_backend, cache_backend = _get_backends(origin, tier_name)
+    result = sync_cache(origin_backend, cache_backend)
+    if result['reason'] == 'not_pickle':
+        print "Get config store from url:", origin
+        ts = get_store_from_url(origin)
+        redis_backend = update_cache(ts, tier_name)
+        print "Config {} saved to {}".format(ts, redis_backend)
+    elif result['updated']:
+        print "Config copied from {} to {}".format(origin_backend, cache_backend)
+    else:
+        print "Config in {} is up to date.".format(cache_backend)
+    return result
 
 '''
     import json
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Profiling support for the command line tools
+
+Runs a command under cProfile and records wall time per phase through the
+instrumentation hooks in driftconfig.instrument.
+'''
+import cProfile
+import pstats
+import sys
+import time
+
+from driftconfig import instrument
+
+
+# Phases of the summary and the instrumentation timers that make up each one.
+PHASES = [
+    ('backend I/O', ['backend.load_data', 'backend.save_data']),
+    ('deserialization', ['relib.pickle_decode', 'relib.json_decode']),
+    ('integrity checks', ['relib.check_constraints']),
+    ('schema validation', ['relib.check_schema']),
+]
+
+
+class Profiler(object):
+    """
+    Profile a block of code. Call start() and stop(), then report() to write a summary
+    of the wall time per phase and the top functions by 'sort_key'. If 'output' is set,
+    the raw cProfile data is written to that file for use with pstats or other tools.
+    """
+
+    def __init__(self, output=None, sort_key='cumulative', limit=25):
+        self.output = output
+        self.sort_key = sort_key
+        self.limit = limit
+        self.recorder = instrument.MemoryRecorder()
+        self.wall_time = None
+
+    def start(self):
+        self._previous_recorder = instrument.set_recorder(self.recorder)
+        self._profile = cProfile.Profile()
+        self._start_time = time.time()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self.wall_time = time.time() - self._start_time
+        instrument.set_recorder(self._previous_recorder)
+        if self.output:
+            self._profile.dump_stats(self.output)
+
+    def get_phases(self):
+        """
+        Returns a list of dicts with 'phase', 'seconds' and 'count', ranked by time spent.
+        Time not accounted for by any phase is reported as 'other'.
+        """
+        timers = self.recorder.report()['timers']
+        phases = []
+        for phase, names in PHASES:
+            stats = [timers[name] for name in names if name in timers]
+            phases.append({
+                'phase': phase,
+                'seconds': sum(s['total'] for s in stats),
+                'count': sum(s['count'] for s in stats),
+            })
+        accounted = sum(phase['seconds'] for phase in phases)
+        phases.append({'phase': 'other', 'seconds': max(self.wall_time - accounted, 0.0), 'count': None})
+        phases.sort(key=lambda phase: phase['seconds'], reverse=True)
+        return phases
+
+    def report(self, stream=None):
+        stream = stream or sys.stderr
+        stream.write("\nProfile summary. Total wall time: {:.3f} sec\n".format(self.wall_time))
+        for phase in self.get_phases():
+            percent = 100.0 * phase['seconds'] / self.wall_time if self.wall_time else 0.0
+            calls = " ({} calls)".format(phase['count']) if phase['count'] else ""
+            stream.write("  {:<20} {:8.3f} sec {:5.1f}%{}\n".format(phase['phase'], phase['seconds'], percent, calls))
+
+        stream.write("\nTop {} functions by {} time:\n".format(self.limit, self.sort_key))
+        stats = pstats.Stats(self._profile, stream=stream)
+        stats.sort_stats(self.sort_key).print_stats(self.limit)
+
+        if self.output:
+            stream.write("Profile data written to {}\n".format(self.output))
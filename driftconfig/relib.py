@@ -12,23 +12,39 @@ import json
 import re
 import collections
 import copy
+import itertools
 from urlparse import urlparse, parse_qs
 import hashlib
+import threading
+import Queue
 from datetime import datetime
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
-from schemautil import check_schema
+from schemautil import check_schema, get_validator
+import instrument
 
 log = logging.getLogger(__name__)
 
 
+# Json files larger than this are written out in chunks of about this size as they are
+# encoded, instead of as one string. See Backend.save_stream().
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# The checksums of the files of tables serialized with set_row_as_file() are kept in the
+# meta data in this many buckets, so the meta data doesn't grow with the number of rows.
+# See Table.get_hash_tree().
+FILE_CHECKSUM_BUCKETS = 64
+
 # Global integrity check switches.
 # TODO: Add unit tests to check proper functionality of these flags.
 CHECK_INTEGRITY = ['pk', 'fk', 'unique', 'schema', 'constraints']
 
+# Max number of journal segments read when walking back the journal. See Backend.load_journal().
+MAX_JOURNAL_SEGMENTS = 100
+
 
 class RelibError(RuntimeError):
     pass
@@ -46,11 +62,42 @@ class BackendError(RelibError):
     pass
 
 
+class JournalGapError(BackendError):
+    """The journal in the backend doesn't go far enough back to replay from a given point."""
+    pass
+
+
+class JournalMismatchError(RelibError):
+    """Replaying the journal didn't result in the table store it was saved from."""
+    pass
+
+
+# A foreign key constraint compiled for fast lookups. See Table._compile_constraints().
+ForeignKey = collections.namedtuple(
+    'ForeignKey',
+    [
+        'table_name',
+        'fields',  # Tuple of foreign key field names.
+        'field_set',  # Same as 'fields' but a frozenset.
+        'field_pairs',  # List of (foreign key field, alias key field) tuples.
+        'on_primary_key',  # True if the alias key is the primary key of the foreign table.
+        'constraint',  # The constraint dict as defined in the table.
+    ]
+)
+
+
 class Table(object):
 
     TABLENAME_REGEX = re.compile(r"^([a-z\d.-]){1,50}$")
     PK_FIELDNAME_REGEX = re.compile(r"^([\w\d.-]){1,50}$")
 
+    # Attributes containing state derived from the rows or the definition. They are not
+    # part of the table definition nor pickled, and are rebuilt on demand.
+    _transient_attributes = [
+        '_unique_indexes', '_default_template', '_identity_counters', '_key_functions', '_constraint_index',
+        '_validator', '_undo', '_handed_out',
+    ]
+
     def __init__(self, table_name, table_store=None, from_def=None):
 
         # Table name must be nicely formatted so we can use it in path names.
@@ -68,6 +115,7 @@ class Table(object):
         self._group_by_fields = None
         self._subfolder = None
         self._is_system_table = False
+        self._init_transient()
 
         if from_def:
             self.__dict__.update(from_def['dict'])
@@ -79,6 +127,26 @@ class Table(object):
     def __str__(self):
         return "Table('{}')".format(self._table_name)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in self._transient_attributes:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_transient()
+
+    def _init_transient(self):
+        self._unique_indexes = {}  # Key is tuple of field names, value is index. See _get_unique_index().
+        self._default_template = None  # See _compile_default_values().
+        self._identity_counters = None  # See _get_identity_counters().
+        self._key_functions = {}  # See _compile_key_functions().
+        self._constraint_index = None  # See _compile_constraints().
+        self._validator = None  # See _compile_validator().
+        self._undo = None  # Dict of row key and pickled original row while a savepoint is active.
+        self._handed_out = set()  # Keys of rows handed out, if the table has unique keys. See _find_unique().
+
     @property
     def name(self):
         return self._table_name
@@ -99,22 +167,81 @@ class Table(object):
         Special case: If the primary key is a number, the canonicalized version is the
         number itself. This guarantees proper ordering when writing out json.
         """
-        fields = self._group_by_fields if use_group_by else self._pk_fields
+        key_functions = self._key_functions or self._compile_key_functions()
+        return key_functions['group_by' if use_group_by else 'pk'](primary_key)
 
-        if not set(fields).issubset(set(primary_key.keys())):
-            raise TableError("For table '{}', can't make primary key. Need {} but got {}.".format(
-                self._table_name, fields, primary_key.keys()))
+    def _compile_key_functions(self):
+        """
+        Compile the functions that canonicalize keys for this table. This is done when the
+        primary key or row grouping is defined, or on first use for tables which are loaded
+        from a definition or a pickle.
+        Returns a dict of functions, 'pk' and 'group_by' for _canonicalize_key() and 'read'
+        which skips the validation of the key values as it's only used for lookups.
+        """
+        self._key_functions = {
+            'pk': self._compile_key_function(self._pk_fields),
+            'read': self._compile_key_function(self._pk_fields, validate=False),
+            'group_by': self._compile_key_function(self._group_by_fields),
+        }
+        return self._key_functions
 
-        if len(fields) == 1 and isinstance(primary_key[fields[0]], (int, long, float)):
-            canonicalized = primary_key[fields[0]]
+    def _compile_key_function(self, fields, validate=True):
+        """
+        Return a function which canonicalizes a primary key using 'fields'. See
+        _canonicalize_key() for details.
+        If 'validate' is False, the key values are not checked against PK_FIELDNAME_REGEX.
+        """
+        fields = list(fields or [])
+        table_name = self._table_name
+        pattern = self.PK_FIELDNAME_REGEX
+        match = pattern.match
+
+        def missing_fields(primary_key):
+            return TableError("For table '{}', can't make primary key. Need {} but got {}.".format(
+                table_name, fields, primary_key.keys()))
+
+        def bad_value(value):
+            return ConstraintError("Primary key value {!r} didn't match pattern '{}' in table '{}'.".format(
+                value, pattern.pattern, table_name))
+
+        if len(fields) == 1:
+            field = fields[0]
+
+            def key_function(primary_key):
+                try:
+                    value = primary_key[field]
+                except KeyError:
+                    raise missing_fields(primary_key)
+                if isinstance(value, (int, long, float)):
+                    return value
+                text = str(value)
+                if validate and not match(text):
+                    raise bad_value(value)
+                return text
         else:
-            for k in fields:
-                if k in primary_key and not self.PK_FIELDNAME_REGEX.match(str(primary_key[k])):
-                    raise ConstraintError("Primary key value {!r} didn't match pattern '{}' in table '{}'.".format(
-                        primary_key[k], self.PK_FIELDNAME_REGEX.pattern, self.name))
-            canonicalized = '.'.join([str(primary_key[k]) for k in fields if k in primary_key])
-
-        return canonicalized
+            def key_function(primary_key):
+                try:
+                    values = [primary_key[k] for k in fields]
+                except KeyError:
+                    raise missing_fields(primary_key)
+                texts = [str(value) for value in values]
+                if validate:
+                    for value, text in zip(values, texts):
+                        if not match(text):
+                            raise bad_value(value)
+                return '.'.join(texts)
+
+        return key_function
+
+    def _tuple_key(self, values):
+        # Canonicalize a primary key given as a tuple of values in the order of the primary key fields.
+        if len(values) != len(self._pk_fields):
+            raise TableError("For table '{}', can't make primary key. Need values for {} but got {}.".format(
+                self._table_name, self._pk_fields, values))
+        if len(values) == 1:
+            value = values[0]
+            return value if isinstance(value, (int, long, float)) else str(value)
+        return '.'.join([str(value) for value in values])
 
     def _check_row(self, row):
         # Make sure 'row' contains primary key and unique key fields and does not violate any
@@ -127,31 +254,39 @@ class Table(object):
         check_constraints = 'constraints' in CHECK_INTEGRITY
 
         if check_constraints:
-            for c in self._constraints:
-                if c['type'] == 'primary_key' and not set(c['fields']).issubset(row):
-                    raise ConstraintError("In table '{}', row violates constraint {}: {}".format(self._table_name, c, row))
+            with instrument.timer('relib.check_constraints'):
+                constraints = self._constraint_index or self._compile_constraints()
+                for field_set, c in constraints['primary_key']:
+                    if not field_set.issubset(row):
+                        raise ConstraintError("In table '{}', row violates constraint {}: {}".format(self._table_name, c, row))
 
                 # Do unique check but allow for "null" values or omitted field.
-                if c['type'] == 'unique' and check_unique and set(c['fields']).issubset(row):
-                    # Check for duplicates
-                    search_criteria = {k: row[k] for k in c['fields']}
-                    found = self.find(search_criteria)
-                    if len(found):
-                        raise ConstraintError("Unique constraint violation on {} because of {}.".format(search_criteria, found))
-                elif c['type'] == 'foreign_key' and check_fk:
-                    # Verify foreign row reference, if set.
-                    if set(c['foreign_key_fields']).issubset(row):
-                        foreign_row = self.get_foreign_row(None, c['table'], c['foreign_key_fields'], _row=row)
-                        if foreign_row is None:
-                            raise ConstraintError("In table '{}', foreign key record in '{}' not found {}.\nRow data:\n{}".format(
-                                self.name, c['table'], {k: row[k] for k in c['foreign_key_fields']}, json.dumps(row, indent=4)))
+                if check_unique:
+                    for fields, field_set in constraints['unique']:
+                        if field_set.issubset(row):
+                            # Check for duplicates
+                            search_criteria = {k: row[k] for k in fields}
+                            found = self._find_unique(search_criteria)
+                            if found is not None:
+                                raise ConstraintError("Unique constraint violation on {} because of {}.".format(search_criteria, [found]))
+
+                if check_fk:
+                    for fk in constraints['foreign_key']:
+                        # Verify foreign row reference, if set.
+                        if fk.field_set.issubset(row):
+                            foreign_row = self._lookup_foreign_row(row, fk)
+                            if foreign_row is None:
+                                raise ConstraintError("In table '{}', foreign key record in '{}' not found {}.\nRow data:\n{}".format(
+                                    self.name, fk.table_name, {k: row[k] for k in fk.fields}, json.dumps(row, indent=4)))
 
         # Check Json schema format compliance
         if check_schema_:
-            check_schema(row, self._schema, "Adding row to {}".format(self))
+            with instrument.timer('relib.check_schema'):
+                validator = self._validator or self._compile_validator()
+                check_schema(row, self._schema, "Adding row to {}".format(self), validator=validator)
 
         # Check primary key violation
-        row_key = self._canonicalize_key(row)
+        row_key = (self._key_functions or self._compile_key_functions())['pk'](row)
         if check_pk and row_key in self._rows:
             raise ConstraintError("Primary key violation in table '{}': {}".format(self._table_name, row_key))
 
@@ -164,6 +299,7 @@ class Table(object):
         """
         if search_criteria is None:
             # Special case, return all rows
+            self._hand_out(self._rows.keys())
             return self._rows.values()
 
         rows = []
@@ -175,8 +311,79 @@ class Table(object):
             else:
                 rows.append(row)
 
+        self._hand_out_rows(rows)
         return rows
 
+    def _get_unique_index(self, fields):
+        """
+        Return index for the unique key made of 'fields', a sorted tuple of field names.
+        The index is a dict where the key is a tuple of the field values and the value is
+        the canonicalized primary key of the row. It's built on first use and kept up to
+        date as rows are added and removed.
+        """
+        index = self._unique_indexes.get(fields)
+        if index is None:
+            index = {}
+            for row_key, row in self._rows.iteritems():
+                self._index_row(index, fields, row_key, row)
+            self._unique_indexes[fields] = index
+        return index
+
+    @staticmethod
+    def _index_row(index, fields, row_key, row):
+        if set(fields).issubset(row):
+            try:
+                index[tuple(row[k] for k in fields)] = row_key
+            except TypeError:
+                pass  # Unhashable values can't be looked up through the index.
+
+    def _update_unique_indexes(self, row_key, old_row, new_row):
+        for fields, index in self._unique_indexes.iteritems():
+            if old_row is not None:
+                try:
+                    if index.get(tuple(old_row.get(k) for k in fields)) == row_key:
+                        del index[tuple(old_row.get(k) for k in fields)]
+                except TypeError:
+                    pass
+            if new_row is not None:
+                self._index_row(index, fields, row_key, new_row)
+
+    def _find_unique(self, search_criteria):
+        """
+        Same as find() but for criteria made of unique key fields. Returns the first row
+        found or None. The lookup is done through an index instead of scanning the table.
+
+        Rows may have had their unique key fields changed in place since they were indexed.
+        A hit is verified against the row itself, and on a miss the rows handed out by get(),
+        find(), get_foreign_row() and find_references() are checked as well. Rows changed in
+        place through other references, like the one passed to add(), must be updated with
+        update() for the index to pick up the change.
+        """
+        fields = tuple(sorted(search_criteria))
+        try:
+            row_key = self._get_unique_index(fields).get(tuple(search_criteria[k] for k in fields))
+        except TypeError:
+            # Unhashable values must be looked up the slow way.
+            rows = self.find(search_criteria)
+            return rows[0] if rows else None
+
+        if row_key is not None:
+            row = self._rows.get(row_key)
+            if row is not None and all(row.get(k) == search_criteria[k] for k in fields):
+                return row
+            # The row was modified in place after it was added. Rebuild the index and try again.
+            self._unique_indexes.pop(fields, None)
+            rows = self.find(search_criteria)
+            return rows[0] if rows else None
+
+        for row_key in self._handed_out:
+            row = self._rows.get(row_key)
+            if row is not None and all(row.get(k) == search_criteria[k] for k in fields):
+                # The row was given the values in place. Rebuild the index on next use.
+                self._unique_indexes.pop(fields, None)
+                return row
+        return None
+
     def add(self, row, check_only=False):
         """
         Add a row to the table.
@@ -203,7 +410,17 @@ class Table(object):
 
         row_key = self._check_row(row)
         if not check_only:
+            if self._undo is not None:
+                self._save_undo(row_key)
+            if self._unique_indexes:
+                self._update_unique_indexes(row_key, self._rows.get(row_key), row)
             self._rows[row_key] = row
+            if self._identity_counters:
+                for k, last_value in self._identity_counters.iteritems():
+                    value = row.get(k)
+                    if isinstance(value, (int, long)) and value > last_value:
+                        self._identity_counters[k] = value
+            self._record_change()
         return row
 
     def update(self, row):
@@ -224,15 +441,68 @@ class Table(object):
     def get(self, primary_key):
         """
         Get the record pointed to by 'primary_key'.
-        'primary_key' is a dict containing all the fields that make up the primary key.
+        'primary_key' is a dict containing all the fields that make up the primary key, or
+        a tuple of the primary key values in the order the fields were defined in
+        add_primary_key().
+
+        The key values are not validated. A malformed key simply isn't found.
         """
-        return self._rows.get(self._canonicalize_key(primary_key))
+        row_key = self._get_row_key(primary_key)
+        row = self._rows.get(row_key)
+        if self._undo is not None or self._handed_out_tracked():
+            self._hand_out([row_key])
+        return row
+
+    def _get_row_key(self, primary_key):
+        # Canonicalize 'primary_key' for a lookup, see get().
+        if isinstance(primary_key, tuple):
+            return self._tuple_key(primary_key)
+        return (self._key_functions or self._compile_key_functions())['read'](primary_key)
 
     def remove(self, primary_key):
         """
         Remove row from table identified by 'primary_key'.
         """
-        del self._rows[self._canonicalize_key(primary_key)]
+        row_key = self._canonicalize_key(primary_key)
+        if self._undo is not None and row_key in self._rows:
+            self._save_undo(row_key)
+        row = self._rows.pop(row_key)
+        if self._unique_indexes:
+            self._update_unique_indexes(row_key, row, None)
+        self._handed_out.discard(row_key)
+        self._record_change()
+
+    def _save_undo(self, row_key):
+        # Keep the row as it was when the savepoint was made, before it's handed out or
+        # changed. The row is pickled as that's a lot cheaper than a deep copy, and only the
+        # rows which turn out to be changed are unpickled on rollback. None means the row
+        # didn't exist. See TableStore.savepoint().
+        if row_key not in self._undo:
+            row = self._rows.get(row_key)
+            self._undo[row_key] = None if row is None else pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+
+    def _hand_out(self, row_keys):
+        # Called with the keys of rows about to be handed out, and possibly changed in place
+        # by the caller.
+        if self._undo is not None:
+            for row_key in row_keys:
+                self._save_undo(row_key)
+        if self._handed_out_tracked():
+            self._handed_out.update(row_key for row_key in row_keys if row_key in self._rows)
+
+    def _hand_out_rows(self, rows):
+        if rows and (self._undo is not None or self._handed_out_tracked()):
+            self._hand_out([self._canonicalize_key(row) for row in rows])
+
+    def _handed_out_tracked(self):
+        # Only tables with unique keys need to know which rows have been handed out.
+        return bool((self._constraint_index or self._compile_constraints())['unique'])
+
+    def _record_change(self):
+        # Invalidate the caches of the table store.
+        ts = self._table_store
+        if ts is not None and not self._is_system_table:
+            ts.invalidate_caches()
 
     def add_primary_key(self, primary_key_fields):
         """
@@ -246,6 +516,8 @@ class Table(object):
         c = {'type': 'primary_key', 'fields': sorted(self._pk_fields)}
         if c not in self._constraints:
             self._constraints.append(c)
+        self._compile_key_functions()
+        self._invalidate_constraints(all_tables=True)  # Foreign keys to this table may change.
 
     def add_foreign_key(self, foreign_key_fields, table_name, alias_key_fields=None):
         """
@@ -283,6 +555,7 @@ class Table(object):
                 self._table_name, alias_key_fields, table_name))
 
         self._constraints.append(c)
+        self._invalidate_constraints()
 
     def add_unique_constraint(self, unique_key_fields):
         """
@@ -293,10 +566,18 @@ class Table(object):
         """
         c = {'type': 'unique', 'fields': sorted(unique_key_fields.split(','))}
         self._constraints.append(c)
+        self._invalidate_constraints()
 
     def add_schema(self, schema):
         """Add Json schema for row validation."""
         self._schema = schema
+        self._validator = None
+
+    def _compile_validator(self):
+        # Compile the Json schema into a validator. It's cached until the schema changes.
+        # Validators are not shared between table stores as they aren't thread safe.
+        self._validator = get_validator(self._schema)
+        return self._validator
 
     def add_default_values(self, default_values):
         """
@@ -304,6 +585,8 @@ class Table(object):
         'default_values' is a dict.
         """
         self._default_values = copy.deepcopy(default_values)
+        self._default_template = None
+        self._identity_counters = None
 
     def set_subfolder_name(self, subfolder_name):
         """The table file or fileswill be placed in a subfolder called 'subfolder_name'."""
@@ -335,6 +618,7 @@ class Table(object):
             self._group_by_fields = self._pk_fields
 
         self._subfolder = subfolder_name
+        self._compile_key_functions()
 
     def get_filename(self, row=None, is_index_file=None):
         """
@@ -380,66 +664,173 @@ class Table(object):
         """
         row = _row or self.get(primary_key)
 
-        for c in self._constraints:
-            if c['type'] == 'foreign_key' and c['table'] == table_name:
-                if foreign_key_fields is None or foreign_key_fields == c['foreign_key_fields']:
-                    break
+        constraints = self._constraint_index or self._compile_constraints()
+        for fk in constraints['foreign_key_by_table'].get(table_name, []):
+            if foreign_key_fields is None or foreign_key_fields == fk.constraint['foreign_key_fields']:
+                break
         else:
             raise TableError("No foreign key relationship found between {} and {}".format(self, table_name))
 
-        foreign_table = self._table_store.get_table(table_name)
-        search_criteria = {k2: row[k1] for k1, k2 in zip(c['foreign_key_fields'], c['alias_key_fields'])}
+        foreign_row = self._lookup_foreign_row(row, fk)
+        if foreign_row is not None:
+            self._table_store.get_table(fk.table_name)._hand_out_rows([foreign_row])
+        return foreign_row
+
+    def _lookup_foreign_row(self, row, fk):
+        # Return the row which 'row' references through foreign key 'fk', or None.
+        search_criteria = {k2: row[k1] for k1, k2 in fk.field_pairs}
 
         # Special case where foreign row is a reference to the 'row' itself, which is in the process
         # of being inserted.
-        if self.name == table_name and set(search_criteria.items()).issubset(set(row.items())):
-            pass  # Just use the row
+        if fk.table_name == self._table_name and set(search_criteria.items()).issubset(set(row.items())):
+            return row
+
+        foreign_table = self._table_store.get_table(fk.table_name)
+        # If it's on primary key, use it as it can be must faster than scanning the whole table.
+        if fk.on_primary_key:
+            return foreign_table._rows.get(foreign_table._get_row_key(search_criteria))
         else:
-            # If it's on primary key, use it as it can be must faster than scanning the whole table.
-            if sorted(search_criteria.keys()) == sorted(foreign_table._pk_fields):
-                row = foreign_table.get(search_criteria)
-            else:
-                rows = foreign_table.find(search_criteria)
-                if rows:
-                    row = rows[0]
-                else:
-                    row = None
+            # Foreign keys are otherwise linked to a unique key.
+            return foreign_table._find_unique(search_criteria)
 
-        return row
+    def _compile_constraints(self):
+        """
+        Compile the constraints of this table into a dict keyed by constraint type, so
+        checks and lookups don't need to scan and compare every constraint:
+            'primary_key': List of (frozenset of fields, constraint) tuples.
+            'unique': List of (tuple of fields, frozenset of fields) tuples.
+            'foreign_key': List of ForeignKey tuples.
+            'foreign_key_by_table': Dict of foreign table name and list of ForeignKey tuples.
+        The result is cached until the constraints change.
+        """
+        index = {'primary_key': [], 'unique': [], 'foreign_key': [], 'foreign_key_by_table': {}}
+        for c in self._constraints:
+            if c['type'] == 'primary_key':
+                index['primary_key'].append((frozenset(c['fields']), c))
+            elif c['type'] == 'unique':
+                index['unique'].append((tuple(c['fields']), frozenset(c['fields'])))
+            elif c['type'] == 'foreign_key':
+                foreign_table = self._table_store.get_table(c['table'])
+                fk = ForeignKey(
+                    table_name=c['table'],
+                    fields=tuple(c['foreign_key_fields']),
+                    field_set=frozenset(c['foreign_key_fields']),
+                    field_pairs=zip(c['foreign_key_fields'], c['alias_key_fields']),
+                    on_primary_key=sorted(c['alias_key_fields']) == sorted(foreign_table._pk_fields),
+                    constraint=c,
+                )
+                index['foreign_key'].append(fk)
+                index['foreign_key_by_table'].setdefault(fk.table_name, []).append(fk)
+
+        self._constraint_index = index
+        return index
+
+    def _share_compiled(self, other):
+        """
+        Use the compiled key functions, constraints and default values of table 'other'
+        which has the same definition. They are compiled on 'other' first if needed, so
+        tables cloned from the same prototype only compile them once.
+        """
+        self._key_functions = other._key_functions or other._compile_key_functions()
+        self._constraint_index = other._constraint_index or other._compile_constraints()
+        if other._default_template is None:
+            other._default_template = other._compile_default_values()
+        self._default_template = other._default_template
+
+    def _invalidate_constraints(self, all_tables=False):
+        # Drop compiled constraints of this table, or of all tables in the table store.
+        tables = self._table_store._tables.values() if all_tables and self._table_store else [self]
+        for table in tables:
+            table._constraint_index = None
 
     def find_references(self, ref_row, _refs=None):
         """
         Return a dict of tables and rows that reference 'ref_row' either directly or indirectly.
         {'table name': [row, ...]}
         """
-        refs = _refs or []
-
-        for table in self._table_store.tables.values():
-            for c in table._constraints:
-                if c['type'] == 'foreign_key' and c['table'] == self.name:
-                    # 'table' and 'c' is referencing 'self'.
-                    search_criteria = {k2: ref_row[k1] for k1, k2 in zip(c['alias_key_fields'], c['foreign_key_fields'])}
-                    for row in table.find(search_criteria):
-                        refs.append((table.name, row))
-                        if table.name != self.name:
-                            table.find_references(row, refs)
+        refs = _refs if _refs is not None else []
+        self._collect_references(ref_row, refs, {})
 
         # Remove duplicates and formalize the result.
         result = {}
+        seen = set()
         for table_name, row in refs:
             rows = result.setdefault(table_name, [])
-            if row not in rows:
+            if (table_name, id(row)) not in seen:
+                seen.add((table_name, id(row)))
                 rows.append(row)
 
+        for table_name, rows in result.items():
+            self._table_store.get_table(table_name)._hand_out_rows(rows)
         return result
 
+    def _collect_references(self, ref_row, refs, groups):
+        # Add rows referencing 'ref_row' to 'refs' as (table name, row) tuples. The rows of
+        # each referencing table are grouped by foreign key values once and kept in 'groups'
+        # so each table is only scanned once per call to find_references().
+        for table in self._table_store.tables.values():
+            constraints = table._constraint_index or table._compile_constraints()
+            for fk in constraints['foreign_key_by_table'].get(self.name, []):
+                # 'table' and 'fk' is referencing 'self'.
+                fields = fk.fields
+                group = groups.get((table.name, fields))
+                if group is None:
+                    # Rows with unhashable values go in a separate list and are matched by scanning.
+                    group = groups[(table.name, fields)] = ({}, [])
+                    for row in table._rows.itervalues():
+                        if fk.field_set.issubset(row):
+                            try:
+                                group[0].setdefault(tuple(row[k] for k in fields), []).append(row)
+                            except TypeError:
+                                group[1].append(row)
+
+                values = tuple(ref_row[k2] for k1, k2 in fk.field_pairs)
+                try:
+                    rows = group[0].get(values, [])
+                except TypeError:
+                    rows = []
+                rows = rows + [row for row in group[1] if tuple(row[k] for k in fields) == values]
+                for row in rows:
+                    refs.append((table.name, row))
+                    if table.name != self.name:
+                        table._collect_references(row, refs, groups)
+
     def save(self, save_data):
-        cs = self._save_table_data(save_data)
+        hash_tree = self._save_hash_tree(save_data)
         if not self._is_system_table:
             table_meta = self._table_store.get_table_metadata(self._table_name)
-            if table_meta['md5'] != cs:
-                table_meta['md5'] = cs
+            if table_meta['md5'] != hash_tree['md5']:
+                table_meta['md5'] = hash_tree['md5']
                 table_meta['last_modified'] = datetime.utcnow().isoformat() + 'Z'
+            if self._group_by_fields:
+                # Keep checksums of the row group files so diffs can be narrowed down.
+                table_meta['file_buckets'] = hash_tree['buckets']
+                table_meta.pop('files', None)  # Written by earlier versions.
+            identity_counters = self._get_identity_counters()
+            if identity_counters:
+                table_meta['identity'] = dict(identity_counters)
+
+    def get_hash_tree(self):
+        """
+        Return a dict with 'md5' as the checksum of the table and 'files' as a dict of
+        checksums for each file the table is serialized into, keyed by file name.
+
+        'buckets' is a dict of checksums of the files grouped into FILE_CHECKSUM_BUCKETS
+        buckets by file name, see _get_file_bucket(). It's what is kept in the meta data.
+        """
+        return self._save_hash_tree(lambda file_name, data: None)
+
+    def _save_hash_tree(self, save_data):
+        files = {}
+
+        def save_data_hashed(file_name, data):
+            checksum = hashlib.sha256()
+            result = _save_hashed(save_data, file_name, data, checksum.update)
+            files[file_name] = checksum.hexdigest()
+            return result
+
+        cs = self._save_table_data(save_data_hashed)
+        return {'md5': cs, 'files': files, 'buckets': _get_bucket_checksums(files)}
 
     def load(self, fetch_from_storage):
         return self._load_table_data(fetch_from_storage)
@@ -452,6 +843,9 @@ class Table(object):
         'file_name' is a globally unique identifier for the table data or row and can
         be used when writing out the 'json' data to file, db, cloud storage or any other
         device for safe keeping.
+
+        Large files are passed to 'save_data' as an iterator of chunks instead of a string,
+        see json_data(). The chunks must be consumed before 'save_data' returns.
         """
 
         # Save the rows sorted on primary key.
@@ -461,8 +855,7 @@ class Table(object):
         checksum = hashlib.sha256()
 
         def save_data_check(filename, data):
-            checksum.update(data)
-            return save_data(filename, data)
+            return _save_hashed(save_data, filename, data, checksum.update)
 
         if self._group_by_fields:
             row_per_file = self._group_by_fields == self._pk_fields
@@ -482,12 +875,11 @@ class Table(object):
 
             # Add index so we can read it back in automatically
             index = [{k: row[k] for k in self._pk_fields} for row in rows]
-            save_data_check(self.get_filename(is_index_file=True), json.dumps(index, indent=4, sort_keys=True))
+            save_data_check(self.get_filename(is_index_file=True), json_data(index))
 
         else:
             # Write out all rows as a list
-            rows = [row for row in rows]
-            save_data_check(self.get_filename(), json.dumps(rows, indent=4, sort_keys=True))
+            save_data_check(self.get_filename(), json_data(rows))
 
         cs = checksum.hexdigest()
         return cs
@@ -498,59 +890,111 @@ class Table(object):
         Load table data.
 
         'fetch_from_storage' is an function that accepts 'file_name' as a single argument and
-        returns the data pointed to by 'file_name'.
+        returns the data pointed to by 'file_name', either as a string or an iterator of
+        chunks.
         """
         if not self._group_by_fields:
-            data = fetch_from_storage(self.get_filename())
-            rows = jsonloads(data, self.get_filename())
-            for row in rows:
+            # The rows are parsed and added one at a time as the data is read.
+            file_name = self.get_filename()
+            for row in iter_json_array(fetch_from_storage(file_name), file_name):
                 self.add(row)
         else:
             # Get index
-            row_per_file = self._group_by_fields == self._pk_fields
             index_file_name = self.get_filename(is_index_file=True)
             index = fetch_from_storage(index_file_name)
             index = jsonloads(index, index_file_name)
 
-            if row_per_file:
-                for primary_key in index:
-                    file_name = self.get_filename(row=primary_key)
-                    data = fetch_from_storage(file_name)
-                    row = jsonloads(data, file_name)
+            # Each file contains either a single row or a group of rows.
+            row_per_file = self._group_by_fields == self._pk_fields
+            for file_name in self._get_data_filenames(index):
+                data = fetch_from_storage(file_name)
+                rows = [jsonloads(data, file_name)] if row_per_file else iter_json_array(data, file_name)
+                for row in rows:
                     self.add(row)
-            else:
-                # Group one or more rows together for each file.
-                key_groups = {}
-                for primary_key in index:
-                    key = self._canonicalize_key(primary_key, use_group_by=True)
-                    key_groups[key] = primary_key
-
-                for group_key in key_groups.values():
-                    file_name = self.get_filename(row=group_key)
-                    data = fetch_from_storage(file_name)
-                    rows = jsonloads(data, file_name)
-                    for row in rows:
-                        self.add(row)
+
+    def _get_file_names(self, fetch_from_storage):
+        # Return the names of all the files this table is serialized into. If the rows are
+        # stored in separate files, the index file is read using 'fetch_from_storage'.
+        if not self._group_by_fields:
+            return [self.get_filename()]
+        index_file_name = self.get_filename(is_index_file=True)
+        index = jsonloads(fetch_from_storage(index_file_name), index_file_name)
+        return [index_file_name] + self._get_data_filenames(index)
+
+    def _get_load_filename(self):
+        # Return the name of the first file to load, which is the index file if rows are
+        # stored in separate files.
+        return self.get_filename(is_index_file=bool(self._group_by_fields))
+
+    def _get_data_filenames(self, index):
+        # Return the names of the files containing the rows listed in 'index', the
+        # content of the index file.
+        if self._group_by_fields == self._pk_fields:
+            return [self.get_filename(row=primary_key) for primary_key in index]
+
+        # Group one or more rows together for each file.
+        key_groups = {}
+        for primary_key in index:
+            key = self._canonicalize_key(primary_key, use_group_by=True)
+            key_groups[key] = primary_key
+        return [self.get_filename(row=group_key) for group_key in key_groups.values()]
 
     def _get_default_values(self):
         """
         Return a dict of default values for this table. Dynamic values are calculated.
         """
-        # TODO: Move this to a utility
+        if self._default_template is None:
+            self._default_template = self._compile_default_values()
+        static_values, mutable_values, dynamic_values = self._default_template
+
+        d = dict(static_values)
+        for k, v in mutable_values.iteritems():
+            d[k] = copy.deepcopy(v)
+        for k, v in dynamic_values.iteritems():
+            if v == '@@utcnow':
+                d[k] = datetime.utcnow().isoformat() + 'Z'
+            elif v == '@@identity':
+                d[k] = self._get_identity_counters()[k] + 1
+        return d
 
-        d = copy.deepcopy(self._default_values)
-        for k, v in d.items():
+    def _compile_default_values(self):
+        # Split the default values into a tuple of dicts of static values which can be shared
+        # between rows, mutable values which need to be copied, and dynamic values.
+        static_values, mutable_values, dynamic_values = {}, {}, {}
+        for k, v in self._default_values.items():
             if isinstance(v, basestring) and v.startswith('@@'):
-                if v == '@@utcnow':
-                    d[k] = datetime.utcnow().isoformat() + 'Z'
-                elif v == '@@identity':
-                    if self._rows:
-                        d[k] = max([row[k] for row in self._rows.values()]) + 1
-                    else:
-                        d[k] = 1
+                if v in ['@@utcnow', '@@identity']:
+                    dynamic_values[k] = v
                 else:
                     log.warning("Unknown dynamic default value '{}' defined in table '{}'".format(k, self._table_name))
-        return d
+                    static_values[k] = v
+            elif isinstance(v, (dict, list)):
+                mutable_values[k] = v
+            else:
+                static_values[k] = v
+        return static_values, mutable_values, dynamic_values
+
+    def _get_identity_counters(self):
+        """
+        Return a dict with the last value used for each field that has '@@identity' as
+        default value. The counters pick up from the values persisted in the table meta
+        data, or the highest value in the table, and are kept up to date as rows are added.
+        Values are never reused even if the rows using them are removed.
+        """
+        if self._identity_counters is None:
+            persisted = {}
+            if self._table_store and not self._is_system_table:
+                for table_meta in self._table_store.meta['tables']:
+                    if table_meta['table_name'] == self._table_name:
+                        persisted = table_meta.get('identity', {})
+
+            counters = {}
+            for k, v in self._default_values.items():
+                if v == '@@identity':
+                    values = [row[k] for row in self._rows.itervalues() if isinstance(row.get(k), (int, long))]
+                    counters[k] = max(values + [persisted.get(k, 0)])
+            self._identity_counters = counters
+        return self._identity_counters
 
 
 class SingleRowTable(Table):
@@ -565,11 +1009,13 @@ class SingleRowTable(Table):
         super(SingleRowTable, self).__init__(table_name, table_store, from_def)
         self.add({})  # A single row table always has one, and only one row.
 
-    def _canonicalize_key(self, primary_key, use_group_by=False):
-        return ''
+    def _compile_key_function(self, fields, validate=True):
+        return lambda primary_key: ''
 
     def get(self):
         if self._rows:
+            if self._undo is not None:
+                self._save_undo(self._rows.keys()[0])
             return self._rows.values()[0]
 
     def __getitem__(self, key):
@@ -580,7 +1026,12 @@ class SingleRowTable(Table):
         # Adding a row to a single row table essentially means overwrite whatever is
         # in there. So let's remove the singleton record before adding this one if needed.
         tmp = self.get()
+        if self._undo is not None:
+            for row_key in self._rows:
+                self._save_undo(row_key)
         self._rows.clear()
+        self._unique_indexes.clear()
+        self._handed_out.clear()
         try:
             return super(SingleRowTable, self).add(row, check_only)
         finally:
@@ -628,26 +1079,40 @@ class TableStoreEncoder(json.JSONEncoder):
     """
     def default(self, obj):
         if isinstance(obj, TableStore):
-            return obj.__dict__
+            return obj.__getstate__()
         elif isinstance(obj, Table):
-            #
-            tmp, obj._rows = obj._rows, {}  # Remove rows temporarily
-            tmp2 = obj.__dict__.pop('_table_store')  # Exlude this property from definition
-            try:
-                return {'class': obj.__class__.__name__, 'dict': obj.__dict__.copy()}
-            finally:
-                obj._rows = tmp
-                obj._table_store = tmp2
+            state = obj.__getstate__()  # Transient attributes are excluded
+            state['_rows'] = {}  # Remove rows
+            del state['_table_store']  # Exlude this property from definition
+            return {'class': obj.__class__.__name__, 'dict': state}
 
         # Let the base class default method raise the TypeError
         return super(TableStoreEncoder, self).default(obj)
 
 
+# Key is a definition fingerprint, value is a tuple of a pickled table store with that
+# definition and no rows, and an unpickled instance of it which holds the compiled key
+# functions, constraints and default values of its tables. See TableStore.init_from_definition().
+_prototypes = {}
+# Key is the hash of a definition as returned from get_definition(), value is its fingerprint.
+_definition_fingerprints = {}
+MAX_PROTOTYPES = 16
+# Key is the ETag of a definition file as returned from Backend.get_etag(), value is the
+# fingerprint of the definition it was found to contain. See TableStore._load_from_backend().
+_definition_etags = {}
+MAX_DEFINITION_ETAGS = 1024
+
+
 class TableStore(object):
 
     TS_DEF_FILENAME = '#tsdef.json'
     TS_META_TABLENAME = '#tsmeta'
 
+    _journal_base = None  # Table stores pickled without a journal attribute don't have it enabled.
+    _generation = 0  # See invalidate_caches().
+    _caches = None
+    _pristine = False
+
     def __init__(self):
         """
         Initialize TableStore. If 'backend' is set, it will load definition and data from
@@ -657,8 +1122,24 @@ class TableStore(object):
         self._tableorder = []  # Table order, because of DAG
         self._origin = 'clean'
         self._lock_meta = False  # Safeguard updates to meta data.
+        self._journal_base = None  # Pickled rows of all tables if journaling is enabled, see get_journal().
+        self._generation = 0  # Incremented on every change to the table store.
+        self._caches = None  # Dict of caches of derived data, see get_cache().
+        self._pristine = False  # See pristine.
         self._add_metatable()
 
+    def __getstate__(self):
+        # The journal and caches are kept next to the table store but are not a part of it.
+        state = self.__dict__.copy()
+        for attr in ['_journal_base', '_generation', '_caches', '_pristine']:
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        # Unpickling a table store is as good as loading it.
+        self.__dict__.update(state)
+        self._pristine = True
+
     def __str__(self):
         if 'domain' in self._tables:
             domain = self._tables['domain'].get()
@@ -687,6 +1168,163 @@ class TableStore(object):
     def get_table(self, table_name):
         return self._tables[table_name]
 
+    @property
+    def generation(self):
+        """A number which is incremented every time the table store changes."""
+        return self._generation
+
+    @property
+    def pristine(self):
+        """
+        True if the table store was loaded from a backend and hasn't changed since. Rows
+        modified in place go unnoticed unless invalidate_caches() is called, so call it
+        before handing the table store out for editing.
+        """
+        return self._pristine
+
+    def invalidate_caches(self):
+        """
+        Drop all caches returned from get_cache() and increment the generation number.
+        This is done automatically on every add, update and remove, but must be called
+        explicitly after modifying rows in place.
+        """
+        self._generation += 1
+        self._caches = None
+        self._pristine = False
+
+    def get_cache(self, name, factory=dict):
+        """
+        Return the cache 'name' for data derived from this table store. If it doesn't exist,
+        it's created by calling 'factory'. The cache is dropped when the table store changes.
+        """
+        if self._caches is None:
+            self._caches = {}
+        cache = self._caches.get(name)
+        if cache is None:
+            cache = self._caches[name] = factory()
+        return cache
+
+    def enable_journal(self):
+        """
+        Keep track of changes to the tables in this table store so they can be saved as
+        journal entries, see get_journal(). The tables as they are now are the starting
+        point of the journal.
+        """
+        if self._journal_base is None:
+            self._journal_base = self._pickle_rows()
+
+    def reset_journal(self):
+        """
+        Make the tables as they are now the starting point of the journal, if journaling is
+        enabled, so the changes made up to now are no longer returned from get_journal().
+        """
+        if self._journal_base is not None:
+            self._journal_base = self._pickle_rows()
+
+    def _pickle_rows(self):
+        rows = {table.name: table._rows for table in self._tables.values() if not table._is_system_table}
+        return pickle.dumps(rows, protocol=2)
+
+    def get_journal(self):
+        """
+        Return a list of journal entries for the changes made to the tables since the
+        starting point of the journal, or None if journaling is not enabled.
+
+        Each entry is a dict with 'seq' as a sequence number, 'table_name', 'operation' as
+        'add', 'update' or 'remove', 'primary_key' as a dict, 'row' as a copy of the row or
+        None if it was removed, and 'timestamp'.
+
+        The entries are made by comparing the tables to the starting point, so rows which
+        are modified in place are included. Rows are added and updated in the order the
+        tables are defined and removed in reverse order, so foreign keys hold when the
+        entries are replayed. Entries are numbered anew when they are saved to a backend,
+        see Backend.save_journal().
+        """
+        if self._journal_base is None:
+            return None
+
+        base = pickle.loads(self._journal_base)
+        timestamp = datetime.utcnow().isoformat() + 'Z'
+        operations = {'new': 'add', 'modified': 'update', 'deleted': 'remove'}
+        entries, removed = [], []
+        for table in self._tables.values():
+            if table._is_system_table:
+                continue
+            table_removed = []
+            changes = _iter_diff_rows(table._rows, base.get(table.name, {}))
+            for change in sorted(changes, key=lambda change: change['key']):
+                row = change['first'] or change['second']
+                entry = {
+                    'table_name': table.name,
+                    'operation': operations[change['change']],
+                    'primary_key': {k: row[k] for k in table._pk_fields},
+                    'row': copy.deepcopy(change['first']),
+                    'timestamp': timestamp,
+                }
+                (table_removed if change['change'] == 'deleted' else entries).append(entry)
+            removed[:0] = table_removed
+
+        entries.extend(removed)
+        for seq, entry in enumerate(entries, 1):
+            entry['seq'] = seq
+        return entries
+
+    def get_checksum(self):
+        """
+        Return the checksum of the rows in all tables, the same as 'checksum' in the meta
+        data once the table store is saved, but without updating the meta data.
+        """
+        checksum = hashlib.sha256()
+        for table in self._tables.values():
+            if not table._is_system_table:
+                checksum.update(table.get_hash_tree()['md5'])
+        return checksum.hexdigest()
+
+    def savepoint(self):
+        """
+        Returns a savepoint which can be passed to rollback() to revert all tables to
+        their current state. Call release() when the savepoint is no longer needed. Only
+        one savepoint can be active at a time.
+
+        Rows are pickled when they are first handed out by get(), find(), get_foreign_row()
+        or find_references(), or changed by add(), update() or remove(), so the cost is in
+        proportion to the rows touched and not the size of the table store. On rollback
+        only the rows which were changed are restored. Rows which are reached through other
+        means, like Table._rows, are not reverted.
+        """
+        identity_counters = {}
+        for table_name, table in self._tables.items():
+            table._undo = {}
+            if table._identity_counters is not None:
+                identity_counters[table_name] = dict(table._identity_counters)
+        return {'identity_counters': identity_counters}
+
+    def rollback(self, savepoint):
+        """Revert all tables to the state they were in when 'savepoint' was made and release it."""
+        for table_name, table in self._tables.items():
+            undo, table._undo = table._undo, None
+            changed = False
+            for row_key, data in (undo or {}).iteritems():
+                row = table._rows.get(row_key)
+                if data is None:
+                    if row is not None:
+                        del table._rows[row_key]
+                        changed = True
+                elif row is None or pickle.dumps(row, pickle.HIGHEST_PROTOCOL) != data:
+                    table._rows[row_key] = pickle.loads(data)
+                    changed = True
+            if changed:
+                # Only the state derived from the rows is rebuilt.
+                table._unique_indexes = {}
+            # Counters are left to be worked out again if they weren't in use at the time.
+            table._identity_counters = savepoint['identity_counters'].get(table_name)
+        self.invalidate_caches()
+
+    def release(self, savepoint):
+        """Keep the changes made since 'savepoint' and stop recording them."""
+        for table in self._tables.values():
+            table._undo = None
+
     def clear(self):
         for table in self._tables.values():
             table._table_store = None
@@ -699,11 +1337,59 @@ class TableStore(object):
         self._tableorder = self._tables.keys()
         return json.dumps(self, indent=4, cls=TableStoreEncoder, sort_keys=True)
 
+    def get_definition_fingerprint(self):
+        """
+        Returns a fingerprint of the definition of this table store. Unlike the definition
+        itself, it only covers the tables and not where the table store was loaded from.
+        """
+        tables = json.dumps(self._tables.items(), cls=TableStoreEncoder, sort_keys=True)
+        return hashlib.sha256(tables).hexdigest()
+
     def init_from_definition(self, definition):
         """
         Initialize this instance using result from a previous call to
         'get_definition'.
+
+        Each definition is only parsed once per process. The result is kept as a
+        prototype and later initializations with the same definition are cloned from it.
+        """
+        definition_hash = hashlib.sha256(definition).hexdigest()
+        fingerprint = _definition_fingerprints.get(definition_hash)
+        if fingerprint and self.init_from_fingerprint(fingerprint):
+            return
+
+        self._parse_definition(definition)
+        fingerprint = self.get_definition_fingerprint()
+        if len(_prototypes) >= MAX_PROTOTYPES:
+            _prototypes.clear()
+            _definition_fingerprints.clear()
+        blob = pickle.dumps(self, pickle.HIGHEST_PROTOCOL)
+        _prototypes[fingerprint] = blob, pickle.loads(blob)
+        _definition_fingerprints[definition_hash] = fingerprint
+
+    def init_from_fingerprint(self, fingerprint):
+        """
+        Initialize this instance using the definition with 'fingerprint' if it has been
+        seen before in this process. Returns True if successful, else False.
+
+        Only the tables are initialized, the origin of this instance is kept as is. The
+        compiled key functions, constraints and default values are shared with the
+        prototype.
         """
+        if fingerprint not in _prototypes:
+            return False
+
+        blob, prototype = _prototypes[fingerprint]
+        clone = pickle.loads(blob)
+        self._tables = clone._tables
+        self._tableorder = clone._tableorder
+        for table in self._tables.values():
+            table._table_store = self
+        for table_name, table in self._tables.items():
+            table._share_compiled(prototype._tables[table_name])
+        return True
+
+    def _parse_definition(self, definition):
         data = jsonloads(definition, "<definition>")
         self.__dict__.update(data)
 
@@ -727,6 +1413,9 @@ class TableStore(object):
                 raise RuntimeError("Unknown table class '{}'".format(table_data['class']))
             self._tables[table_name] = cls(table_name, self, table_data)
 
+        for table in self._tables.values():
+            table._compile_constraints()
+
     def check_integrity(self):
         """Run constraints and schema integrity check on current table store."""
         if not CHECK_INTEGRITY:  # Do a quick bail-out.
@@ -738,10 +1427,19 @@ class TableStore(object):
         # Serializing in a table store will in fact run all the integrity checks.
         b.load_table_store()  # This will trigger any constraint or schema violations.
 
-    def _save_to_backend(self, backend, force=False, run_integrity_check=True):
+    def _save_to_backend(self, backend, force=False, run_integrity_check=True, table_names=None, folder=None):
         """
         Save this table store definition and table data to 'backend'.
 
+        If 'table_names' is set, only data for those tables is saved, along with the
+        definition and meta data. The caller must make sure the other tables in
+        'backend' are up to date.
+
+        If 'folder' is set, the definition, meta data and table data is saved in that
+        folder in 'backend', and the meta data of each table saved records the folder.
+        Tables which are not saved are then loaded from the folder recorded in their
+        meta data. See _load_from_backend().
+
         If the table store is only partial (contains only meta table info) or not
         fully intact, it will not save to 'backend' and instead raise an exception.
         Use 'force' = True to override this behavior.
@@ -758,14 +1456,34 @@ class TableStore(object):
             self.check_integrity()
 
         backend.start_saving()
-        backend.save_data(self.TS_DEF_FILENAME, self.get_definition())
+        backend._save_data(_in_folder(folder, self.TS_DEF_FILENAME), self.get_definition())
 
         user_tables = [table for table in self._tables.values() if not table._is_system_table]
         system_tables = [table for table in self._tables.values() if table._is_system_table]
 
+        # Table files are written concurrently if the backend allows, but the system tables
+        # are only written once all table files are saved.
+        pending = []
+
+        def save_data(file_name, data):
+            # Large files are streamed to the backend as they are encoded.
+            file_name = _in_folder(folder, file_name)
+            if backend.max_concurrency <= 1 or not isinstance(data, basestring):
+                backend._save_data(file_name, data)
+            else:
+                pending.append((file_name, data))
+
         for table in user_tables:
+            if table_names is not None and table.name not in table_names:
+                continue
             log.debug("Save to backend %s: %s", backend, table)
-            table.save(backend.save_data)
+            table.save(save_data)
+            if folder:
+                self.get_table_metadata(table.name)['folder'] = folder
+
+        for args, result, error in run_concurrently(backend._save_data, pending, backend.max_concurrency):
+            if error:
+                raise error
 
         # Calculate checksum for user tables
         checksum = hashlib.sha256()
@@ -773,33 +1491,120 @@ class TableStore(object):
             md5 = self.get_table_metadata(table.name)['md5']
             checksum.update(md5)
         self.meta.get()['checksum'] = checksum.hexdigest()
+        # Loading the table store can skip the definition file if it's already known.
+        self.meta.get()['definition_fingerprint'] = self.get_definition_fingerprint()
 
         for table in system_tables:
             log.debug("Save to backend %s: %s", backend, table)
-            table.save(backend.save_data)
+            table.save(lambda file_name, data: backend._save_data(_in_folder(folder, file_name), data))
 
         backend.done_saving()
 
-    def _load_from_backend(self, backend, skip_definition=False):
+    def _load_from_backend(self, backend, skip_definition=False, folder=None):
         """
         Initialize this table store using data from 'backend'.
 
         If 'skip_definition' is True, the current definition in the
         TableStore object is used, instead of the one stored in the
         backend.
+
+        If 'folder' is set, the table store is loaded from that folder in 'backend', and
+        each table from the folder recorded in its meta data. See _save_to_backend().
         """
         backend.start_loading()
+        prefetched = {}
+        table_folders = {}
+        if folder:
+            # The meta data is read first as it has the folders of the tables.
+            meta_filename = _in_folder(folder, self.meta._get_load_filename())
+            prefetched[meta_filename] = meta_data = backend._load_data(meta_filename)
+            meta = jsonloads(meta_data, meta_filename)
+            table_folders = {
+                table_meta['table_name']: table_meta['folder']
+                for table_meta in meta.get('tables', []) if table_meta.get('folder')
+            }
+        fingerprint = None
         if not skip_definition:
-            definition = backend.load_data(self.TS_DEF_FILENAME)
-            self.init_from_definition(definition)
+            # The fingerprint in the meta data can't be trusted as clients which predate it
+            # carry it forward unchanged when they change the definition. The definition is
+            # only skipped if its file is the same one it was seen in before.
+            definition_filename = _in_folder(folder, self.TS_DEF_FILENAME)
+            etag = backend.get_etag(definition_filename)
+            fingerprint = _definition_etags.get(etag) if etag else None
+            if not fingerprint or not self.init_from_fingerprint(fingerprint):
+                definition = backend._load_data(definition_filename)
+                self.init_from_definition(definition)
+                fingerprint = self.get_definition_fingerprint()
+                if etag:
+                    if len(_definition_etags) >= MAX_DEFINITION_ETAGS:
+                        _definition_etags.clear()
+                    _definition_etags[etag] = fingerprint
         self._origin = str(backend)
 
+        def get_folder(table):
+            return table_folders.get(table.name, folder)
+
+        if backend.max_concurrency > 1:
+            self._prefetch_from_backend(backend, prefetched, get_folder)
+
+        # Files which weren't prefetched are streamed from the backend so large tables don't
+        # need to be read into memory in full before they are parsed.
+        def fetch(file_name):
+            if file_name in prefetched:
+                return prefetched.pop(file_name)
+            return backend._load_stream(file_name)
+
         for table in self._tables.values():
             log.debug("Load from backend %s: %s", backend, table)
-            table.load(backend.load_data)
+            table_folder = get_folder(table)
+            table.load(lambda file_name: fetch(_in_folder(table_folder, file_name)))
 
+        # Loading rows is not a change worth recording.
+        self.reset_journal()
+
+        # Table stores saved without a definition fingerprint, or with a stale one, get the
+        # right one so the meta data doesn't appear modified on the next save.
+        meta = self.meta.get()
+        if meta:
+            meta['definition_fingerprint'] = fingerprint or self.get_definition_fingerprint()
+
+        self.invalidate_caches()
+        self._pristine = True
         backend.done_loading()
 
+    def _prefetch_from_backend(self, backend, prefetched, get_folder=None):
+        """
+        Fetch the files of tables which keep rows in separate files, see
+        Table.set_row_as_file(), from 'backend' using up to 'backend.max_concurrency'
+        threads. The index files are fetched first, then all the files they list. These
+        files are small and many, so fetching them at the same time pays off, while the
+        files of other tables can be large and are better streamed when they are loaded.
+
+        The files are added to 'prefetched', a dict keyed by file name. Files which failed
+        to prefetch are left out so they are fetched again and errors are raised in order.
+
+        'get_folder' is a function returning the folder of a table in 'backend', if any.
+        """
+        get_folder = get_folder or (lambda table: None)
+
+        def prefetch(file_names):
+            file_names = [file_name for file_name in file_names if file_name not in prefetched]
+            for file_name, data, error in run_concurrently(backend._load_data, file_names, backend.max_concurrency):
+                if not error:
+                    prefetched[file_name] = data
+
+        tables = [table for table in self._tables.values() if table._group_by_fields]
+        prefetch([_in_folder(get_folder(table), table._get_load_filename()) for table in tables])
+
+        file_names = []
+        for table in tables:
+            folder = get_folder(table)
+            index_file_name = _in_folder(folder, table._get_load_filename())
+            if index_file_name in prefetched:
+                index = jsonloads(prefetched[index_file_name], index_file_name)
+                file_names.extend(_in_folder(folder, file_name) for file_name in table._get_data_filenames(index))
+        prefetch(file_names)
+
     def get_table_metadata(self, table_name):
         for table_meta in self.meta['tables']:
             if table_meta['table_name'] == table_name:
@@ -841,6 +1646,7 @@ class TableStore(object):
                 'origin': {'type': 'string'},
                 'version': {'type': 'integer'},
                 'checksum': {'type': 'string'},
+                'definition_fingerprint': {'type': 'string'},
 
                 'tables': {'type': 'array', 'items': {
                     'type': 'object',
@@ -848,6 +1654,9 @@ class TableStore(object):
                         'table_name': {'type': 'string'},
                         'md5': {'type': 'string'},
                         'last_modified': {'format': 'date-time'},
+                        'file_buckets': {'type': 'object'},
+                        'identity': {'type': 'object'},
+                        'folder': {'type': 'string'},
                     },
                 }},
             },
@@ -868,43 +1677,405 @@ class Backend(object):
 
     schemes = {}  # Backend registry using url scheme as key.
     pickle_filename = 'table-store.pickle'
+    pickle_meta_filename = 'table-store.meta.json'  # See _save_pickle_meta().
+    journal_folder = 'journal'
+    manifest_filename = 'manifest.json'
     default_format = 'json'  # Default table store file format for the backend.
+    max_concurrency = 1  # Max number of files loaded or saved at the same time.
+
+    def _load_data(self, file_name):
+        # Relib loads all files through here so the backend I/O can be instrumented.
+        if not instrument.enabled:
+            return self.load_data(file_name)
+        with instrument.timer('backend.load_data'):
+            data = self.load_data(file_name)
+        instrument.incr('backend.load_data.bytes', len(data) if data else 0)
+        return data
+
+    def _load_stream(self, file_name):
+        # Same as _load_data() but for load_stream().
+        if not instrument.enabled:
+            return self.load_stream(file_name)
+        with instrument.timer('backend.load_data'):
+            chunks = self.load_stream(file_name)
+        return _iter_hashed(chunks, lambda chunk: instrument.incr('backend.load_data.bytes', len(chunk)))
+
+    def load_stream(self, file_name):
+        """
+        Return the data in 'file_name' as an iterator of strings. Errors, like if the file
+        doesn't exist, are raised by this call and not when the chunks are read. By default
+        the data is read in one piece using load_data().
+        """
+        return iter([self.load_data(file_name)])
+
+    def _save_data(self, file_name, data):
+        # Relib saves all files through here so the backend I/O can be instrumented. Data
+        # which is an iterator of chunks is passed on to save_stream().
+        is_string = isinstance(data, basestring)
+        save = self.save_data if is_string else self.save_stream
+        if not instrument.enabled:
+            return save(file_name, data)
+        if not is_string:
+            data = _iter_hashed(data, lambda chunk: instrument.incr('backend.save_data.bytes', len(chunk)))
+        with instrument.timer('backend.save_data'):
+            save(file_name, data)
+        if is_string:
+            instrument.incr('backend.save_data.bytes', len(data))
+
+    def save_stream(self, file_name, chunks):
+        """
+        Save the data in 'chunks', an iterator of strings, to 'file_name'. The chunks are
+        produced as the data is encoded, so backends which can write them out as they
+        come should override this. By default the chunks are joined and saved using
+        save_data().
+        """
+        self.save_data(file_name, ''.join(chunks))
 
     def load_table_store(self):
+        folder = self.get_version_folder()
         blob = None
         try:
             self.start_loading()
-            blob = self.load_data(self.pickle_filename)
+            blob = self._load_data(_in_folder(folder, self.pickle_filename))
             self.done_loading()
         except Exception as e:
             log.info("%s does not contain pickle: %s. Assuming json source.", self, self.pickle_filename)
         if blob:
-            ts = pickle.loads(blob)
+            with instrument.timer('relib.pickle_decode'):
+                ts = pickle.loads(blob)
         else:
             # Try json loading
             ts = TableStore()
             try:
-                ts._load_from_backend(self)
+                ts._load_from_backend(self, folder=folder)
             except Exception as e:
                 raise e
         return ts
 
-    def save_table_store(self, ts, run_integrity_check=True, file_format=None):
+    def get_version_folder(self):
+        """
+        Return the folder holding the current version of the table store in this backend
+        as recorded in the manifest, or None if the table store is not kept in a version
+        folder. See save_table_store().
+
+        The manifest is not followed if the table store at the root was saved after it,
+        see is_manifest_current().
+        """
+        manifest = self.load_manifest()
+        if manifest and manifest.get('folder') and self.is_manifest_current(manifest):
+            return manifest['folder']
+        return None
+
+    def get_root_etag(self):
+        """
+        Return a tag which changes whenever the table store at the root of this backend is
+        saved, or None if the backend can't tell. See get_etag().
+        """
+        etags = [self.get_etag(self.pickle_filename), self.get_etag(TableStore.TS_META_TABLENAME + '.json')]
+        if not any(etags):
+            return None
+        return ','.join(etag or '' for etag in etags)
+
+    def is_manifest_current(self, manifest):
+        """
+        Return False if the table store at the root of this backend was saved after
+        'manifest' was written, by a client which doesn't know about manifests. The
+        manifest then no longer describes the table store in this backend.
+
+        This is told by the 'root_etag' recorded in the manifest, see make_manifest().
+        Manifests without it are assumed to be current.
+        """
+        root_etag = manifest.get('root_etag')
+        return not root_etag or root_etag == self.get_root_etag()
+
+    def delete_data(self, file_name):
+        """Delete 'file_name' from this backend. Files which don't exist are ignored."""
+        raise BackendError("{} doesn't support deleting files.".format(self))
+
+    def delete_version(self, ts, folder, in_use):
+        """
+        Delete the files of the version of table store 'ts' in version 'folder' which are
+        not used by other versions. 'in_use' is a list of dicts, one for each version which
+        is still in use, of table names and the version folder of the table in that version,
+        see get_table_folders().
+
+        A version is made of its definition and meta data, or its pickle, and the tables
+        it shares with the versions it was saved on top of. Errors are logged and the
+        remaining files are left in place.
+        """
+        meta_filename = _in_folder(folder, TableStore.TS_META_TABLENAME + '.json')
+        try:
+            try:
+                meta = jsonloads(self._load_data(meta_filename), meta_filename)
+            except Exception:
+                meta = None  # The version is in pickle format.
+
+            file_names = [
+                _in_folder(folder, file_name)
+                for file_name in (TableStore.TS_DEF_FILENAME, self.pickle_filename, self.pickle_meta_filename)
+            ]
+            for table_name, table_folder in get_table_folders(meta, folder).items():
+                if table_name not in ts.tables or any(tables.get(table_name) == table_folder for tables in in_use):
+                    continue
+                table = ts.get_table(table_name)
+                fetch = lambda file_name: self._load_data(_in_folder(table_folder, file_name))
+                file_names.extend(_in_folder(table_folder, file_name) for file_name in table._get_file_names(fetch))
+
+            # The meta data goes last so the deletion can be done again if it fails midway.
+            for file_name in file_names + [meta_filename]:
+                self.delete_data(file_name)
+        except Exception as e:
+            log.warning("Couldn't delete version '%s' in %s: %s", folder, self, repr(e))
+
+    def load_meta(self):
+        """
+        Return the meta data of the table store in this backend. Only the meta data file is
+        fetched, unless the table store is in pickle format and was saved without one.
+        """
+        return self._load_meta_or_pickle()[0]
+
+    def _load_meta_or_pickle(self):
+        # Returns a tuple of meta data, a function which returns the table store if it's in
+        # pickle format or None if it's in json format, and the version folder. The pickle
+        # is only loaded up front if there is no up to date meta data saved next to it.
+        folder = self.get_version_folder()
+        meta = self._load_pickle_meta(folder)
+        if meta is not None:
+            return meta, lambda: self._load_pickle(folder), folder
+
+        ts = self._load_pickle(folder)
+        if ts is not None:
+            return ts.meta.get(), lambda: ts, folder
+
+        file_name = _in_folder(folder, TableStore.TS_META_TABLENAME + '.json')
+        self.start_loading()
+        meta = jsonloads(self._load_data(file_name), file_name)
+        self.done_loading()
+        return meta, None, folder
+
+    def _load_pickle(self, folder=None):
+        # Returns the table store in pickle format in 'folder', or None if there is none.
+        blob = None
+        try:
+            self.start_loading()
+            blob = self._load_data(_in_folder(folder, self.pickle_filename))
+            self.done_loading()
+        except Exception:
+            pass
+        if not blob:
+            return None
+        with instrument.timer('relib.pickle_decode'):
+            return pickle.loads(blob)
+
+    def _save_pickle_meta(self, ts, folder=None):
+        # Save the meta data of 'ts' next to its pickle along with the etag of the pickle, so
+        # load_meta() and diff_table_store() don't have to load the pickle. Backends which
+        # can't tell the etag don't get the meta data file.
+        etag = self.get_etag(_in_folder(folder, self.pickle_filename))
+        if etag:
+            data = json.dumps({'pickle_etag': etag, 'meta': ts.meta.get()}, indent=4, sort_keys=True)
+            self._save_data(_in_folder(folder, self.pickle_meta_filename), data)
+
+    def _load_pickle_meta(self, folder=None):
+        # Returns the meta data saved by _save_pickle_meta(), or None if there is none or the
+        # pickle has since been replaced, like when it was written by an earlier version.
+        file_name = _in_folder(folder, self.pickle_meta_filename)
+        try:
+            data = self._load_data(file_name)
+        except Exception:
+            return None
+        if not data:
+            return None
+        pickle_meta = jsonloads(data, file_name)
+        if pickle_meta.get('pickle_etag') != self.get_etag(_in_folder(folder, self.pickle_filename)):
+            return None
+        return pickle_meta['meta']
+
+    def save_table_store(self, ts, run_integrity_check=True, file_format=None, table_names=None, folder=None,
+                         update_manifest=True):
+        """
+        Save table store 'ts' to this backend.
+
+        If 'table_names' is set and the file format is json, only the data of those tables
+        is written out. See TableStore._save_to_backend() for details. In pickle format the
+        table store is a single file which is always written out in full.
+
+        If 'folder' is set, the table store is saved as a new version in that folder and
+        none of the files of the current version are overwritten. The new version is made
+        current by writing a manifest with the 'folder', see make_manifest(). Otherwise the
+        table store is saved at the root of the backend, and if the manifest points to a
+        version folder or records a snapshot, it's replaced with one that doesn't, unless
+        'update_manifest' is False and the caller writes the manifest.
+        """
         file_format = file_format or self.default_format
 
         if file_format == 'json':
-            ts._save_to_backend(self, run_integrity_check=run_integrity_check)
-            self.save_data(self.pickle_filename, '')  # An empty pickle file indicates json format.
+            ts._save_to_backend(self, run_integrity_check=run_integrity_check, table_names=table_names, folder=folder)
+            # An empty pickle file indicates json format.
+            self._save_data(_in_folder(folder, self.pickle_filename), '')
         elif file_format == 'pickle':
-            if run_integrity_check:
-                ts.check_integrity()
-            blob = pickle.dumps(ts, protocol=2)
-            self.start_saving()
-            self.save_data(self.pickle_filename, blob)
-            self.done_saving()
+            self.save_pickled_table_store(pickle_table_store(ts, run_integrity_check=run_integrity_check), folder)
+            self._save_pickle_meta(ts, folder)
         else:
             raise RuntimeError("Unsupported table store file format '%s'" % file_format)
 
+        if folder is None and update_manifest:
+            manifest = self.load_manifest()
+            # The manifest no longer describes what's in the backend.
+            if manifest and (manifest.get('folder') or manifest.get('snapshot_checksum')):
+                self.save_manifest(make_manifest(ts, manifest.get('journal_head')))
+
+    def save_pickled_table_store(self, blob, folder=None):
+        """
+        Save a table store in pickle format, as returned from pickle_table_store(). Use
+        this to save the same table store to many backends without pickling it each time.
+        """
+        self.start_saving()
+        self._save_data(_in_folder(folder, self.pickle_filename), blob)
+        self.done_saving()
+
+    def get_etag(self, file_name):
+        """
+        Return a tag which changes whenever the content of 'file_name' changes, without
+        fetching the content itself. Returns None if the file doesn't exist or if the
+        backend can't tell.
+        """
+        return None
+
+    def save_snapshot(self, snapshot, force=False):
+        """
+        Save 'snapshot', a Snapshot of a table store, to this backend along with a manifest
+        that records its checksum. If the manifest shows the backend already holds the
+        snapshot, nothing is written unless 'force' is True.
+
+        Returns True if the snapshot was written, False if it was skipped.
+        """
+        if not force:
+            manifest = self.load_manifest()
+            if manifest and manifest.get('snapshot_checksum') == snapshot.checksum:
+                return False
+
+        # The definition goes first and the meta data last, the same as when saving a
+        # table store directly.
+        first, middle, last = snapshot.file_groups
+        self.start_saving()
+        for args in first:
+            self._save_data(*args)
+        for args, result, error in run_concurrently(self._save_data, middle, self.max_concurrency):
+            if error:
+                raise error
+        for args in last:
+            self._save_data(*args)
+        self.done_saving()
+
+        self.save_manifest(snapshot.manifest)
+        return True
+
+    def load_manifest(self):
+        """
+        Return the manifest of the table store in this backend, or None if there is none.
+
+        The manifest is a small dict with 'version_token', which changes on every commit
+        to the backend, as well as 'checksum' and 'version' from the meta data of the
+        table store.
+        """
+        try:
+            data = self._load_data(self.manifest_filename)
+        except Exception:
+            return None
+        if not data:
+            return None
+        return jsonloads(data, self.manifest_filename)
+
+    def save_manifest(self, manifest):
+        """Write 'manifest' unconditionally."""
+        self._save_data(self.manifest_filename, json.dumps(manifest, indent=4, sort_keys=True))
+
+    def compare_and_swap_manifest(self, expected_token, manifest):
+        """
+        Write 'manifest' if and only if the version token of the current manifest in this
+        backend is 'expected_token', or if 'expected_token' is None and there is no manifest.
+        Returns True if the manifest was written, False otherwise.
+
+        This implementation is only atomic within the current process. Backends override
+        it using whatever conditional write their storage supports.
+        """
+        with _manifest_lock:
+            current = self.load_manifest()
+            current_token = current['version_token'] if current else None
+            if current_token != expected_token:
+                return False
+            self.save_manifest(manifest)
+            return True
+
+    def save_journal(self, entries, journal_head=None, checksum=None):
+        """
+        Save journal 'entries' to this backend as a new journal segment that follows the
+        segment pointed to by 'journal_head'. Returns the head of the journal including the
+        new segment, a dict with 'file_name' of the segment and 'seq' of its last entry.
+
+        'checksum' is the checksum of the table store once the entries are applied, see
+        TableStore.get_checksum(). It's recorded in the last entry of the segment so
+        replay_journal() can verify the result.
+
+        Segments are never modified once written, so concurrent writers can't overwrite
+        each other's entries. The entries are numbered anew following 'journal_head' so the
+        sequence numbers are unique along the journal. A segment only becomes a part of the
+        journal once the returned head is published in the manifest, see make_manifest().
+        """
+        if not entries:
+            return journal_head
+
+        first_seq = journal_head['seq'] + 1 if journal_head else 1
+        entries = [dict(entry, seq=seq) for seq, entry in enumerate(entries, first_seq)]
+        if checksum:
+            entries[-1]['checksum'] = checksum
+        file_name = '{}/{}.json'.format(self.journal_folder, _unique_id())
+        segment = {
+            'previous': journal_head['file_name'] if journal_head else None,
+            'first_seq': first_seq,
+            'entries': entries,
+        }
+        self._save_data(file_name, json.dumps(segment, indent=4, sort_keys=True))
+        return {'file_name': file_name, 'seq': entries[-1]['seq']}
+
+    def load_journal(self, since_seq=None, journal_head=None):
+        """
+        Return list of journal entries from this backend, or an empty list if there is no
+        journal. If 'since_seq' is set, only entries after that sequence number are returned.
+
+        The journal is read from 'journal_head', or the head published in the manifest, and
+        back until 'since_seq' is reached. At most MAX_JOURNAL_SEGMENTS segments are read.
+        Raises JournalGapError if the journal doesn't reach back to 'since_seq'.
+        """
+        if journal_head is None:
+            manifest = self.load_manifest()
+            journal_head = manifest.get('journal_head') if manifest else None
+
+        segments = []
+        file_name = journal_head['file_name'] if journal_head else None
+        while file_name and len(segments) < MAX_JOURNAL_SEGMENTS:
+            try:
+                data = self._load_data(file_name)
+            except Exception:
+                data = None
+            if not data:
+                break
+            segment = jsonloads(data, file_name)
+            segments.append(segment)
+            if since_seq is not None and segment['first_seq'] <= since_seq + 1:
+                break
+            file_name = segment['previous']
+
+        journal = [entry for segment in reversed(segments) for entry in segment['entries']]
+        if since_seq is not None:
+            if journal_head and journal_head['seq'] > since_seq:
+                if not segments or segments[-1]['first_seq'] > since_seq + 1:
+                    raise JournalGapError("Journal in {} doesn't go back to sequence number {}.".format(
+                        self, since_seq))
+            journal = [entry for entry in journal if entry['seq'] > since_seq]
+        return journal
+
     def start_saving(self):
         pass
 
@@ -924,6 +2095,60 @@ class Backend(object):
         pass
 
 
+class Snapshot(object):
+    """
+    Table store 'ts' encoded once in 'file_format', 'pickle' or 'json', so it can be
+    saved to any number of backends using Backend.save_snapshot().
+
+    'files' is the list of (file name, data) tuples to write out and 'checksum' is the
+    sha256 of the content. 'manifest' is the manifest for the backends, which records the
+    checksum so writing the same snapshot again can be skipped.
+
+    'file_groups' has the same files split into the definition, the table data, and the
+    meta data and pickle files, which are written in that order so the table store is
+    only picked up once all of it is written.
+    """
+
+    first_file_names = [TableStore.TS_DEF_FILENAME]
+    last_file_names = [TableStore.TS_META_TABLENAME + '.json', Backend.pickle_filename]
+
+    def __init__(self, ts, file_format='pickle', run_integrity_check=True):
+        self.file_format = file_format
+        if file_format == 'pickle':
+            blob = pickle_table_store(ts, run_integrity_check=run_integrity_check)
+            self.files = [(Backend.pickle_filename, blob)]
+        elif file_format == 'json':
+            storage = collections.OrderedDict()
+            DictBackend(storage).save_table_store(ts, run_integrity_check=run_integrity_check, file_format='json')
+            self.files = storage.items()
+        else:
+            raise RuntimeError("Unsupported table store file format '%s'" % file_format)
+
+        self.file_groups = (
+            [f for f in self.files if f[0] in self.first_file_names],
+            [f for f in self.files if f[0] not in self.first_file_names + self.last_file_names],
+            [f for f in self.files if f[0] in self.last_file_names],
+        )
+
+        # Pickles of equal table stores aren't always byte for byte equal, so the checksum is
+        # calculated from the rows and the definition instead. The meta data isn't used as
+        # it may not be up to date.
+        checksum = hashlib.sha256(file_format)
+        if file_format == 'json':
+            for file_name, data in sorted(self.files):
+                checksum.update(file_name)
+                checksum.update(hashlib.sha256(data).digest())
+        else:
+            checksum.update(ts.get_checksum())
+            checksum.update(ts.get_definition_fingerprint())
+        self.checksum = checksum.hexdigest()
+        self.size = sum(len(data) for file_name, data in self.files)
+        self.manifest = dict(make_manifest(ts), snapshot_checksum=self.checksum)
+
+    def __str__(self):
+        return "Snapshot({}, {} files, {} bytes)".format(self.file_format, len(self.files), self.size)
+
+
 class DictBackend(Backend):
     """Wrap a dict as a Backend for TableStore."""
     def __init__(self, storage=None):
@@ -935,6 +2160,180 @@ class DictBackend(Backend):
     def load_data(self, k):
         return self.storage[k]
 
+    def delete_data(self, k):
+        self.storage.pop(k, None)
+
+    def get_etag(self, file_name):
+        if file_name not in self.storage:
+            return None
+        return hashlib.md5(self.storage[file_name]).hexdigest()
+
+
+class LRUCache(object):
+    """
+    A dict-like cache which holds at most 'size' entries, dropping the least recently used.
+    It's safe to use from multiple threads.
+
+    If 'max_weight' is set, entries are also dropped while the total weight of the entries
+    exceeds it, where 'weigh' is a function returning the weight of a value, such as its
+    size in bytes. Values which weigh more than 'max_weight' on their own are not cached.
+    """
+
+    def __init__(self, size, max_weight=None, weigh=None):
+        self.size = size
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._pop(key)
+            if self.max_weight is not None:
+                weight = self.weigh(value)
+                if weight > self.max_weight:
+                    return
+                self.weight += weight
+            self._entries[key] = value
+            while len(self._entries) > self.size or (self.max_weight is not None and self.weight > self.max_weight):
+                self._pop(next(iter(self._entries)))
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        if key not in self._entries:
+            return default
+        value = self._entries.pop(key)
+        if self.max_weight is not None:
+            self.weight -= self.weigh(value)
+        return value
+
+
+_manifest_lock = threading.Lock()
+
+
+def run_concurrently(fn, items, max_concurrency):
+    """
+    Call 'fn' with each element of 'items' as argument using up to 'max_concurrency'
+    threads. If 'items' is a list of tuples, they are passed in as positional arguments.
+
+    Returns a list of (item, result, exception) tuples in the same order as 'items'.
+    The exception is None if the call succeeded.
+    """
+    results = [None] * len(items)
+
+    def call(i):
+        item = items[i]
+        try:
+            result = fn(*item) if isinstance(item, tuple) else fn(item)
+            results[i] = (item, result, None)
+        except Exception as e:
+            results[i] = (item, None, e)
+
+    if max_concurrency <= 1 or len(items) <= 1:
+        for i in xrange(len(items)):
+            call(i)
+        return results
+
+    queue = Queue.Queue()
+    for i in xrange(len(items)):
+        queue.put(i)
+
+    def worker():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except Queue.Empty:
+                return
+            call(i)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(max_concurrency, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def pickle_table_store(ts, run_integrity_check=True):
+    """Return table store 'ts' pickled for Backend.save_pickled_table_store()."""
+    if run_integrity_check:
+        ts.check_integrity()
+    return pickle.dumps(ts, protocol=2)
+
+
+def make_manifest(ts, journal_head=None, folder=None, previous_folder=None, root_etag=None):
+    """
+    Return a new manifest for table store 'ts' with a fresh version token. If 'journal_head'
+    is set, as returned from Backend.save_journal(), it's published in the manifest.
+
+    If 'folder' is set, it's the version folder the table store was saved in, see
+    Backend.save_table_store(). 'previous_folder' is the version folder of the version
+    before, so it can be deleted once it's superseded, see Backend.delete_version().
+
+    'root_etag' is the etag of the table store at the root of the backend, as returned
+    from Backend.get_root_etag(), once it's up to date. See Backend.is_manifest_current().
+    """
+    meta = ts.meta.get()
+    manifest = {
+        'version_token': _unique_id(),
+        'checksum': meta.get('checksum'),
+        'version': meta.get('version'),
+        'last_modified': meta.get('last_modified'),
+    }
+    if journal_head:
+        manifest['journal_head'] = journal_head
+    if folder:
+        manifest['folder'] = folder
+    if previous_folder:
+        manifest['previous_folder'] = previous_folder
+    if root_etag:
+        manifest['root_etag'] = root_etag
+    return manifest
+
+
+def get_table_folders(meta, folder=None):
+    """
+    Return a dict of table names and the version folders the tables were saved in, as
+    recorded in table store meta data 'meta'. Tables without a folder are in 'folder'.
+    """
+    if not meta:
+        return {}
+    return {table_meta['table_name']: table_meta.get('folder', folder) for table_meta in meta.get('tables', [])}
+
+
+def make_version_folder():
+    """Return a new unique folder name for a version of a table store."""
+    return 'versions/' + _unique_id()
+
+
+def _unique_id():
+    # Returns a random unique id as a hex string. The uuid module is imported on first use
+    # as it's slow to import on Python 2 where it loads ctypes.
+    import uuid
+    return uuid.uuid4().hex
+
+
+def _in_folder(folder, file_name):
+    # Returns the name of 'file_name' in 'folder', or 'file_name' if 'folder' is None.
+    return folder + '/' + file_name if folder else file_name
+
 
 def create_backend(url):
     parts = urlparse(url)
@@ -959,32 +2358,204 @@ def copy_table_store(table_store):
     return ts
 
 
+def replay_journal(ts, entries, since_seq=None):
+    """
+    Apply journal 'entries' to table store 'ts'. Entries up to and including sequence
+    number 'since_seq' are skipped.
+
+    Returns the sequence number of the last entry applied, or 'since_seq' if none were
+    applied. Pass it in as 'since_seq' when replaying later entries of the journal.
+
+    Entries which end a segment carry the checksum of the table store they were saved
+    from. Raises JournalMismatchError if 'ts' doesn't have that checksum once the entry is
+    applied, which means 'ts' didn't match the journal to begin with.
+    """
+    for entry in sorted(entries, key=lambda entry: entry['seq']):
+        if since_seq is not None and entry['seq'] <= since_seq:
+            continue
+
+        table = ts.get_table(entry['table_name'])
+        if entry['operation'] == 'remove':
+            if table._canonicalize_key(entry['primary_key']) in table._rows:
+                table.remove(entry['primary_key'])
+        else:
+            table.update(copy.deepcopy(entry['row']))
+        since_seq = entry['seq']
+
+        if entry.get('checksum') and entry['checksum'] != ts.get_checksum():
+            raise JournalMismatchError(
+                "Table store doesn't match the journal after sequence number {}.".format(since_seq))
+
+    return since_seq
+
+
 def diff_tables(t1, t2):
     """
     Compare table 't1' to 't2' and report the difference.
     Returns a dict with 'identical' as True or False depending on if the tables are identical,
     and 'new_rows', 'deleted_rows' and 'modified_rows' lists with the diffs accordingly.
+
+    See iter_diff_tables() for a generator version of this function.
     """
-    if t1 == t2:
+    if t1 is t2:
         return {'identical': True}
 
-    diff = {}
-    diff['identical'] = False
+    return _collect_diff(iter_diff_tables(t1, t2))
+
+
+def iter_diff_tables(t1, t2):
+    """
+    Compare table 't1' to 't2' and generate a change record for each row that differs.
+
+    Each change record is a dict with 'change' as 'new', 'deleted' or 'modified', 'key'
+    as the canonicalized primary key, and 'first' and 'second' as the row from 't1' and
+    't2' respectively, or None if the row is absent.
+    """
+    if t1 is t2:
+        return
 
     # Cheat by using the table._rows dict directly
-    pk1, pk2 = set(t1._rows), set(t2._rows)
-    diff['new_rows'] = [t1._rows[pk] for pk in pk1 - pk2]
-    diff['deleted_rows'] = [t2._rows[pk] for pk in pk2 - pk1]
-    diff['modified_rows'] = []
-    for common_pk in pk1.intersection(pk2):
-        first = t1._rows[common_pk]
-        second = t2._rows[common_pk]
+    for change in _iter_diff_rows(t1._rows, t2._rows):
+        yield change
+
+
+def _iter_diff_rows(rows1, rows2):
+    # Diff two dicts of rows keyed by canonicalized primary key. The rows themselves are
+    # compared as rows may have been modified in place.
+    for pk, first in rows1.iteritems():
+        if pk not in rows2:
+            yield {'change': 'new', 'key': pk, 'first': first, 'second': None}
+            continue
+
+        second = rows2[pk]
         if first != second:
-            diff['modified_rows'].append({'first': first, 'second': second})
+            yield {'change': 'modified', 'key': pk, 'first': first, 'second': second}
+
+    for pk, second in rows2.iteritems():
+        if pk not in rows1:
+            yield {'change': 'deleted', 'key': pk, 'first': None, 'second': second}
+
 
+def _diff_rows(rows1, rows2):
+    return _collect_diff(_iter_diff_rows(rows1, rows2))
+
+
+def _collect_diff(changes):
+    # Gather change records into a diff report as returned by diff_tables().
+    diff = {'new_rows': [], 'deleted_rows': [], 'modified_rows': []}
+    for change in changes:
+        if change['change'] == 'new':
+            diff['new_rows'].append(change['first'])
+        elif change['change'] == 'deleted':
+            diff['deleted_rows'].append(change['second'])
+        else:
+            diff['modified_rows'].append({'first': change['first'], 'second': change['second']})
+
+    diff['identical'] = not (diff['new_rows'] or diff['deleted_rows'] or diff['modified_rows'])
     return diff
 
 
+def diff_table_store(ts, backend):
+    """
+    Compare table store 'ts' to the one in 'backend' and report the difference down to
+    row level.
+
+    The checksum of each table is compared using the meta data from 'backend', and only
+    the tables that differ are fetched. For tables serialized with set_row_as_file() the
+    checksums of their files are compared bucket by bucket, see Table.get_hash_tree(), so
+    only the index file and the files in buckets that differ are fetched. If the table
+    store in 'backend' is in pickle format, it's only loaded if some table differs.
+
+    Returns a dict with 'identical' as True or False, 'meta' as the meta data from
+    'backend', 'new_tables' and 'deleted_tables' as lists of the names of tables only
+    found in 'ts' and 'backend' respectively, 'tables' as a dict of diff_tables() results
+    for each modified table (first=local, second=backend), and 'fetched_files' as a list
+    of the file names that were fetched from 'backend'.
+    """
+    meta, load_pickle, folder = backend._load_meta_or_pickle()
+    other_tables = {t['table_name']: t for t in meta['tables']}
+    diff = {
+        'meta': meta,
+        'new_tables': sorted(set(ts.tables) - set(other_tables)),
+        'deleted_tables': sorted(set(other_tables) - set(ts.tables)),
+        'tables': {},
+        'fetched_files': [],
+    }
+    diff['identical'] = not (diff['new_tables'] or diff['deleted_tables'])
+    other_ts = None
+    table_folder = None
+
+    def fetch(file_name):
+        diff['fetched_files'].append(file_name)
+        file_name = _in_folder(table_folder, file_name)
+        return jsonloads(backend._load_data(file_name), file_name)
+
+    for table_name, table in ts.tables.items():
+        if table_name not in other_tables:
+            continue
+        other_meta = other_tables[table_name]
+        table_folder = other_meta.get('folder', folder) if folder else None
+        hash_tree = table.get_hash_tree()
+        if hash_tree['md5'] == other_meta['md5']:
+            continue
+
+        diff['identical'] = False
+        if load_pickle:
+            other_ts = other_ts or load_pickle()
+            diff['tables'][table_name] = diff_tables(table, other_ts.get_table(table_name))
+        elif isinstance(table, SingleRowTable):
+            doc = fetch(table.get_filename())
+            diff['tables'][table_name] = _diff_rows(table._rows, {'': doc})
+        elif not table._group_by_fields:
+            other_rows = fetch(table.get_filename())
+            other_rows = {table._canonicalize_key(row): row for row in other_rows}
+            diff['tables'][table_name] = _diff_rows(table._rows, other_rows)
+        else:
+            # Narrow the diff down to the row group files in buckets that differ. The index
+            # file tells which files the table in 'backend' has.
+            files = hash_tree['files']
+            index_file_name = table.get_filename(is_index_file=True)
+            other_files = set(table._get_data_filenames(fetch(index_file_name)))
+            file_names = set(files) | other_files
+            # Meta data from earlier versions has no bucket checksums, so then all the files
+            # are compared.
+            other_buckets = other_meta.get('file_buckets')
+            if other_buckets is not None:
+                buckets = hash_tree['buckets']
+                file_names = set(
+                    file_name for file_name in file_names
+                    if buckets.get(_get_file_bucket(file_name)) != other_buckets.get(_get_file_bucket(file_name))
+                )
+            file_names.discard(index_file_name)
+
+            rows = {k: row for k, row in table._rows.iteritems() if table.get_filename(row) in file_names}
+            other_rows = {}
+            for file_name in sorted(file_names):
+                if file_name in other_files:
+                    data = fetch(file_name)
+                    for row in data if isinstance(data, list) else [data]:
+                        other_rows[table._canonicalize_key(row)] = row
+
+            diff['tables'][table_name] = _diff_rows(rows, other_rows)
+
+    return diff
+
+
+def _get_file_bucket(file_name):
+    # Returns the checksum bucket of 'file_name', see FILE_CHECKSUM_BUCKETS.
+    return str(int(hashlib.md5(file_name).hexdigest()[:8], 16) % FILE_CHECKSUM_BUCKETS)
+
+
+def _get_bucket_checksums(files):
+    # Returns a dict of checksums for each bucket of 'files', a dict of file names and
+    # checksums. The checksum of a bucket covers the names and checksums of its files.
+    buckets = {}
+    for file_name in sorted(files):
+        checksum = buckets.setdefault(_get_file_bucket(file_name), hashlib.sha256())
+        checksum.update('{}:{}\n'.format(file_name, files[file_name]))
+    return {bucket: checksum.hexdigest() for bucket, checksum in buckets.items()}
+
+
 def diff_meta(m1, m2):
     """Return a diff report on two meta tables."""
     if m1['checksum'] == m2['checksum']:
@@ -1018,12 +2589,153 @@ def register(cls):
     return cls
 
 
+def iter_json_chunks(obj, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encode 'obj' as Json and yield the result in chunks of about 'chunk_size' bytes.
+    The chunks joined together are the same as json.dumps(obj, indent=4, sort_keys=True).
+    """
+    encoder = json.JSONEncoder(indent=4, sort_keys=True)
+    buf, size = [], 0
+    for text in encoder.iterencode(obj):
+        buf.append(text)
+        size += len(text)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield ''.join(buf)
+
+
+def json_data(obj):
+    """
+    Return the Json encoding of 'obj' for saving. It's a string unless it's larger than
+    STREAM_CHUNK_SIZE, in which case it's an iterator of chunks which are encoded as they
+    are consumed.
+    """
+    chunks = iter_json_chunks(obj)
+    first = next(chunks)
+    second = next(chunks, None)
+    if second is None:
+        return first
+    return itertools.chain([first, second], chunks)
+
+
+_whitespace = re.compile(r'[ \t\n\r]*')
+_json_decoder = json.JSONDecoder()
+_json_item_delimiters = frozenset(' \t\n\r,]')
+
+
+def iter_json_array(data, filename):
+    """
+    Parse a Json array from 'data' and yield its items one at a time. 'data' is a string
+    or an iterator of chunks which are only read as far as needed to parse the next item,
+    so the whole text and all the items don't need to be in memory at the same time.
+    The items are the same as from json.loads(). If the json is bad, an error is logged
+    and ValueError raised.
+    """
+    chunks = iter([data] if isinstance(data, basestring) else data)
+    skip_whitespace = _whitespace.match
+    raw_decode = _json_decoder.raw_decode
+    buf, pos, eof = '', 0, False
+    expect = '['  # One of '[', 'first' item or ']', 'item', 'next' for ',' or ']', and 'end'.
+
+    def bad_json(message):
+        log.error("Error parsing json file %s", filename)
+        return ValueError("{} in json file '{}'.".format(message, filename))
+
+    while True:
+        pos = skip_whitespace(buf, pos).end()
+        if pos < len(buf):
+            c = buf[pos]
+            if expect == '[':
+                if c != '[':
+                    raise bad_json("Expected a Json array")
+                pos += 1
+                expect = 'first'
+                continue
+            elif c == ']' and expect in ('first', 'next'):
+                pos += 1
+                expect = 'end'
+                continue
+            elif expect == 'next':
+                if c != ',':
+                    raise bad_json("Expected ',' or ']'")
+                pos += 1
+                expect = 'item'
+                continue
+            elif expect == 'end':
+                raise bad_json("Extra data after Json array")
+
+            try:
+                if instrument.enabled:
+                    with instrument.timer('relib.json_decode'):
+                        item, end = raw_decode(buf, pos)
+                else:
+                    item, end = raw_decode(buf, pos)
+            except ValueError as e:
+                if eof:
+                    raise bad_json(str(e))
+                end = None
+            # An item which is incomplete or isn't followed by a delimiter may continue in the
+            # next chunk, like a number which is split between chunks after '.' or 'e'.
+            if end is not None and (eof or end < len(buf) and buf[end] in _json_item_delimiters):
+                pos = end
+                expect = 'next'
+                yield item
+                continue
+        elif eof:
+            break
+
+        # Read the next chunk and drop what has been parsed already.
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+        else:
+            if instrument.enabled:
+                instrument.incr('relib.json_decode.bytes', len(chunk))
+            buf = buf[pos:] + chunk
+            pos = 0
+
+    if expect != 'end':
+        raise bad_json("Unexpected end of data")
+
+
+def _iter_hashed(chunks, update):
+    for chunk in chunks:
+        update(chunk)
+        yield chunk
+
+
+def _save_hashed(save_data, file_name, data, update):
+    """
+    Call save_data(file_name, data) and pass the data to 'update' on the way. If 'data'
+    is an iterator of chunks, each chunk is passed to 'update' as it's consumed, and
+    chunks which 'save_data' doesn't consume are consumed when it returns.
+    """
+    if isinstance(data, basestring):
+        update(data)
+        return save_data(file_name, data)
+
+    chunks = _iter_hashed(data, update)
+    result = save_data(file_name, chunks)
+    for chunk in chunks:
+        pass
+    return result
+
+
 def jsonloads(json_text, filename):
     """
     Wrapper for json.loads function. If the json is bad, a proper error
     is generated.
+    'json_text' can also be an iterator of chunks.
     """
+    if not isinstance(json_text, basestring):
+        json_text = ''.join(json_text)
     try:
+        if instrument.enabled:
+            instrument.incr('relib.json_decode.bytes', len(json_text))
+            with instrument.timer('relib.json_decode'):
+                return json.loads(json_text)
         return json.loads(json_text)
     except Exception:
         log.error("Error parsing json file %s", filename)
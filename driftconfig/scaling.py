@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+'''
+Drift Config Scaling Checks
+
+Runs table store operations at doubling sizes and fits the growth of the running time
+to a power law, t = c * N^k. Each operation declares its complexity class, and a check
+fails if the fitted exponent 'k' exceeds the one of the class by more than a tolerance.
+This catches operations that accidentally become quadratic.
+
+    python -m driftconfig.scaling
+
+The exit code is 1 if any operation exceeds its complexity class.
+'''
+import argparse
+import collections
+import json
+import math
+import sys
+import timeit
+
+from driftconfig.relib import TableStore, create_backend
+from driftconfig.testhelpers import create_test_domain, get_name
+from driftconfig.util import set_sticky_config
+
+
+# Exponent of N for each complexity class.
+COMPLEXITY_CLASSES = {
+    'constant': 0.0,
+    'linear': 1.0,
+    'quadratic': 2.0,
+}
+
+DEFAULT_SIZES = [100, 200, 400, 800]
+DEFAULT_REPEAT = 2
+DEFAULT_TOLERANCE = 0.5
+
+# Key is operation name, value is a tuple of (setup function, complexity class, sizes).
+OPERATIONS = collections.OrderedDict()
+
+
+def operation(complexity, sizes=None):
+    """
+    Register an operation of complexity class 'complexity'. The operation is a setup
+    function which takes the size N and returns the callable which is timed.
+
+    'sizes' is a list of sizes to run the operation at if other than DEFAULT_SIZES.
+    Cheap operations need larger sizes for the growth to show.
+    """
+    if complexity not in COMPLEXITY_CLASSES:
+        raise ValueError("Unknown complexity class '{}'.".format(complexity))
+
+    def decorator(fn):
+        OPERATIONS[fn.__name__] = (fn, complexity, sizes or DEFAULT_SIZES)
+        return fn
+    return decorator
+
+
+_domains = {}
+
+
+def _test_domain(n):
+    """
+    Returns a test domain with 'n' users, each with a role assigned in 'users-acl'. The
+    domain is shared between operations and must not be modified.
+    """
+    if n not in _domains:
+        ts = create_test_domain(resource_attributes={})
+        set_sticky_config(None)
+        organization_name = get_name('organization')
+        ts.get_table('access-roles').add({'role_name': 'scaling', 'deployable_name': get_name('deployable')})
+        for i in xrange(n):
+            user_name = 'user{}'.format(i)
+            ts.get_table('users').add({'organization_name': organization_name, 'user_name': user_name})
+            ts.get_table('users-acl').add({
+                'organization_name': organization_name,
+                'user_name': user_name,
+                'role_name': 'scaling',
+            })
+        _domains[n] = ts
+    return _domains[n]
+
+
+def _parent_child_store():
+    # A small table store without schemas so the cost of an add is dominated by the
+    # constraint checks.
+    ts = TableStore()
+    parents = ts.add_table('parents')
+    parents.add_primary_key('parent_id')
+    parents.add_unique_constraint('code')
+    children = ts.add_table('children')
+    children.add_primary_key('child_id')
+    children.add_foreign_key('parent_code', 'parents', 'code')
+    sequence = ts.add_table('sequence')
+    sequence.add_primary_key('sequence_id')
+    sequence.add_default_values({'sequence_id': '@@identity'})
+    return ts
+
+
+@operation('linear', sizes=[500, 1000, 2000, 4000])
+def add_with_unique_key(n):
+    parents = _parent_child_store().get_table('parents')
+
+    def run():
+        for i in xrange(n):
+            parents.add({'parent_id': i, 'code': 'code{}'.format(i)})
+    return run
+
+
+@operation('linear', sizes=[500, 1000, 2000, 4000])
+def add_with_foreign_key(n):
+    ts = _parent_child_store()
+    parents = ts.get_table('parents')
+    children = ts.get_table('children')
+    for i in xrange(n):
+        parents.add({'parent_id': i, 'code': 'code{}'.format(i)})
+
+    def run():
+        for i in xrange(n):
+            children.add({'child_id': 'child{}'.format(i), 'parent_code': 'code{}'.format(i)})
+    return run
+
+
+@operation('linear', sizes=[500, 1000, 2000, 4000])
+def add_with_identity(n):
+    sequence = _parent_child_store().get_table('sequence')
+
+    def run():
+        for i in xrange(n):
+            sequence.add({})
+    return run
+
+
+@operation('linear', sizes=[500, 1000, 2000, 4000])
+def get(n):
+    parents = _parent_child_store().get_table('parents')
+    for i in xrange(n):
+        parents.add({'parent_id': 'parent{}'.format(i), 'code': 'code{}'.format(i)})
+    primary_keys = [{'parent_id': 'parent{}'.format(i)} for i in xrange(n)]
+
+    def run():
+        for primary_key in primary_keys:
+            parents.get(primary_key)
+    return run
+
+
+@operation('linear')
+def find_references(n):
+    # Rows in 'users' reference the organization, and rows in 'users-acl' reference the users.
+    organizations = _test_domain(n).get_table('organizations')
+    organization = organizations.get({'organization_name': get_name('organization')})
+    return lambda: organizations.find_references(organization)
+
+
+@operation('linear', sizes=[50, 100, 200, 400])
+def check_integrity(n):
+    return _test_domain(n).check_integrity
+
+
+@operation('linear', sizes=[50, 100, 200, 400])
+def save_and_load_json(n):
+    ts = _test_domain(n)
+
+    def run():
+        backend = create_backend('memory:///scaling')
+        backend.save_table_store(ts, file_format='json')
+        backend.load_table_store()
+    return run
+
+
+def fit_exponent(sizes, timings):
+    """
+    Return the exponent 'k' of the power law t = c * N^k which best fits 'timings' as a
+    function of 'sizes', using least squares on the log-log values.
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(timing, 1e-9)) for timing in timings]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    numerator = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    denominator = sum((x - x_mean) ** 2 for x in xs)
+    return numerator / denominator
+
+
+def measure(setup, sizes, repeat):
+    """Returns the best of 'repeat' timings of the operation 'setup' for each size in 'sizes'."""
+    timings = []
+    for size in sizes:
+        best = None
+        for i in xrange(repeat):
+            run = setup(size)
+            timing = timeit.timeit(run, number=1)
+            best = timing if best is None else min(best, timing)
+        timings.append(best)
+    return timings
+
+
+def check_scaling(name, sizes=None, repeat=None, tolerance=None):
+    """
+    Measure operation 'name' at each size in 'sizes' and check it against its declared
+    complexity class. If 'sizes' is not set, the sizes of the operation are used.
+
+    Returns a dict with 'name', 'complexity', 'sizes', 'timings', 'exponent' as the fitted
+    exponent, 'limit' as the highest allowed exponent and 'ok'.
+    """
+    repeat = repeat or DEFAULT_REPEAT
+    tolerance = DEFAULT_TOLERANCE if tolerance is None else tolerance
+
+    setup, complexity, default_sizes = OPERATIONS[name]
+    sizes = sizes or default_sizes
+    timings = measure(setup, sizes, repeat)
+    exponent = fit_exponent(sizes, timings)
+    limit = COMPLEXITY_CLASSES[complexity] + tolerance
+    return {
+        'name': name,
+        'complexity': complexity,
+        'sizes': sizes,
+        'timings': timings,
+        'exponent': exponent,
+        'limit': limit,
+        'ok': exponent <= limit,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check scaling of Drift Config operations.")
+    parser.add_argument(
+        '--sizes', help="Comma separated list of sizes. Default depends on the operation."
+    )
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Number of repetitions.")
+    parser.add_argument(
+        '--tolerance', type=float, default=DEFAULT_TOLERANCE,
+        help="How much the fitted exponent may exceed the complexity class. Default is %(default)s."
+    )
+    parser.add_argument(
+        '--only', action='append', choices=OPERATIONS.keys(), help="Check only this operation. Can be repeated."
+    )
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')] if args.sizes else None
+    results = [
+        check_scaling(name, sizes=sizes, repeat=args.repeat, tolerance=args.tolerance)
+        for name in args.only or OPERATIONS.keys()
+    ]
+    print json.dumps(results, indent=4, sort_keys=True)
+
+    failed = [result for result in results if not result['ok']]
+    for result in failed:
+        sys.stderr.write("{name} is not {complexity}: Fitted exponent {exponent:.2f} exceeds {limit:.2f}\n".format(
+            **result))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,18 +6,50 @@ Schema Util - Helpers to pretty print Json schema errors and other bits.
 '''
 import logging
 
-import jsonschema
 from json import dumps
 from StringIO import StringIO
 
 log = logging.getLogger(__name__)
 
 
-def check_schema(json_object, schema, title=None):
-    """Do json schema check on object and abort with 400 error if it fails."""
+_format_checker = None
+# Schemas which have been checked against their meta schema, as Json text.
+_checked_schemas = set()
+
+
+def get_validator(schema):
+    """
+    Return a validator for 'schema' which can be passed to check_schema(). Each schema
+    is only checked against its meta schema once per process instead of on every
+    validation.
+
+    Validators keep internal state when resolving references, so a validator should not
+    be shared between threads.
+    """
+    # jsonschema is slow to import so it's not imported until the first check.
+    import jsonschema
+    global _format_checker
+    if _format_checker is None:
+        _format_checker = jsonschema.FormatChecker()
+    cls = jsonschema.validators.validator_for(schema)
+    schema_text = dumps(schema, sort_keys=True)
+    if schema_text not in _checked_schemas:
+        cls.check_schema(schema)
+        _checked_schemas.add(schema_text)
+    return cls(schema, format_checker=_format_checker)
+
+
+def check_schema(json_object, schema, title=None, validator=None):
+    """
+    Do json schema check on object and abort with 400 error if it fails.
+    If 'validator' is set, it's used instead of compiling 'schema'.
+    """
+    import jsonschema
+    validator = validator or get_validator(schema)
     try:
-        jsonschema.validate(json_object, schema, format_checker=jsonschema.FormatChecker())
-        ###jsonschema.validate(json_object, schema)
+        error = jsonschema.exceptions.best_match(validator.iter_errors(json_object))
+        if error is not None:
+            raise error
     except jsonschema.ValidationError as e:
         report = _generate_validation_error_report(e, json_object)
         if title:
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from driftconfig.benchmark import run_benchmarks, compare_results
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        names = ['find', 'get_foreign_row', 'load_json_memory', 'load_pickle_file', 'drift_config']
+        results = run_benchmarks(sizes=[1], repeat=1, names=names)
+        self.assertEqual([r['name'] for r in results['results']], names)
+        for result in results['results']:
+            self.assertEqual(result['size'], 1)
+            self.assertGreater(result['rows'], 0)
+            self.assertTrue(0 <= result['min'] <= result['mean'] <= result['max'])
+
+    def test_compare_results(self):
+        baseline = {'results': [
+            {'name': 'find', 'size': 1, 'min': 1.0},
+            {'name': 'get', 'size': 1, 'min': 1.0},
+        ]}
+        current = {'results': [
+            {'name': 'find', 'size': 1, 'min': 1.1},
+            {'name': 'get', 'size': 1, 'min': 2.0},
+            {'name': 'add', 'size': 1, 'min': 5.0},  # Not in baseline
+        ]}
+        regressions = compare_results(baseline, current, threshold=1.25)
+        self.assertEqual([(r['name'], r['ratio']) for r in regressions], [('get', 2.0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
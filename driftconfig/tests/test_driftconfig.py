@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
-from driftconfig.config import get_drift_table_store, TSTransaction
+from driftconfig.config import get_drift_table_store, push_to_origin, TSTransaction, TSBatch, update_caches
+from driftconfig.relib import create_backend, make_manifest, Backend, DictBackend
+from driftconfig.util import set_sticky_config, get_drift_config, TenantNotConfigured
+from driftconfig.util import get_domains, config_dir, DOMAIN_REGISTRY_FILENAME, LRUCache
 
 # TODO:
 # - test 'check_only' in Table.add().
@@ -229,6 +237,14 @@ class TestRelib(unittest.TestCase):
             'tenant_name': 'dg-unittest-product',
         })
 
+    def test_drift_table_store_is_fresh(self):
+        # The definition is cached but each table store is a separate instance.
+        ts1 = get_drift_table_store()
+        ts1.get_table('tiers').add({'tier_name': 'UNITTEST', 'is_live': True})
+        ts2 = get_drift_table_store()
+        self.assertEqual(ts2.get_table('tiers').find(), [])
+        self.assertEqual(ts1.get_definition(), ts2.get_definition())
+
 
 class TestPushPull(unittest.TestCase):
 
@@ -239,6 +255,276 @@ class TestPushPull(unittest.TestCase):
             row = ts.get_table('domain').get()
             row['display_name'] += " moar! "
 
+    def test_push_with_version_token(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        ts = create_basic_domain()
+        ts.get_table('domain').get()['origin'] = 'file://' + folder
+        push_to_origin(ts, _first=True)
+
+        origin_backend = create_backend('file://' + folder)
+        token = origin_backend.load_manifest()['version_token']
+        ts1 = origin_backend.load_table_store()
+        ts2 = origin_backend.load_table_store()
+
+        # Nothing changed, nothing pushed
+        result = push_to_origin(ts1, _version_token=token)
+        self.assertEqual(result['reason'], 'push_skipped_crc_match')
+
+        ts1.enable_journal()
+        tiers = ts1.get_table('tiers')
+        tiers.update(dict(tiers.get({'tier_name': 'UNITTEST'}), is_live=False))
+        result = push_to_origin(ts1, _version_token=token)
+        self.assertEqual(result['reason'], 'pushed_to_origin')
+        self.assertEqual(result['tables'], ['tiers'])
+        self.assertEqual(ts1.get_journal(), [])
+        self.assertEqual([entry['seq'] for entry in origin_backend.load_journal()], [1])
+        manifest = origin_backend.load_manifest()
+        self.assertNotEqual(manifest['version_token'], token)
+        self.assertEqual(manifest['checksum'], ts1.meta['checksum'])
+        origin_ts = origin_backend.load_table_store()
+        self.assertEqual(origin_ts.meta['checksum'], ts1.meta['checksum'])
+        self.assertFalse(origin_ts.get_table('tiers').get({'tier_name': 'UNITTEST'})['is_live'])
+
+        # The second writer pulled the same version and must lose.
+        ts2.get_table('domain').get()['display_name'] = 'Conflict'
+        result = push_to_origin(ts2, _version_token=token)
+        self.assertFalse(result['pushed'])
+        self.assertEqual(result['reason'], 'version_conflict')
+        self.assertEqual(origin_backend.load_manifest(), manifest)
+        self.assertEqual(len(origin_backend.load_journal()), 1)
+
+        # Only the modified tables are uploaded to the new version folder.
+        ts1.get_table('domain').get()['display_name'] = 'Second'
+        result = push_to_origin(ts1, _version_token=manifest['version_token'])
+        self.assertEqual(result['tables'], ['domain'])
+        version_folder = origin_backend.get_version_folder()
+        self.assertNotEqual(version_folder, manifest['folder'])
+        file_names = os.listdir(os.path.join(folder, version_folder))
+        self.assertIn('domain.json', file_names)
+        self.assertNotIn('tiers.json', file_names)
+        origin_ts = origin_backend.load_table_store()
+        self.assertEqual(origin_ts.get_table('domain').get()['display_name'], 'Second')
+        self.assertFalse(origin_ts.get_table('tiers').get({'tier_name': 'UNITTEST'})['is_live'])
+
+        # The root is kept up to date for clients which don't read the manifest.
+        def load_root_file(file_name):
+            with open(os.path.join(folder, file_name)) as f:
+                return json.load(f)
+
+        self.assertEqual(load_root_file('#tsmeta.json')['checksum'], ts1.meta['checksum'])
+        self.assertEqual(load_root_file('domain.json')['display_name'], 'Second')
+        self.assertTrue(origin_backend.is_manifest_current(origin_backend.load_manifest()))
+
+        # The version before the one replaced is deleted, except for the tables still in use.
+        first_folder = os.path.join(folder, manifest['folder'])
+        ts1.get_table('domain').get()['display_name'] = 'Third'
+        result = push_to_origin(ts1, _version_token=origin_backend.load_manifest()['version_token'])
+        self.assertEqual(result['reason'], 'pushed_to_origin')
+        file_names = os.listdir(first_folder)
+        self.assertIn('tiers.json', file_names)
+        for file_name in ['#tsdef.json', '#tsmeta.json', 'domain.json']:
+            self.assertNotIn(file_name, file_names)
+        self.assertEqual(origin_backend.load_table_store().get_table('domain').get()['display_name'], 'Third')
+
+        # A client which doesn't read the manifest saves at the root. The manifest is no
+        # longer followed and pushes based on it fail.
+        token = origin_backend.load_manifest()['version_token']
+        ts2.get_table('domain').get()['display_name'] = 'Old client'
+        create_backend('file://' + folder).save_table_store(ts2, update_manifest=False)
+        self.assertIsNone(origin_backend.get_version_folder())
+        self.assertEqual(origin_backend.load_table_store().get_table('domain').get()['display_name'], 'Old client')
+        ts1.get_table('domain').get()['display_name'] = 'Lost update'
+        result = push_to_origin(ts1, _version_token=token)
+        self.assertEqual(result['reason'], 'version_conflict')
+
+    def test_compare_and_swap_manifest(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        backend = create_backend('file://' + folder)
+        manifest = make_manifest(create_basic_domain())
+        self.assertIsNone(backend.load_manifest())
+        self.assertFalse(backend.compare_and_swap_manifest('nope', manifest))
+        self.assertTrue(backend.compare_and_swap_manifest(None, manifest))
+        self.assertFalse(backend.compare_and_swap_manifest(None, manifest))
+        self.assertTrue(backend.compare_and_swap_manifest(manifest['version_token'], manifest))
+
+    def test_batch(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        ts = create_basic_domain()
+        ts.get_table('domain').get()['origin'] = 'file://' + folder
+        push_to_origin(ts, _first=True)
+        set_sticky_config(ts)
+        self.addCleanup(set_sticky_config, None)
+
+        def add_tier(ts, tier_name, fail=False):
+            ts.get_table('tiers').add({'tier_name': tier_name})
+            if fail:
+                ts.get_table('domain').get()['display_name'] = 'Borked'
+                raise RuntimeError("Bork")
+            return tier_name
+
+        batch = TSBatch()
+        batch.add(add_tier, 'FIRST')
+        batch.add(add_tier, 'SECOND', fail=True)
+        batch.add(add_tier, tier_name='THIRD')
+        batch.add(add_tier, 'FIRST')  # Duplicate
+        self.assertEqual(len(batch), 4)
+        result = batch.commit()
+
+        self.assertEqual(result['ok_count'], 2)
+        self.assertEqual(result['error_count'], 2)
+        self.assertEqual([r['ok'] for r in result['results']], [True, False, True, False])
+        self.assertEqual(result['results'][2]['result'], 'THIRD')
+        self.assertEqual(str(result['results'][1]['error']), "Bork")
+
+        origin_ts = create_backend('file://' + folder).load_table_store()
+        tier_names = sorted(tier['tier_name'] for tier in origin_ts.get_table('tiers').find())
+        self.assertEqual(tier_names, ['FIRST', 'THIRD', 'UNITTEST'])
+        self.assertEqual(origin_ts.get_table('domain')['display_name'], "Unit Test Domain")
+
+    def test_update_caches(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        class StuckBackend(DictBackend):
+            __scheme__ = 'stucktest'
+
+            @classmethod
+            def create_from_url_parts(cls, parts, query):
+                return cls()
+
+            def get_url(self):
+                return 'stucktest://'
+
+            def save_data(self, k, v):
+                release.wait(5.0)
+
+        Backend.schemes['stucktest'] = StuckBackend
+        self.addCleanup(Backend.schemes.pop, 'stucktest')
+
+        ts = create_basic_domain()
+        ts.get_table('tiers').add({'tier_name': 'FAST', 'cache': 'file://' + folder})
+        ts.get_table('tiers').add({'tier_name': 'STUCK', 'cache': 'stucktest://'})
+        reports = {report['tier_name']: report for report in update_caches(ts, timeout=0.5)}
+
+        self.assertTrue(reports['FAST']['ok'])
+        self.assertGreater(reports['FAST']['bytes'], 0)
+        self.assertEqual(create_backend('file://' + folder).load_table_store().meta['checksum'], ts.meta['checksum'])
+        self.assertFalse(reports['STUCK']['ok'])
+        self.assertIn("Timed out", reports['STUCK']['error'])
+        self.assertFalse(reports['UNITTEST']['ok'])
+        self.assertTrue(reports['UNITTEST']['no_cache'])
+        self.assertIsNone(reports['UNITTEST']['error'])
+        self.assertFalse(reports['FAST']['no_cache'])
+
+        # Caches which are up to date are skipped
+        report = update_caches(ts, ['FAST'])[0]
+        self.assertTrue(report['ok'] and report['skipped'])
+        self.assertEqual(report['bytes'], 0)
+
+    def test_drift_config_cache(self):
+        ts = create_basic_domain()
+        lookup = {'tier_name': 'UNITTEST', 'deployable_name': 'drift-base', 'tenant_name': 'dg-unittest-product'}
+        conf = get_drift_config(ts=ts, **lookup)
+        self.assertEqual(conf.organization['organization_name'], 'directivegames')
+        self.assertEqual(len(conf.tenants), 1)
+        self.assertIs(get_drift_config(ts=ts, **lookup).tenant, conf.tenant)
+
+        # Table stores which are being edited are not cached
+        ts.get_table('tenants').get(lookup)['state'] = 'disabled'
+        self.assertEqual(len(get_drift_config(ts=ts, **lookup).tenants), 0)
+        ts.get_table('tenants').get(lookup)['state'] = 'active'
+
+        # Table stores fresh from a backend are cached until they change
+        backend = DictBackend()
+        backend.save_table_store(ts)
+        loaded = backend.load_table_store()
+        self.assertTrue(loaded.pristine)
+        conf = get_drift_config(ts=loaded, **lookup)
+        self.assertIs(get_drift_config(ts=loaded, **lookup).tenants[0], conf.tenants[0])
+        self.assertEqual(len(loaded.get_cache('drift_config')), 1)
+        loaded.get_table('tenants').update(dict(conf.tenant, state='disabled'))
+        self.assertFalse(loaded.pristine)
+        self.assertEqual(len(get_drift_config(ts=loaded, **lookup).tenants), 0)
+
+        missing = dict(lookup, tenant_name='dg-other')
+        with self.assertRaises(TenantNotConfigured):
+            get_drift_config(ts=ts, **missing)
+        self.assertIsNone(get_drift_config(ts=ts, allow_missing_tenant=True, **missing).tenant)
+        ts.get_table('tenant-names').add({
+            'tenant_name': 'dg-other',
+            'product_name': 'dg-unittest-product',
+            'tier_name': 'UNITTEST',
+            'organization_name': 'directivegames',
+        })
+        ts.get_table('tenants').add(dict(missing, state='active'))
+        self.assertEqual(get_drift_config(ts=ts, **missing).tenant['tenant_name'], 'dg-other')
+
+    def test_lru_cache(self):
+        cache = LRUCache(8)
+        errors = []
+
+        def worker(offset):
+            try:
+                for i in range(2000):
+                    cache[(offset + i) % 20] = i
+                    cache.get((offset + i * 7) % 20)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=worker, args=(offset,)) for offset in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(cache), 8)
+
+        # Caches can be bounded by the total weight of the values as well
+        cache = LRUCache(8, max_weight=10, weigh=len)
+        cache['a'] = 'aaaa'
+        cache['b'] = 'bbbb'
+        cache.get('a')
+        cache['c'] = 'cccc'
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.weight), ('aaaa', None, 8))
+        cache['a'] = 'a'
+        self.assertEqual(cache.weight, 5)
+        cache['d'] = 'd' * 11  # Too big to be cached at all
+        self.assertEqual((cache.get('d'), len(cache), cache.weight), (None, 2, 5))
+        cache.pop('c')
+        self.assertEqual(cache.weight, 1)
+
+    def test_get_domains(self):
+        home = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, home)
+        self.addCleanup(os.environ.__setitem__, 'HOME', os.environ['HOME'])
+        os.environ['HOME'] = home
+
+        self.assertEqual(get_domains(), {})
+        ts = create_basic_domain()
+        create_backend('file://' + config_dir('unit_test_domain')).save_table_store(ts)
+        domain_info = get_domains()['unit_test_domain']
+        self.assertEqual(domain_info['origin'], '')
+        self.assertEqual(domain_info['checksum'], ts.meta['checksum'])
+        self.assertTrue(os.path.exists(config_dir(DOMAIN_REGISTRY_FILENAME)))
+
+        # The registry is used while the folder is unchanged, and the table store is
+        # only loaded on demand.
+        domain_info = get_domains()['unit_test_domain']
+        self.assertEqual(domain_info['display_name'], "Unit Test Domain")
+        self.assertNotIn('table_store', domain_info)
+        self.assertEqual(domain_info['table_store'].meta['checksum'], ts.meta['checksum'])
+
+        ts.get_table('domain').get()['display_name'] = "Renamed"
+        create_backend('file://' + config_dir('unit_test_domain')).save_table_store(ts)
+        self.assertEqual(get_domains()['unit_test_domain']['display_name'], "Renamed")
+        self.assertEqual(
+            get_domains()['unit_test_domain']['table_store'].get_table('domain')['display_name'], "Renamed")
+
 
 if __name__ == '__main__':
     unittest.main()
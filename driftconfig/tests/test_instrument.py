@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import unittest
+from StringIO import StringIO
+
+from driftconfig import instrument
+from driftconfig.profiling import Profiler
+from driftconfig.relib import DictBackend
+from driftconfig.testhelpers import create_test_domain, get_name
+from driftconfig.util import get_drift_config, set_sticky_config
+
+
+class TestInstrument(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = create_test_domain(resource_attributes={})
+        set_sticky_config(None)
+
+    def test_disabled(self):
+        self.assertFalse(instrument.enabled)
+        self.assertIsNone(instrument.get_recorder())
+        with instrument.timer('test'):
+            pass
+        instrument.incr('test')
+
+    def test_recording(self):
+        with instrument.recording() as recorder:
+            self.assertTrue(instrument.enabled)
+            b = DictBackend()
+            b.save_table_store(self.ts, file_format='json')
+            b.load_table_store()
+            b.save_table_store(self.ts, file_format='pickle')
+            b.load_table_store()
+            get_drift_config(
+                ts=self.ts,
+                tenant_name=get_name('tenant'),
+                tier_name=get_name('tier'),
+                deployable_name=get_name('deployable'),
+            )
+
+        self.assertFalse(instrument.enabled)
+        report = recorder.report()
+        for name in [
+            'backend.load_data', 'backend.save_data', 'relib.pickle_decode', 'relib.json_decode',
+            'relib.check_schema', 'relib.check_constraints', 'util.get_drift_config',
+        ]:
+            self.assertIn(name, report['timers'])
+            self.assertGreater(report['timers'][name]['count'], 0)
+        self.assertEqual(report['timers']['util.get_drift_config']['count'], 1)
+
+        saved = sum(len(data) for data in b.storage.values())
+        self.assertGreaterEqual(report['counters']['backend.save_data.bytes'], saved)
+        self.assertGreater(report['counters']['backend.load_data.bytes'], 0)
+        self.assertGreater(report['counters']['relib.json_decode.bytes'], 0)
+
+    def test_callback_recorder(self):
+        calls = []
+        recorder = instrument.CallbackRecorder(
+            timing=lambda name, seconds: calls.append(name),
+            incr=lambda name, value: calls.append((name, value)),
+        )
+        with instrument.recording(recorder):
+            instrument.incr('counter', 5)
+            with instrument.timer('timer'):
+                pass
+        self.assertEqual(calls, [('counter', 5), 'timer'])
+
+    def test_profiler(self):
+        profiler = Profiler(limit=5)
+        profiler.start()
+        DictBackend().save_table_store(self.ts)
+        profiler.stop()
+        self.assertFalse(instrument.enabled)
+
+        phases = {phase['phase']: phase for phase in profiler.get_phases()}
+        self.assertEqual(
+            sorted(phases), ['backend I/O', 'deserialization', 'integrity checks', 'other', 'schema validation'])
+        self.assertGreater(phases['backend I/O']['count'], 0)
+        self.assertGreater(phases['schema validation']['count'], 0)
+
+        stream = StringIO()
+        profiler.report(stream)
+        self.assertIn("Total wall time", stream.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import unittest
+
+from driftconfig.relib import DictBackend, make_manifest
+from driftconfig.lambdas import refresh_cache
+from driftconfig.tests.test_driftconfig import create_basic_domain
+
+
+class FakeS3Backend(DictBackend):
+    """Stand-in for S3 which reports ETags like S3 does for plain uploads."""
+
+    def get_etag(self, file_name):
+        if file_name in self.storage:
+            return '"{}"'.format(hashlib.md5(self.storage[file_name]).hexdigest())
+
+
+class FakeRedisBackend(DictBackend):
+    """Stand-in for Redis which counts writes."""
+
+    def __init__(self):
+        super(FakeRedisBackend, self).__init__()
+        self.writes = 0
+
+    def save_data(self, k, v):
+        self.writes += 1
+        super(FakeRedisBackend, self).save_data(k, v)
+
+
+def make_event(*keys):
+    return {'Records': [{'s3': {'object': {'key': key}}} for key in keys]}
+
+
+class TestRefreshCache(unittest.TestCase):
+
+    def setUp(self):
+        self.ts = create_basic_domain()
+        self.origin = FakeS3Backend()
+        self.origin.save_table_store(self.ts, file_format='pickle')
+        self.origin.save_manifest(make_manifest(self.ts))
+        self.cache = FakeRedisBackend()
+
+    def test_sync_cache(self):
+        result = refresh_cache.sync_cache(self.origin, self.cache)
+        self.assertEqual(result, {'updated': True, 'reason': 'copied'})
+        # The pickle is copied byte for byte.
+        self.assertEqual(self.cache.storage['table-store.pickle'], self.origin.storage['table-store.pickle'])
+        self.assertEqual(self.cache.load_table_store().meta['checksum'], self.ts.meta['checksum'])
+
+        # Nothing is written if the cache is up to date.
+        writes = self.cache.writes
+        self.assertEqual(refresh_cache.sync_cache(self.origin, self.cache)['reason'], 'up_to_date')
+        self.assertEqual(self.cache.writes, writes)
+
+        self.ts.get_table('tiers').add({'tier_name': 'OTHER'})
+        self.origin.save_table_store(self.ts, file_format='pickle')
+        self.assertTrue(refresh_cache.sync_cache(self.origin, self.cache)['updated'])
+        self.assertIsNotNone(self.cache.load_table_store().get_table('tiers').get({'tier_name': 'OTHER'}))
+
+        # Versions saved in a version folder are copied to the root of the cache.
+        self.ts.get_table('tiers').add({'tier_name': 'THIRD'})
+        self.origin.save_table_store(self.ts, file_format='pickle', folder='versions/v1')
+        self.assertEqual(refresh_cache.sync_cache(self.origin, self.cache)['reason'], 'up_to_date')
+        self.origin.save_manifest(make_manifest(self.ts, folder='versions/v1'))
+        self.assertTrue(refresh_cache.sync_cache(self.origin, self.cache)['updated'])
+        self.assertIsNone(self.cache.get_version_folder())
+        self.assertIsNotNone(self.cache.load_table_store().get_table('tiers').get({'tier_name': 'THIRD'}))
+
+        # Json origins can't be copied as is.
+        self.origin.save_table_store(self.ts, file_format='json')
+        self.assertEqual(refresh_cache.sync_cache(self.origin, self.cache)['reason'], 'not_pickle')
+
+    def test_on_config_update(self):
+        for name, value in [('S3_ORIGIN_URL', 's3://fake/origin'), ('TIER_NAME', 'UNITTEST')]:
+            self.addCleanup(os.environ.pop, name, None)
+            os.environ[name] = value
+        refresh_cache._backends[('s3://fake/origin', 'UNITTEST')] = self.origin, self.cache
+        self.addCleanup(refresh_cache._backends.clear)
+
+        # A burst of uploads results in a single copy.
+        refresh_cache.on_config_update(make_event('origin/table-store.pickle', 'origin/table-store.pickle'), None)
+        writes = self.cache.writes
+        self.assertEqual(writes, 2)  # The pickle and the manifest
+
+        refresh_cache.on_config_update(make_event('origin/table-store.pickle'), None)
+        refresh_cache.on_config_update(make_event('origin/tiers.json'), None)
+        self.assertEqual(self.cache.writes, writes)
+
+        # Publishing a new version triggers an update.
+        self.ts.get_table('tiers').add({'tier_name': 'OTHER'})
+        self.origin.save_table_store(self.ts, file_format='pickle', folder='versions/v1')
+        self.origin.save_manifest(make_manifest(self.ts, folder='versions/v1'))
+        refresh_cache.on_config_update(make_event('origin/manifest.json'), None)
+        self.assertEqual(self.cache.writes, writes + 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,18 @@
 # -*- coding: utf-8 -*-
 import unittest
+import copy
 import json
+import os
 import tempfile
 import shutil
 
 import jsonschema
 
-from driftconfig.relib import TableStore, Table, TableError, ConstraintError, Backend, DictBackend
-from driftconfig.backends import FileBackend
+from driftconfig.relib import TableStore, Table, TableError, ConstraintError, Backend, DictBackend, Snapshot
+from driftconfig.relib import diff_tables, iter_diff_tables, diff_table_store, replay_journal, create_backend
+from driftconfig.relib import iter_json_array, make_manifest, JournalGapError, JournalMismatchError
+from driftconfig.backends import FileBackend, ClientRegistry, ChunkReader
+from driftconfig import relib
 
 
 # TODO:
@@ -237,6 +242,121 @@ class TestRelib(unittest.TestCase):
         # Clear table store
         ts.clear()
 
+    def test_unique_index(self):
+        ts = TableStore()
+        table = ts.add_table('table')
+        table.add_primary_key('pk_field')
+        table.add_unique_constraint('unique_field')
+        table.add({'pk_field': 1, 'unique_field': 'one'})
+        table.add({'pk_field': 2, 'unique_field': 'two'})
+
+        with self.assertRaises(ConstraintError):
+            table.add({'pk_field': 3, 'unique_field': 'one'})
+
+        # Removed and updated rows release their unique values
+        table.remove({'pk_field': 1})
+        table.add({'pk_field': 3, 'unique_field': 'one'})
+        table.update({'pk_field': 2, 'unique_field': 'zwei'})
+        table.add({'pk_field': 4, 'unique_field': 'two'})
+        with self.assertRaises(ConstraintError):
+            table.add({'pk_field': 5, 'unique_field': 'zwei'})
+
+        # Rows handed out and modified in place are checked as well
+        table.get({'pk_field': 3})['unique_field'] = 'drei'
+        with self.assertRaises(ConstraintError):
+            table.add({'pk_field': 5, 'unique_field': 'drei'})
+        table.add({'pk_field': 5, 'unique_field': 'one'})
+
+        # Unhashable values are checked as well
+        table.add({'pk_field': 6, 'unique_field': ['a']})
+        with self.assertRaises(ConstraintError):
+            table.add({'pk_field': 7, 'unique_field': ['a']})
+
+    def test_identity(self):
+        ts = TableStore()
+        table = ts.add_table('table')
+        table.add_primary_key('id')
+        table.add_default_values({'id': '@@identity', 'tags': [], 'name': 'noname'})
+
+        self.assertEqual(table.add({})['id'], 1)
+        self.assertEqual(table.add({'id': 10})['id'], 10)
+        row = table.add({})
+        self.assertEqual(row['id'], 11)
+
+        # Mutable default values are not shared between rows
+        row['tags'].append('x')
+        self.assertEqual(table.add({})['tags'], [])
+
+        # Identity values are not reused and survive serialization
+        table.remove({'id': 12})
+        b = DictBackend()
+        b.save_table_store(ts)
+        ts2 = b.load_table_store()
+        self.assertEqual(ts2.get_table('table').add({})['id'], 13)
+        self.assertEqual(table.add({})['id'], 13)
+
+        # Identity values handed out after a savepoint are given out again after rollback.
+        savepoint = ts.savepoint()
+        self.assertEqual(table.add({})['id'], 14)
+        ts.rollback(savepoint)
+        self.assertEqual(table.add({})['id'], 14)
+
+    def test_tuple_key(self):
+        ts = TableStore()
+        table = ts.add_table('table')
+        table.add_primary_key('name,number')
+        table.add({'name': 'a', 'number': 1})
+        table.add({'name': 'b', 'number': 2})
+
+        self.assertEqual(table.get(('a', 1)), table.get({'name': 'a', 'number': 1}))
+        self.assertEqual(table.get(('b', 2))['number'], 2)
+        self.assertIsNone(table.get(('c', 3)))
+        self.assertIsNone(table.get({'name': 'no pattern match', 'number': 1}))
+
+        with self.assertRaises(TableError):
+            table.get(('a',))
+        with self.assertRaises(TableError):
+            table.get({'name': 'a'})
+
+        # Keys are still validated when adding rows
+        with self.assertRaises(ConstraintError):
+            table.add({'name': 'no pattern match', 'number': 1})
+
+        # Key functions are compiled on demand after loading
+        b = DictBackend()
+        b.save_table_store(ts)
+        self.assertEqual(b.load_table_store().get_table('table').get(('a', 1))['name'], 'a')
+
+    def test_constraint_index(self):
+        ts = TableStore()
+        parents = ts.add_table('parents')
+        parents.add_primary_key('parent_id')
+        parents.add_unique_constraint('code')
+        children = ts.add_table('children')
+        children.add_primary_key('child_id')
+        children.add_foreign_key('parent_id', 'parents')
+        parent = parents.add({'parent_id': 1, 'code': 'a'})
+        child = children.add({'child_id': 1, 'parent_id': 1})
+        self.assertIs(children.get_foreign_row(child, 'parents'), parent)
+
+        # New constraints take effect immediately
+        children.add_foreign_key('parent_code', 'parents', 'code')
+        self.assertFalse(children._compile_constraints()['foreign_key'][1].on_primary_key)
+        with self.assertRaises(ConstraintError):
+            children.add({'child_id': 2, 'parent_id': 1, 'parent_code': 'b'})
+        child = children.add({'child_id': 2, 'parent_id': 1, 'parent_code': 'a'})
+        self.assertIs(children.get_foreign_row(child, 'parents', ['parent_code']), parent)
+
+        # Constraints are compiled when the definition is loaded
+        b = DictBackend()
+        b.save_table_store(ts, file_format='json')
+        ts2 = b.load_table_store()
+        children2 = ts2.get_table('children')
+        self.assertEqual(len(children2._constraint_index['foreign_key_by_table']['parents']), 2)
+        self.assertEqual(children2.get_foreign_row({'child_id': 2}, 'parents', ['parent_code'])['code'], 'a')
+        with self.assertRaises(ConstraintError):
+            children2.add({'child_id': 3, 'parent_id': 2})
+
     def test_schema(self):
         ts = TableStore()
 
@@ -285,6 +405,13 @@ class TestRelib(unittest.TestCase):
 
         self.assertIn("Schema check failed", str(context.exception))
 
+        # The compiled schema is dropped when the schema changes.
+        table.add_schema({'type': 'object', 'properties': {'a_string': {'type': 'integer'}}})
+        table.add({'id': 124, 'a_string': 1})
+        with self.assertRaises(jsonschema.SchemaError):
+            table.add_schema({'type': 'no-such-type'})
+            table.add({'id': 125})
+
     def test_integrity_check(self):
         ts = make_store(populate=True)
         ts.check_integrity()
@@ -444,6 +571,194 @@ class TestRelib(unittest.TestCase):
             table_check.load(lambda file_name: storage[file_name])
             self.assertEqual(table_orig._rows, table_check._rows)
 
+    def test_concurrent_serialization(self):
+        class ConcurrentBackend(DictBackend):
+            max_concurrency = 4
+
+            def load_data(self, k):
+                self.loaded.append(k)
+                return self.storage[k]
+
+            def load_stream(self, k):
+                self.streamed.append(k)
+                return iter([self.storage[k]])
+
+        for row_as_file in False, True:
+            ts = make_store(populate=True, row_as_file=row_as_file)
+            backend = ConcurrentBackend()
+            backend.save_table_store(ts, file_format='json')
+            storage = {}
+            DictBackend(storage).save_table_store(ts, file_format='json')
+            self.assertEqual(sorted(backend.storage), sorted(storage))
+
+            backend.loaded, backend.streamed = [], []
+            ts_check = TableStore()
+            ts_check._load_from_backend(backend)
+            for table_name in ts.tables:
+                self.assertEqual(ts.get_table(table_name)._rows, ts_check.get_table(table_name)._rows)
+            # Each file is fetched only once. Files of rows are prefetched while whole tables,
+            # which can be large, are streamed.
+            self.assertEqual(len(backend.loaded + backend.streamed), len(set(backend.loaded + backend.streamed)))
+            self.assertEqual('countries.json' in backend.streamed, not row_as_file)
+            self.assertIn('#tsmeta.json', backend.streamed)
+
+            # Missing files raise errors as usual
+            del backend.storage['continents.json']
+            with self.assertRaises(KeyError):
+                TableStore()._load_from_backend(backend)
+
+    def test_snapshot(self):
+        ts = make_store(populate=True, row_as_file=True)
+        for file_format in 'pickle', 'json':
+            snapshot = Snapshot(ts, file_format=file_format)
+            backend1, backend2 = DictBackend(), DictBackend()
+            self.assertTrue(backend1.save_snapshot(snapshot))
+            self.assertTrue(backend2.save_snapshot(snapshot))
+            for backend in backend1, backend2:
+                ts_check = backend.load_table_store()
+                for table_name in ts.tables:
+                    self.assertEqual(ts.get_table(table_name)._rows, ts_check.get_table(table_name)._rows)
+
+            # Backends which already hold the snapshot are skipped.
+            self.assertFalse(backend1.save_snapshot(snapshot))
+            self.assertTrue(backend1.save_snapshot(snapshot, force=True))
+            self.assertEqual(Snapshot(ts, file_format=file_format).checksum, snapshot.checksum)
+
+            # Saving the table store by other means invalidates the snapshot checksum.
+            backend1.save_table_store(ts)
+            self.assertNotIn('snapshot_checksum', backend1.load_manifest())
+            self.assertTrue(backend1.save_snapshot(snapshot))
+
+        # A change to the table store changes the checksum, even if the meta data is stale.
+        checksum = Snapshot(ts).checksum
+        ts.get_table('continents').get({'continent_id': 1})['name'] = 'Pangaea'
+        self.assertNotEqual(Snapshot(ts).checksum, checksum)
+
+        # Json snapshots match saving the table store directly, and the definition, table
+        # data and meta data are written in that order.
+        storage = {}
+        DictBackend(storage).save_table_store(ts, file_format='json')
+        snapshot = Snapshot(ts, file_format='json')
+        self.assertEqual(dict(snapshot.files), storage)
+        first, middle, last = [[file_name for file_name, data in group] for group in snapshot.file_groups]
+        self.assertEqual(first, ['#tsdef.json'])
+        self.assertEqual(sorted(last), ['#tsmeta.json', 'table-store.pickle'])
+        self.assertEqual(len(first + middle + last), len(storage))
+
+    def test_definition_fingerprint(self):
+        class CountingBackend(DictBackend):
+            def load_data(self, k):
+                self.loaded.append(k)
+                return self.storage[k]
+
+        ts = make_store(populate=True)
+        backend = CountingBackend()
+        backend.save_table_store(ts, file_format='json')
+        fingerprint = ts.get_definition_fingerprint()
+        self.assertEqual(ts.meta['definition_fingerprint'], fingerprint)
+
+        # The definition is only read from the backend if it hasn't been seen before.
+        relib._prototypes.clear()
+        relib._definition_fingerprints.clear()
+        relib._definition_etags.clear()
+        for expect_definition in True, False:
+            backend.loaded = []
+            ts_check = backend.load_table_store()
+            self.assertEqual(TableStore.TS_DEF_FILENAME in backend.loaded, expect_definition)
+            self.assertEqual(ts_check.get_definition_fingerprint(), fingerprint)
+            self.assertEqual(ts_check.get_table('countries').get({'country_code': 'is'})['name'], 'Iceland')
+
+        # Clones share compiled constraints and key functions.
+        ts_other = backend.load_table_store()
+        for table_name in ts.tables:
+            table, other = ts_check.get_table(table_name), ts_other.get_table(table_name)
+            self.assertIs(table._constraint_index, other._constraint_index)
+            self.assertIs(table._key_functions, other._key_functions)
+
+        # Clones don't share tables, and the origin is not a part of the fingerprint.
+        ts_check.get_table('continents').add({'continent_id': 4, 'name': 'Oceania'})
+        self.assertIsNone(backend.load_table_store().get_table('continents').get({'continent_id': 4}))
+        self.assertNotEqual(ts_check.get_definition(), ts.get_definition())
+        self.assertTrue(TableStore().init_from_fingerprint(fingerprint))
+        self.assertFalse(TableStore().init_from_fingerprint('unknown'))
+
+        # Changing the definition changes the fingerprint.
+        ts.get_table('continents').add_unique_constraint('code')
+        self.assertNotEqual(ts.get_definition_fingerprint(), fingerprint)
+
+        # A changed definition is picked up even if the meta data carries the old
+        # fingerprint forward, as clients which predate the fingerprint do.
+        backend.save_table_store(ts, file_format='json')
+        meta = json.loads(backend.storage['#tsmeta.json'])
+        meta['definition_fingerprint'] = fingerprint
+        backend.storage['#tsmeta.json'] = json.dumps(meta)
+        ts_check = backend.load_table_store()
+        self.assertEqual(ts_check.get_definition_fingerprint(), ts.get_definition_fingerprint())
+        self.assertEqual(ts_check.meta['definition_fingerprint'], ts.get_definition_fingerprint())
+
+    def test_streaming_save(self):
+        class StreamingBackend(DictBackend):
+            max_concurrency = 4
+
+            def save_stream(self, file_name, chunks):
+                chunks = list(chunks)
+                self.streamed[file_name] = len(chunks)
+                self.storage[file_name] = ''.join(chunks)
+
+        ts = make_store(populate=True)
+        countries = ts.get_table('countries')
+        for i in xrange(2000):
+            countries.add({'country_code': 'x{}'.format(i), 'name': 'Country {}'.format(i), 'continent_id': 3})
+
+        backend = StreamingBackend()
+        backend.streamed = {}
+        backend.save_table_store(ts, file_format='json')
+        self.assertGreater(backend.streamed['countries.json'], 1)
+        self.assertNotIn('continents.json', backend.streamed)
+
+        # The result is the same as if it was encoded in one go.
+        rows = [countries._rows[k] for k in sorted(countries._rows)]
+        self.assertEqual(backend.storage['countries.json'], json.dumps(rows, indent=4, sort_keys=True))
+        self.assertEqual(ts.get_table_metadata('countries')['md5'], countries.get_hash_tree()['md5'])
+        storage = {}
+        DictBackend(storage).save_table_store(ts, file_format='json')
+        self.assertEqual(storage, backend.storage)
+
+        # FileBackend writes the chunks straight to the file.
+        tmpdirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdirname)
+        FileBackend(tmpdirname).save_table_store(ts, file_format='json')
+        ts_check = FileBackend(tmpdirname).load_table_store()
+        self.assertEqual(ts_check.get_table('countries')._rows, countries._rows)
+
+        # And read back in chunks.
+        chunks = list(FileBackend(tmpdirname).load_stream('countries.json'))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks), backend.storage['countries.json'])
+
+        reader = ChunkReader(iter(['abc', 'de', '', 'fghij']))
+        self.assertEqual(reader.read(4), 'abcd')
+        self.assertEqual(reader.read(1), 'e')
+        self.assertEqual(reader.read(), 'fghij')
+        self.assertEqual(reader.read(10), '')
+
+    def test_iter_json_array(self):
+        text = '[ 12 , 345,"a\\"b" , {"a": [1, 2.5e3]}, true, null, "\xc3\xa9" ]'
+        expected = json.loads(text)
+        for size in xrange(1, len(text) + 1):
+            # Tokens, like numbers, are split between chunks.
+            chunks = [text[i:i + size] for i in xrange(0, len(text), size)]
+            self.assertEqual(list(iter_json_array(iter(chunks), 'test.json')), expected)
+        self.assertEqual(list(iter_json_array(' [ ]\n', 'test.json')), [])
+        # Numbers which parse as complete up to the end of a chunk.
+        self.assertEqual(list(iter_json_array(['[1.', '5]'], 'test.json')), [1.5])
+        self.assertEqual(list(iter_json_array(['[1.5e', '3]'], 'test.json')), [1.5e3])
+        self.assertEqual(list(iter_json_array(['[1', '2', '.5', 'e-1 ', ', 7]'], 'test.json')), [1.25, 7])
+
+        for bad in ['', '{}', '[1,]', '[1 2]', '[1', '[1] 2', '[,]']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array(bad, 'test.json'))
+
     def test_serialization_for_group_by(self):
         # Test row groups per file as well for multiple primary key fields
 
@@ -465,6 +780,233 @@ class TestRelib(unittest.TestCase):
             table_check._load_from_backend(DictBackend(storage))
             self.assertEqual(ts.get_table('multikey')._rows, table_check.get_table('multikey')._rows)
 
+    def test_diff_tables(self):
+        ts1 = make_store(populate=True, row_as_file=True)
+        ts2 = make_store(populate=True, row_as_file=True)
+        t1, t2 = ts1.get_table('countries'), ts2.get_table('countries')
+        self.assertTrue(diff_tables(t1, t2)['identical'])
+        self.assertEqual(list(iter_diff_tables(t1, t2)), [])
+
+        t1.update({'country_code': 'is', 'name': 'Island', 'continent_id': 3})
+        t1.remove({'country_code': 'jp'})
+        t1.add({'country_code': 'fr', 'name': 'France', 'continent_id': 3})
+        changes = sorted(iter_diff_tables(t1, t2), key=lambda change: change['key'])
+        self.assertEqual(
+            [(change['change'], change['key']) for change in changes],
+            [('new', 'fr'), ('modified', 'is'), ('deleted', 'jp')]
+        )
+        self.assertEqual(changes[1]['second']['name'], 'Iceland')
+
+        # Rows modified in place are picked up right away, also after an earlier diff.
+        t2.get({'country_code': 'ke'})['name'] = 'Kenia'
+        diff = diff_tables(t1, t2)
+        self.assertFalse(diff['identical'])
+        self.assertEqual(len(diff['modified_rows']), 2)
+        DictBackend().save_table_store(ts1)
+        t1.get({'country_code': 'fr'})['name'] = 'Frakkland'
+        self.assertEqual(len(diff_tables(t1, t2)['modified_rows']), 2)
+        self.assertEqual(len(diff_tables(t1, t2)['new_rows']), 1)
+
+    def test_diff_table_store(self):
+        # Diff a modified table store against its original and make sure only the row
+        # files in buckets that differ are fetched.
+        ts = make_store(populate=True, row_as_file=True)
+        storage = {}
+        DictBackend(storage).save_table_store(ts)
+        table_meta = ts.get_table_metadata('countries')
+        self.assertNotIn('files', table_meta)
+        self.assertLessEqual(len(table_meta['file_buckets']), relib.FILE_CHECKSUM_BUCKETS)
+
+        diff = diff_table_store(ts, DictBackend(storage))
+        self.assertTrue(diff['identical'])
+        self.assertEqual(diff['fetched_files'], [])
+
+        countries = ts.get_table('countries')
+        countries.get({'country_code': 'is'})['name'] = 'Island'
+        countries.remove({'country_code': 'jp'})
+        france = countries.add({'country_code': 'fr', 'name': 'France', 'continent_id': 3})
+
+        diff = diff_table_store(ts, DictBackend(storage))
+        self.assertFalse(diff['identical'])
+        self.assertEqual(diff['tables'].keys(), ['countries'])
+        fetched_files = diff['fetched_files']
+        self.assertEqual(fetched_files[0], 'countries/#.countries.json')
+        self.assertIn('countries/countries.is.json', fetched_files)
+        self.assertIn('countries/countries.jp.json', fetched_files)
+        self.assertLess(len(fetched_files), len(countries._rows))
+        tablediff = diff['tables']['countries']
+        self.assertEqual(tablediff['new_rows'], [france])
+        self.assertEqual([row['name'] for row in tablediff['deleted_rows']], ['Japan'])
+        self.assertEqual(len(tablediff['modified_rows']), 1)
+        self.assertEqual(tablediff['modified_rows'][0]['second']['name'], 'Iceland')
+
+        # Tables only found in the backend make a difference too.
+        ts = make_store(populate=True)
+        storage = {}
+        DictBackend(storage).save_table_store(ts)
+        del ts._tables['countries']
+        diff = diff_table_store(ts, DictBackend(storage))
+        self.assertFalse(diff['identical'])
+        self.assertEqual(diff['deleted_tables'], ['countries'])
+        self.assertEqual(diff['new_tables'], [])
+
+        # Table store in pickle format is only loaded if some table differs.
+        ts = make_store(populate=True)
+        storage = {}
+        DictBackend(storage).save_table_store(ts, file_format='pickle')
+
+        class CountingBackend(DictBackend):
+            def load_data(self, k):
+                loaded.append(k)
+                return DictBackend.load_data(self, k)
+
+        loaded = []
+        self.assertTrue(diff_table_store(ts, CountingBackend(storage))['identical'])
+        self.assertNotIn(Backend.pickle_filename, loaded)
+
+        ts.get_table('continents').add({'continent_id': 4, 'name': 'Oceania'})
+        diff = diff_table_store(ts, CountingBackend(storage))
+        self.assertEqual(diff['tables'].keys(), ['continents'])
+        self.assertEqual(len(diff['tables']['continents']['new_rows']), 1)
+        self.assertIn(Backend.pickle_filename, loaded)
+
+        # The meta data next to the pickle is ignored once the pickle is replaced.
+        ts.refresh_metadata()
+        storage[Backend.pickle_filename] = relib.pickle_table_store(ts)
+        self.assertEqual(DictBackend(storage).load_meta()['checksum'], ts.meta['checksum'])
+        self.assertTrue(diff_table_store(ts, DictBackend(storage))['identical'])
+
+    def test_journal(self):
+        ts = make_store(populate=True)
+        storage = {}
+        backend = DictBackend(storage)
+        backend.save_table_store(ts)
+        ts.enable_journal()
+        self.assertEqual(ts.get_journal(), [])
+
+        # The changes are found by comparing the tables to the starting point, so rows
+        # which are modified in place are included.
+        continents, countries = ts.get_table('continents'), ts.get_table('countries')
+        continents.add({'continent_id': 4, 'name': 'Oceania'})
+        continents.update({'continent_id': 4, 'name': 'Australia'})
+        countries.get({'country_code': 'is'})['name'] = 'Island'
+        countries.remove({'country_code': 'gn'})
+        journal = ts.get_journal()
+        self.assertEqual(
+            [(entry['seq'], entry['table_name'], entry['operation']) for entry in journal],
+            [(1, 'continents', 'add'), (2, 'countries', 'update'), (3, 'countries', 'remove')]
+        )
+        self.assertEqual(journal[0]['row']['name'], 'Australia')
+        self.assertEqual(journal[1]['primary_key'], {'country_code': 'is'})
+
+        # Journal is not a part of the table store itself.
+        self.assertNotIn('_journal', ts.get_definition())
+        head = backend.save_journal(journal[:1])
+        self.assertEqual(head['seq'], 1)
+
+        # A writer starting from the same journal head doesn't overwrite the other one.
+        other_head = backend.save_journal(journal[2:], head)
+        head = backend.save_journal(journal[1:], head, checksum=ts.get_checksum())
+        self.assertEqual(other_head['seq'], 2)
+        self.assertEqual(len(backend.load_journal(journal_head=other_head)), 2)
+        self.assertEqual(len(backend.load_journal(journal_head=head)), 3)
+
+        # The journal head is published in the manifest.
+        self.assertEqual(backend.load_journal(), [])
+        backend.save_manifest(make_manifest(ts, head))
+
+        # Replay the journal incrementally on a copy of the original.
+        ts_check = DictBackend(storage).load_table_store()
+        self.assertIsNone(ts_check.get_journal())
+        seq = replay_journal(ts_check, backend.load_journal(since_seq=None)[:1])
+        self.assertEqual(seq, 1)
+        seq = replay_journal(ts_check, backend.load_journal(since_seq=seq), since_seq=seq)
+        self.assertEqual(seq, 3)
+        for table_name in ts.tables:
+            self.assertEqual(ts.get_table(table_name)._rows, ts_check.get_table(table_name)._rows)
+        self.assertEqual(backend.load_journal(since_seq=seq), [])
+
+        # Replaying on a table store which doesn't match the journal fails loudly.
+        ts_check = DictBackend(storage).load_table_store()
+        ts_check.get_table('countries').get({'country_code': 'jp'})['name'] = 'Nippon'
+        with self.assertRaises(JournalMismatchError):
+            replay_journal(ts_check, backend.load_journal())
+
+        ts.reset_journal()
+        self.assertEqual(ts.get_journal(), [])
+
+        # Only the segments needed are read, and a missing segment is reported as a gap.
+        first_segment = json.loads(storage[head['file_name']])['previous']
+        del storage[first_segment]
+        self.assertEqual(len(backend.load_journal(since_seq=1)), 2)
+        with self.assertRaises(JournalGapError):
+            backend.load_journal(since_seq=0)
+
+    def test_savepoint(self):
+        ts = make_store(populate=True)
+        continents, countries = ts.get_table('continents'), ts.get_table('countries')
+        rows = copy.deepcopy(countries._rows)
+        key_functions = countries._key_functions
+
+        savepoint = ts.savepoint()
+        countries.get({'country_code': 'is'})['name'] = 'Island'
+        found = countries.find({'continent_id': 1})
+        found[0]['name'] = 'Changed'
+        countries.remove({'country_code': 'jp'})
+        countries.add({'country_code': 'fr', 'name': 'France', 'continent_id': 3})
+        countries.update({'country_code': 'vn', 'name': 'Viet Nam', 'continent_id': 2})
+        ts.meta.get()['version'] = 99
+        self.assertEqual(continents._undo, {})  # Only the rows touched are saved.
+        ts.rollback(savepoint)
+
+        self.assertEqual(countries._rows, rows)
+        self.assertNotEqual(ts.meta['version'], 99)
+        self.assertIs(countries._key_functions, key_functions)
+        self.assertIs(countries.get(found[1]), found[1])  # Unchanged rows are not restored.
+        self.assertIsNone(countries._undo)
+        with self.assertRaises(ConstraintError):
+            countries.add({'country_code': 'xx', 'name': 'Iceland', 'continent_id': 3})
+
+        # Changes are kept once the savepoint is released.
+        savepoint = ts.savepoint()
+        countries.get({'country_code': 'is'})['name'] = 'Island'
+        ts.release(savepoint)
+        self.assertIsNone(countries._undo)
+        self.assertEqual(countries.get({'country_code': 'is'})['name'], 'Island')
+
+    def test_version_folder(self):
+        # Tables which are not saved with a new version are loaded from the folder of the
+        # version they were last saved in.
+        ts = make_store(populate=True, row_as_file=True)
+        storage = {}
+        backend = DictBackend(storage)
+        backend.save_table_store(ts)
+        ts.get_table('continents').add({'continent_id': 4, 'name': 'Oceania'})
+        backend.save_table_store(ts, folder='versions/v1')
+        self.assertIsNone(backend.get_version_folder())
+        self.assertIsNone(backend.load_table_store().get_table('continents').get({'continent_id': 4}))
+
+        backend.save_manifest(make_manifest(ts, folder='versions/v1'))
+        countries = ts.get_table('countries')
+        countries.update(dict(countries.get({'country_code': 'is'}), name='Island'))
+        backend.save_table_store(ts, table_names=['countries'], folder='versions/v2')
+        self.assertFalse([file_name for file_name in storage if file_name.startswith('versions/v2/continents')])
+        backend.save_manifest(make_manifest(ts, folder='versions/v2'))
+
+        class ConcurrentBackend(DictBackend):
+            max_concurrency = 4
+
+        for b in [backend, ConcurrentBackend(storage)]:
+            ts_check = b.load_table_store()
+            for table_name in ts.tables:
+                self.assertEqual(ts.get_table(table_name)._rows, ts_check.get_table(table_name)._rows)
+        self.assertTrue(diff_table_store(ts, backend)['identical'])
+        self.assertEqual(backend.load_meta()['checksum'], ts.meta['checksum'])
+
+        # Saving the table store at the root makes it current again.
+        backend.save_table_store(ts)
+        self.assertIsNone(backend.get_version_folder())
+
     def test_tablestore_definition(self):
         # Test serializing the definition or meta-data of the table store and tables.
         ts = make_store(populate=False)
@@ -530,6 +1072,73 @@ class TestRelib(unittest.TestCase):
         finally:
             shutil.rmtree(tmpdirname)
 
+    def test_file_backend_atomic_writes_and_cache(self):
+        tmpdirname = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdirname)
+        ts = make_store(populate=True, row_as_file=True)
+        backend = create_backend('file://' + tmpdirname + '?fsync=1')
+        self.assertTrue(backend.fsync)
+        backend.save_table_store(ts)
+
+        def temp_files():
+            return [f for dirpath, dirs, files in os.walk(tmpdirname) for f in files if f.endswith('.tmp')]
+        self.assertEqual(temp_files(), [])
+
+        # A failed write leaves the file intact.
+        with self.assertRaises(TypeError):
+            backend.save_data('continents.json', None)
+        self.assertEqual(temp_files(), [])
+        self.assertEqual(len(json.loads(backend.load_data('continents.json'))), 3)
+
+        # Loads of an unchanged table store return equal but separate copies.
+        ts1 = FileBackend(tmpdirname).load_table_store()
+        ts2 = FileBackend(tmpdirname).load_table_store()
+        self.assertIsNot(ts1, ts2)
+        for table_name in ts.tables:
+            self.assertEqual(ts.get_table(table_name)._rows, ts2.get_table(table_name)._rows)
+        ts2.get_table('continents').add({'continent_id': 4, 'name': 'Oceania'})
+        self.assertIsNone(FileBackend(tmpdirname).load_table_store().get_table('continents').get((4,)))
+
+        # Changes on disk are picked up.
+        FileBackend(tmpdirname).save_table_store(ts2)
+        self.assertIsNotNone(FileBackend(tmpdirname).load_table_store().get_table('continents').get((4,)))
+
+        # Files which are no longer part of the table store are dropped from the read cache.
+        root_file = FileBackend(tmpdirname).get_filename('continents.json')
+        self.assertIsNotNone(FileBackend._read_cache.get(root_file))
+        folder = relib.make_version_folder()
+        backend.save_table_store(ts2, folder=folder)
+        backend.save_manifest(make_manifest(ts2, folder=folder))
+        self.assertIsNotNone(FileBackend(tmpdirname).load_table_store().get_table('continents').get((4,)))
+        self.assertIsNone(FileBackend._read_cache.get(root_file))
+
+    def test_client_registry(self):
+        registry = ClientRegistry()
+        created, disposed = [], []
+
+        def factory():
+            created.append(object())
+            return created[-1]
+
+        def get(health_check=None):
+            return registry.get(('test', 'endpoint'), factory, health_check=health_check, dispose=disposed.append)
+
+        client = get()
+        self.assertIs(get(), client)
+        self.assertIsNot(registry.get(('test', 'other'), factory), client)
+
+        # Unhealthy clients are replaced, but only checked every so often.
+        registry.health_check_interval = -1.0  # Always check
+        self.assertIs(get(health_check=lambda client: True), client)
+        new_client = get(health_check=lambda client: 1 / 0)
+        self.assertIsNot(new_client, client)
+        self.assertEqual(disposed, [client])
+        registry.health_check_interval = 3600.0
+        self.assertIs(get(health_check=lambda client: False), new_client)
+
+        registry.clear()
+        self.assertIsNot(get(), new_client)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import os
+import unittest
+
+from driftconfig.scaling import OPERATIONS, check_scaling, fit_exponent
+
+
+class TestScaling(unittest.TestCase):
+
+    def test_fit_exponent(self):
+        sizes = [100, 200, 400, 800]
+        self.assertAlmostEqual(fit_exponent(sizes, [0.5 * n for n in sizes]), 1.0)
+        self.assertAlmostEqual(fit_exponent(sizes, [0.01 * n * n for n in sizes]), 2.0)
+
+    @unittest.skipUnless(
+        os.environ.get('DRIFTCONFIG_SCALING_TESTS'),
+        "Timing dependent. Set DRIFTCONFIG_SCALING_TESTS=1 to run, or run 'python -m driftconfig.scaling'.")
+    def test_complexity(self):
+        # Operations must not scale worse than their declared complexity class.
+        failed = []
+        for name in OPERATIONS:
+            result = check_scaling(name)
+            if not result['ok']:
+                failed.append("{name} is not {complexity}: Fitted exponent {exponent:.2f} exceeds {limit:.2f}".format(
+                    **result))
+        self.assertFalse(failed, "\n".join(failed))
+
+
+if __name__ == '__main__':
+    unittest.main()
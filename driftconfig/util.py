@@ -7,8 +7,11 @@ import os
 import os.path
 import getpass
 import importlib
+import json
 
-from driftconfig.relib import get_store_from_url, create_backend
+from driftconfig.relib import get_store_from_url, create_backend, LRUCache
+from driftconfig.backends import FileBackend, _stat_signature_or_none
+from driftconfig import instrument
 
 log = logging.getLogger(__name__)
 
@@ -48,26 +51,122 @@ def config_dir(config_name, user_dir=False):
         return os.path.join(root, 'drift', 'config', config_name)
 
 
+# Name of the domain registry file in the config folder.
+DOMAIN_REGISTRY_FILENAME = 'domains.json'
+DOMAIN_REGISTRY_VERSION = 1
+
+
+class DomainInfo(dict):
+    """
+    Info on a config domain stored on local disk, with 'domain_name', 'display_name',
+    'origin', 'checksum' and 'path'. The table store itself is only loaded when
+    'table_store' is looked up.
+    """
+    def __missing__(self, key):
+        if key != 'table_store':
+            raise KeyError(key)
+        ts = get_store_from_url('file://' + self['path'])
+        self['table_store'] = ts
+        return ts
+
+
+def _domain_signature(path):
+    """
+    Returns the stat signature of the table store meta file in 'path' as a list, the same
+    as FileBackend uses to validate its caches. The file is rewritten on every save so it
+    tells if the domain folder has changed. Returns None if the folder has no meta file.
+    """
+    signature = _stat_signature_or_none(os.path.join(path, '#tsmeta.json'))
+    return list(signature) if signature is not None else None
+
+
+def _read_domain_entry(path):
+    """
+    Returns a registry entry for the domain in 'path' and the table store if it had to
+    be loaded. Only the domain and meta files are read unless they are missing.
+    """
+    backend = FileBackend(path)
+    try:
+        domain = json.loads(backend.load_data('domain.json'))
+        checksum = json.loads(backend.load_data('#tsmeta.json')).get('checksum')
+        ts = None
+    except (IOError, ValueError):
+        ts = get_store_from_url('file://' + path)
+        domain = ts.get_table('domain').get()
+        checksum = ts.meta['checksum']
+
+    entry = {
+        'domain_name': domain['domain_name'],
+        'display_name': domain.get('display_name', ''),
+        'origin': domain.get('origin', ''),
+        'checksum': checksum,
+        'mtime': _domain_signature(path),
+    }
+    return entry, ts
+
+
+def _load_domain_registry(config_folder):
+    try:
+        with open(os.path.join(config_folder, DOMAIN_REGISTRY_FILENAME)) as f:
+            registry = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    if registry.get('version') != DOMAIN_REGISTRY_VERSION:
+        return {}
+    return registry['folders']
+
+
+def _save_domain_registry(config_folder, folders):
+    registry = {'version': DOMAIN_REGISTRY_VERSION, 'folders': folders}
+    try:
+        FileBackend(config_folder).save_data(
+            DOMAIN_REGISTRY_FILENAME, json.dumps(registry, indent=4, sort_keys=True))
+    except (IOError, OSError) as e:
+        log.warning("Can't write domain registry to '%s': %s", config_folder, e)
+
+
 def get_domains(user_dir=False, skip_errors=False):
-    """Return all config domains stored on local disk."""
+    """
+    Return all config domains stored on local disk. Key is domain name and value is
+    a DomainInfo.
+
+    The name, origin and checksum of each domain are kept in a registry file in the
+    config folder, and a domain is only read again if its folder has changed. The
+    table stores are not loaded until 'table_store' is looked up on the domain info.
+    """
     config_folder = config_dir('', user_dir=user_dir)
     domains = {}
     if not os.path.exists(config_folder):
         return {}
 
+    registry = _load_domain_registry(config_folder)
+    folders = {}
     for dir_name in os.listdir(config_folder):
         path = os.path.join(config_folder, dir_name)
-        if os.path.isdir(path):
+        if not os.path.isdir(path):
+            continue
+
+        entry = registry.get(dir_name)
+        ts = None
+        if not entry or entry['mtime'] is None or entry['mtime'] != _domain_signature(path):
             try:
-                ts = get_store_from_url('file://' + path)
+                entry, ts = _read_domain_entry(path)
             except Exception as e:
                 if skip_errors:
                     log.warning("Note: '%s' is not a config folder or is corrupt. (%s).", path, e)
                     continue
                 else:
                     raise
-            domain = ts.get_table('domain')
-            domains[domain['domain_name']] = {'path': path, 'table_store': ts}
+
+        folders[dir_name] = entry
+        domain_info = DomainInfo(entry, path=path)
+        del domain_info['mtime']
+        if ts:
+            domain_info['table_store'] = ts
+        domains[entry['domain_name']] = domain_info
+
+    if folders != registry:
+        _save_domain_registry(config_folder, folders)
     return domains
 
 
@@ -154,6 +253,7 @@ conf_tuple = collections.namedtuple(
 )
 
 
+@instrument.timed('util.get_drift_config')
 def get_drift_config(
     ts=None,
     tenant_name=None,
@@ -172,12 +272,62 @@ def get_drift_config(
     If 'tenant_name' is specified but not found in config a TenantNotConfigured exception
     is raised. If 'allow_missing_tenant' is True however, then the config tuple will be
     returned but with the 'tenant' property set to None.
+
+    The lookups are cached for table stores which haven't changed since they were loaded
+    from a backend, see TableStore.pristine. Table stores which are being edited are
+    looked up afresh on every call.
     """
     if ts:
         source = "internal"
     else:
         ts, source = get_default_drift_config_and_source()
 
+    # HACK BEGIN: Until 'flask_config' has been repurposed into 'drift_app' config, we enable a little mapping between
+    # here for convenience:
+    if drift_app and not deployable_name:
+        deployable_name = drift_app['name']
+    # HACK END
+
+    if ts.pristine:
+        key = (tier_name, deployable_name, tenant_name)
+        cache = ts.get_cache('drift_config', _new_resolution_cache)
+        resolved = cache.get(key)
+        if resolved is None:
+            resolved = cache[key] = _resolve_drift_config(ts, tenant_name, tier_name, deployable_name)
+    else:
+        resolved = _resolve_drift_config(ts, tenant_name, tier_name, deployable_name)
+
+    if resolved['tenant_not_found'] and not allow_missing_tenant:
+        raise TenantNotConfigured(resolved['tenant_not_found'])
+
+    return conf_tuple(
+        table_store=ts,
+        tenant=resolved['tenant'],
+        tier=resolved['tier'],
+        deployable=resolved['deployable'],
+        domain=resolved['domain'],
+        tenant_name=resolved['tenant_name'],
+        tenants=list(resolved['tenants']),
+        product=resolved['product'],
+        organization=resolved['organization'],
+        drift_app=drift_app,
+        source=source,
+    )
+
+
+# Max number of (tier, deployable, tenant) lookups cached per table store.
+RESOLUTION_CACHE_SIZE = 1024
+
+
+def _new_resolution_cache():
+    return LRUCache(RESOLUTION_CACHE_SIZE)
+
+
+def _resolve_drift_config(ts, tenant_name, tier_name, deployable_name):
+    """
+    Look up the rows for get_drift_config(). Returns a dict with the rows, and
+    'tenant_not_found' as the error message if the tenant doesn't exist.
+    """
     # Map tenant alias to actual tenant name if needed.
     tenant_name_row = ts.get_table('tenant-names').find({'alias': tenant_name})
     alias = tenant_name
@@ -185,20 +335,13 @@ def get_drift_config(
         tenant_name = tenant_name_row[0]['tenant_name']
         alias = "{} (alias={})".format(tenant_name, alias)
 
-    # HACK BEGIN: Until 'flask_config' has been repurposed into 'drift_app' config, we enable a little mapping between
-    # here for convenience:
-    if drift_app and not deployable_name:
-        deployable_name = drift_app['name']
-    # HACK END
-
     tenants = ts.get_table('tenants')
+    tenant_not_found = None
     if tenant_name:
         tenant = tenants.get({'tier_name': tier_name, 'deployable_name': deployable_name, 'tenant_name': tenant_name})
-
-        if not tenant and not allow_missing_tenant:
-            raise TenantNotConfigured(
-                "Tenant '{}' not found for tier '{}' and deployable '{}'".format(alias, tier_name, deployable_name)
-            )
+        if not tenant:
+            tenant_not_found = "Tenant '{}' not found for tier '{}' and deployable '{}'".format(
+                alias, tier_name, deployable_name)
     else:
         tenant = None
 
@@ -218,26 +361,25 @@ def get_drift_config(
     else:
         tenant_rows = []
 
-    conf = conf_tuple(
-        table_store=ts,
-        tenant=tenant,
-        tier=ts.get_table('tiers').get({'tier_name': tier_name}),
-        deployable=ts.get_table('deployables').get({'deployable_name': deployable_name, 'tier_name': tier_name}),
-        domain=ts.get_table('domain'),
-        tenant_name=tenant_name,
-        tenants=tenant_rows,
-        product=product,
-        organization=organization,
-        drift_app=drift_app,
-        source=source,
-    )
+    domain = ts.get_table('domain')
+    tier = ts.get_table('tiers').get({'tier_name': tier_name})
 
     # Make sure if tier name was specified, that it actually exists.
-    if tier_name and conf.tier is None:
+    if tier_name and tier is None:
         raise RuntimeError(
-            "Tier '{}' not found in config '{}'.".format(tier_name, conf.domain['domain_name']))
+            "Tier '{}' not found in config '{}'.".format(tier_name, domain['domain_name']))
 
-    return conf
+    return {
+        'tenant': tenant,
+        'tenant_not_found': tenant_not_found,
+        'tier': tier,
+        'deployable': ts.get_table('deployables').get({'deployable_name': deployable_name, 'tier_name': tier_name}),
+        'domain': domain,
+        'tenant_name': tenant_name,
+        'tenants': tenant_rows,
+        'product': product,
+        'organization': organization,
+    }
 
 
 def prepare_tenant_name(ts, tenant_name, product_name):
@@ -381,6 +523,7 @@ def define_tenant(ts, tenant_name, product_name, tier_name):
             report_row.setdefault('resources', {})[resource_name] = resource_attribs
 
     prep['report'] = report
+    ts.invalidate_caches()  # Tenant states are modified in place.
     return prep
 
 
@@ -461,6 +604,7 @@ def provision_tenant_resources(ts, tenant_name, deployable_name=None, preview=Fa
 
         depl_report['new_state'] = tenant_config['state']
 
+    ts.invalidate_caches()  # Tenant states are modified in place.
     return report
 
 